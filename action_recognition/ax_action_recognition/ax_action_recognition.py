@@ -11,15 +11,17 @@ import math
 
 import ailia
 
-# import tracking modules
+# import original modules
+sys.path.append('../../util')
+
+# import tracking modules (the tracker uses util/kalman_utils.py)
 sys.path.append('../../object_tracking/deepsort')
-from sort.tracker import Tracker
-from sort.nn_matching import NearestNeighborDistanceMetric
+from sort.tracker import Tracker  # noqa: E402
+from sort.nn_matching import NearestNeighborDistanceMetric  # noqa: E402
 from deepsort_utils import Detection,xywh_to_xyxy,xywh_to_tlwh,tlwh_to_xyxy,xyxy_to_tlwh,\
-    get_detector_result,non_max_suppression
+    get_detector_result,non_max_suppression  # noqa: E402
 
-# import original modules
-sys.path.append('../../util')
+from clip_utils import ClipBuffer, ScoreSmoother  # noqa: E402
 from webcamera_utils import adjust_frame_size  # noqa: E402
 from image_utils import load_image  # noqa: E402
 from image_utils import normalize_image  # noqa: E402
@@ -81,6 +83,16 @@ parser.add_argument(
     default=10,
     help='Input fps for the detection model'
 )
+parser.add_argument(
+    '--stride', default=1, type=int,
+    help='Run the action recognition every STRIDE frames, '
+    'the last result is shown on the frames in between.'
+)
+parser.add_argument(
+    '--smoothing', default=0.0, type=float,
+    help='Exponential moving average factor in [0, 1) of the action '
+    'probabilities of successive recognitions. 0 disables the smoothing.'
+)
 args = update_parser(parser)
 
 POSE_KEY = [
@@ -221,7 +233,7 @@ def display_result(input_img, person):
             ailia.POSE_KEYPOINT_KNEE_RIGHT)
 
 
-def action_recognition(box,input_image,pose,detector,model,data):
+def action_recognition(box,input_image,pose,detector,model,data,smoother):
     if args.arch=="lw_human_pose":
         bbox_xywh, cls_conf, cls_ids = get_detector_result_lw_human_pose(pose, input_image.shape[0], input_image.shape[1], get_all=True)
 
@@ -254,29 +266,27 @@ def action_recognition(box,input_image,pose,detector,model,data):
     frame = np.expand_dims(openpose_keypoints, axis=1)
     frame = pose_postprocess(frame)
 
-    for i in range(TIME_RANGE-1):
-        data[:,i,:]=data[:,i+1,:] #data: (ailia.POSE_KEYPOINT_CNT,TIME_RANGE,3)
-   
-    data[:,TIME_RANGE-1,:] = frame[:,0,:]
+    data.push(frame[:,0,:])
+    clip = data.clip() #clip: (ailia.POSE_KEYPOINT_CNT,TIME_RANGE,3)
 
-    zero_cnt = 0
-    for i in range(TIME_RANGE):
-        if np.sum(data[:,i,:])==0:
-            zero_cnt=zero_cnt+1
+    zero_cnt = np.count_nonzero(np.sum(clip, axis=(0, 2))==0)
 
     if zero_cnt>=1:
+        smoother.reset()
         return "-", person
 
-    data_rgb = data.transpose((2 ,1, 0))
-    data_rgb = data_rgb[:2,...]   # May need to be removed if input for action model changed
+    if smoother.due():
+        data_rgb = clip.transpose((2 ,1, 0))
+        data_rgb = data_rgb[:2,...]   # May need to be removed if input for action model changed
 
-    data_rgb = np.expand_dims(data_rgb, axis=3)
-    data_rgb.shape = (1,) + data_rgb.shape
+        data_rgb = np.expand_dims(data_rgb, axis=3)
+        data_rgb.shape = (1,) + data_rgb.shape
 
-    model.set_input_shape(data_rgb.shape)
-    action = model.predict(data_rgb)
+        model.set_input_shape(data_rgb.shape)
+        action = model.predict(data_rgb)
 
-    action = softmax(action)
+        smoother.update(softmax(action))
+    action = smoother.scores
     max_prob=0
     class_idx=0
     for i in range(len(LABELS)):
@@ -360,6 +370,7 @@ def recognize_from_video():
     model = ailia.Net(ACTION_MODEL_PATH, ACTION_WEIGHT_PATH, env_id=env_id)
 
     action_data = {}
+    action_smoother = {}
 
     frame_nb = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
     idx_frame = 0
@@ -457,7 +468,7 @@ def recognize_from_video():
             box = track.to_tlwh()
             x1, y1, x2, y2 = tlwh_to_xyxy(box, h, w)
             track_id = track.track_id
-            outputs.append(np.array([x1, y1, x2, y2, track_id], dtype=np.int))
+            outputs.append(np.array([x1, y1, x2, y2, track_id], dtype=np.int64))
         if len(outputs) > 0:
             outputs = np.stack(outputs, axis=0)
 
@@ -471,10 +482,11 @@ def recognize_from_video():
                 id = identities[i]
 
                 if not(id in action_data):
-                    action_data[id] = np.zeros((ailia.POSE_KEYPOINT_CNT-1,TIME_RANGE,3))
+                    action_data[id] = ClipBuffer(TIME_RANGE, (ailia.POSE_KEYPOINT_CNT-1,3), dtype=np.float64, time_axis=1)
+                    action_smoother[id] = ScoreSmoother(args.stride, args.smoothing)
 
                 # action recognition
-                action,person = action_recognition(box, input_image, pose, detector, model, action_data[id])
+                action,person = action_recognition(box, input_image, pose, detector, model, action_data[id], action_smoother[id])
                 actions.append(action)
                 persons.append(person)
                 
@@ -11,6 +11,7 @@ import numpy as np
 # import original modules
 sys.path.append('../../util')
 from classifier_utils import plot_results  # noqa: E402
+from clip_utils import ClipBuffer, ScoreSmoother  # noqa: E402
 from image_utils import imread, load_image  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 from utils import get_base_parser, update_parser  # noqa: E402
@@ -101,6 +102,16 @@ parser.add_argument(
     action='store_true',
     help='Display preview in GUI.'
 )
+parser.add_argument(
+    '--stride', default=1, type=int,
+    help='Run the recognition every STRIDE frames, '
+    'the last result is shown on the frames in between.'
+)
+parser.add_argument(
+    '--smoothing', default=0.0, type=float,
+    help='Exponential moving average factor in [0, 1) of the scores '
+    'of successive recognitions. 0 disables the smoothing.'
+)
 args = update_parser(parser)
 
 
@@ -117,19 +128,25 @@ def print_mars_result(result):
         print(f'  prob={result[0, idx]}')
 
 
+def new_clip_buffer():
+    # (3, duration, H, W) clips of (3, H, W) frames
+    return ClipBuffer(
+        args.duration, (3, IMAGE_HEIGHT, IMAGE_WIDTH), time_axis=1)
+
+
 def recognize_from_image():
     # prepare input data
     num = lambda val: int(re.sub("\\D", "", val))
     sorted_inputs_path = sorted(args.input, key=num)
-    input_blob = np.empty((1, 3, args.duration, IMAGE_HEIGHT, IMAGE_WIDTH))
-    for i, input_path in enumerate(sorted_inputs_path[0:args.duration]):
+    clip = new_clip_buffer()
+    for input_path in sorted_inputs_path[0:args.duration]:
         img = load_image(
             input_path,
             (IMAGE_HEIGHT, IMAGE_WIDTH),
             normalize_type='None',
             gen_input_ailia=True
         )
-        input_blob[0, :, i, :, :] = img
+        clip.push(img[0])
     next_input_index = args.duration
     input_frame_size = len(sorted_inputs_path)
 
@@ -141,19 +158,22 @@ def recognize_from_image():
     print('Start inference...')
     if args.benchmark:
         print('BENCHMARK mode')
+        input_blob = clip.clip()[np.newaxis]
         for i in range(5):
             start = int(round(time.time() * 1000))
             result = net.predict(input_blob)
             end = int(round(time.time() * 1000))
             print(f'\tailia processing time {end - start} ms')
     else:
+        smoother = ScoreSmoother(args.stride, args.smoothing)
         frame_shown = False
         while(next_input_index < input_frame_size):
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
             if frame_shown and cv2.getWindowProperty('preview', cv2.WND_PROP_VISIBLE) == 0:
                 break
-            result = net.predict(input_blob)
+            if smoother.due():
+                result = smoother.update(net.predict(clip.clip()[np.newaxis]))
 
             print_mars_result(result)
 
@@ -163,9 +183,6 @@ def recognize_from_image():
             if args.gui:
                 cv2.imshow('preview', preview_img)
                 frame_shown = True
-            
-            for i in range(args.duration - 1):
-                input_blob[0, :, i, :, :] = input_blob[0, :, i + 1, :, :]
 
             img = load_image(
                 sorted_inputs_path[next_input_index],
@@ -173,7 +190,7 @@ def recognize_from_image():
                 normalize_type='None',
                 gen_input_ailia=True
             )
-            input_blob[0, :, args.duration - 1, :, :] = img
+            clip.push(img[0])
             next_input_index += 1
 
     print('Script finished successfully.')
@@ -196,13 +213,14 @@ def recognize_from_video():
 
     # prepare input data
     original_queue = deque([])
-    input_blob = np.empty((1, 3, args.duration, IMAGE_HEIGHT, IMAGE_WIDTH))
+    clip = new_clip_buffer()
     for i in range(args.duration - 1):
         ret, frame = capture.read()
         if not ret:
             continue
         original_queue.append(frame)
-        input_blob[0, :, i, :, :] = convert_input_frame(frame)
+        clip.push(convert_input_frame(frame)[0])
+    smoother = ScoreSmoother(args.stride, args.smoothing)
 
     next_input_index = args.duration - 1
     input_frame_size = capture.get(cv2.CAP_PROP_FRAME_COUNT)
@@ -216,9 +234,10 @@ def recognize_from_video():
             break
             
         original_queue.append(frame)
-        input_blob[0, :, args.duration - 1, :, :] = convert_input_frame(frame)
+        clip.push(convert_input_frame(frame)[0])
 
-        result = net.predict(input_blob)
+        if smoother.due():
+            result = smoother.update(net.predict(clip.clip()[np.newaxis]))
         print_mars_result(result)
         preview_img = original_queue.popleft()
 
@@ -227,9 +246,6 @@ def recognize_from_video():
         cv2.imshow('preview', preview_img)
         frame_shown = True
 
-        for i in range(args.duration - 1):
-            input_blob[0, :, i, :, :] = input_blob[0, :, i + 1, :, :]
-
         next_input_index += 1
 
     capture.release()
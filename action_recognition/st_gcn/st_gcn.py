@@ -15,6 +15,7 @@ from utils import get_base_parser, update_parser  # noqa: E402
 from utils import check_file_existance  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 from webcamera_utils import get_capture  # noqa: E402
+from clip_utils import ScoreSmoother  # noqa: E402
 
 
 # ======================
@@ -72,6 +73,16 @@ parser.add_argument(
     '--img-save', action='store_true',
     help='Instead of show video, save image file.'
 )
+parser.add_argument(
+    '--stride', default=1, type=int,
+    help='Run the recognition every STRIDE frames, '
+    'the last result is shown on the frames in between. (realtime mode)'
+)
+parser.add_argument(
+    '--smoothing', default=0.0, type=float,
+    help='Exponential moving average factor in [0, 1) of the scores '
+    'of successive recognitions. 0 disables the smoothing. (realtime mode)'
+)
 args = update_parser(parser)
 
 if args.arch == "pyopenpose":
@@ -248,6 +259,9 @@ def recognize_realtime(video, pose, net):
     capture = get_capture(args.video)
 
     pose_tracker = naive_pose_tracker()
+    smoother = ScoreSmoother(args.stride, args.smoothing)
+    out = None
+    inferred_person = 0
 
     # start recognition
     start_time = time.time()
@@ -304,18 +318,28 @@ def recognize_realtime(video, pose, net):
 
         # action recognition
         data = pose_tracker.get_skeleton_sequence()
-        input_data = np.expand_dims(data, 0)
-        net.set_input_shape(input_data.shape)
-        outputs = net.predict({
-            'data': input_data
-        })
-        output, feature = outputs
-        output = output[0]
-        feature = feature[0]
-
-        # classification result for each person of the latest frame
         _, _, _, num_person = data.shape
-        out = postprocess(output, feature, num_person)
+        if num_person != inferred_person:
+            # the labels are given by person, infer again
+            smoother.reset()
+            inferred_person = num_person
+        if smoother.due():
+            input_data = np.expand_dims(data, 0)
+            net.set_input_shape(input_data.shape)
+            outputs = net.predict({
+                'data': input_data
+            })
+            output, feature = outputs
+            num_class = output.shape[1]
+
+            # smooth the class scores and the features together
+            scores = smoother.update(
+                np.concatenate([output[0], feature[0]], axis=0))
+            output = scores[:num_class]
+            feature = scores[num_class:]
+
+            # classification result for each person of the latest frame
+            out = postprocess(output, feature, num_person)
         voting_label_name, video_label_name, output, intensity = out
 
         # visualization
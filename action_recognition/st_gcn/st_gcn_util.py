@@ -4,6 +4,7 @@ import cv2
 import numpy as np
 
 sys.path.append('../../util')
+from clip_utils import ClipBuffer  # noqa: E402
 from image_utils import imread  # noqa: E402
 
 graph_edge = [
@@ -42,7 +43,7 @@ class naive_pose_tracker():
             matching_trace = None
             matching_dis = None
             for trace_index, (trace, latest_frame) in enumerate(self.trace_info):
-                # trace.shape: (num_frame, num_joint, 3)
+                # trace: ring buffer of the latest data_frame poses
                 if current_frame <= latest_frame:
                     continue
                 mean_dis, is_close = self.get_dis(trace, p)
@@ -61,11 +62,13 @@ class naive_pose_tracker():
                 # padding zero if the trace is fractured
                 pad_mode = 'interp' if latest_frame == self.latest_frame else 'zero'
                 pad = current_frame - latest_frame - 1
-                new_trace = self.cat_pose(trace, p, pad, pad_mode)
-                self.trace_info[matching_trace] = (new_trace, current_frame)
+                self.cat_pose(trace, p, pad, pad_mode)
+                self.trace_info[matching_trace] = (trace, current_frame)
 
             else:
-                new_trace = np.array([p])
+                new_trace = ClipBuffer(
+                    self.data_frame, p.shape, dtype=np.float64)
+                new_trace.push(p)
                 self.trace_info.append((new_trace, current_frame))
 
         self.latest_frame = current_frame
@@ -86,33 +89,32 @@ class naive_pose_tracker():
         data = np.zeros((3, self.data_frame, self.num_joint, num_trace))
         for trace_index, (trace, latest_frame) in enumerate(self.trace_info):
             end = self.data_frame - (self.latest_frame - latest_frame)
-            d = trace[-end:]
-            beg = end - len(d)
-            data[:, beg:end, :, trace_index] = d.transpose((2, 0, 1))
+            # the poses not pushed yet are zeros at the beginning of the clip
+            d = trace.clip()[self.data_frame - end:]
+            data[:, :end, :, trace_index] = d.transpose((2, 0, 1))
 
         return data
 
-    # concatenate pose to a trace
+    # append pose to a trace
     def cat_pose(self, trace, pose, pad, pad_mode):
-        # trace.shape: (num_frame, num_joint, 3)
+        # trace: ring buffer of (num_joint, 3) poses
         num_joint = pose.shape[0]
-        num_channel = pose.shape[1]
         if pad != 0:
+            # only the padding poses kept in the buffer are computed
+            begin = max(0, pad - trace.length)
             if pad_mode == 'zero':
-                trace = np.concatenate(
-                    (trace, np.zeros((pad, num_joint, 3))), 0)
+                trace.extend(np.zeros((pad - begin, num_joint, 3)))
             elif pad_mode == 'interp':
-                last_pose = trace[-1]
-                coeff = [(p + 1) / (pad + 1) for p in range(pad)]
+                last_pose = trace.last.copy()
+                coeff = [(p + 1) / (pad + 1) for p in range(begin, pad)]
                 interp_pose = [(1 - c) * last_pose + c * pose for c in coeff]
-                trace = np.concatenate((trace, interp_pose), 0)
-        new_trace = np.concatenate((trace, [pose]), 0)
-        return new_trace
+                trace.extend(interp_pose)
+        trace.push(pose)
 
     # calculate the distance between a existing trace and the input pose
 
     def get_dis(self, trace, pose):
-        last_pose_xy = trace[-1, :, 0:2]
+        last_pose_xy = trace.last[:, 0:2]
         curr_pose_xy = pose[:, 0:2]
 
         mean_dis = ((((last_pose_xy - curr_pose_xy) ** 2).sum(1)) ** 0.5).mean()
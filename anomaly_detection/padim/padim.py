@@ -2,8 +2,6 @@ import os
 import sys
 import time
 from collections import OrderedDict
-import random
-import pickle
 
 import numpy as np
 import cv2
@@ -48,8 +46,8 @@ parser.add_argument(
     help='arch model.'
 )
 parser.add_argument(
-    '-f', '--feat', metavar="PICKLE_FILE", default=None,
-    help='train set feature pkl files.'
+    '-f', '--feat', metavar="FEAT_FILE", default=None,
+    help='train set feature directory (memory-mapped) or pkl file.'
 )
 parser.add_argument(
     '-bs', '--batch_size', default=32,
@@ -79,6 +77,11 @@ parser.add_argument(
     '-an', '--aug_num', type=int, default=5,
     help='specify the amplification number of augmentation.'
 )
+parser.add_argument(
+    '-u', '--update', action='store_true',
+    help='absorb the files of train_dir into the train set feature ' +
+    'specified by --feat, and save it again.'
+)
 args = update_parser(parser)
 
 
@@ -152,19 +155,21 @@ def plot_fig(file_list, test_imgs, scores, anormal_scores, gt_imgs, threshold, s
         plt.close()
 
 
-def train_from_image_or_video(net, params):
+def train_from_image_or_video(net, params, stats=None):
     # training
-    train_outputs = training(net, params, IMAGE_RESIZE, KEEP_ASPECT, int(args.batch_size), args.train_dir, args.aug, args.aug_num, args.seed, logger)
+    stats = training_statistics(
+        net, params, IMAGE_RESIZE, KEEP_ASPECT, int(args.batch_size),
+        args.train_dir, args.aug, args.aug_num, args.seed, logger, stats=stats)
+    train_outputs = stats.train_outputs()
 
     # save learned distribution
     if args.feat:
         train_feat_file = args.feat
     else:
         train_dir = args.train_dir
-        train_feat_file = "%s.pkl" % os.path.basename(train_dir)
+        train_feat_file = "%s_feat" % os.path.basename(os.path.normpath(train_dir))
     logger.info('saving train set feature to: %s ...' % train_feat_file)
-    with open(train_feat_file, 'wb') as f:
-        pickle.dump(train_outputs, f)
+    save_train_outputs(train_feat_file, train_outputs, stats)
     logger.info('saved.')
 
     return train_outputs
@@ -294,10 +299,13 @@ def infer_from_video(net, params, train_outputs, threshold):
 
 
 def train_and_infer(net, params):
-    if args.feat:
+    if args.feat and args.update:
+        logger.info('updating train set feature: %s' % args.feat)
+        stats = load_statistics(args.feat)
+        train_outputs = train_from_image_or_video(net, params, stats)
+    elif args.feat:
         logger.info('loading train set feature from: %s' % args.feat)
-        with open(args.feat, 'rb') as f:
-            train_outputs = pickle.load(f)
+        train_outputs = load_train_outputs(args.feat)
         logger.info('loaded.')
     else:
         train_outputs = train_from_image_or_video(net, params)
@@ -40,6 +40,7 @@ result_index = 0
 slider_index = 50
 
 REMOTE_PATH = 'https://storage.googleapis.com/ailia-models/padim/'
+TRAIN_FEAT_FILE = 'train_feat'
 
 train_folder = None
 test_folder = None
@@ -154,15 +155,13 @@ def train_button_clicked():
     aug = False
     aug_num = 0
     seed = 1024
-    train_outputs = training(net, params, get_image_resize(), get_keep_aspect(), batch_size, train_dir, aug, aug_num, seed, logger)
+    stats = training_statistics(net, params, get_image_resize(), get_keep_aspect(), batch_size, train_dir, aug, aug_num, seed, logger)
+    train_outputs = stats.train_outputs()
 
     # save learned distribution
-    train_feat_file = "train.pkl"
-    #train_dir = args.train_dir
-    #train_feat_file = "%s.pkl" % os.path.basename(train_dir)
+    train_feat_file = TRAIN_FEAT_FILE
     logger.info('saving train set feature to: %s ...' % train_feat_file)
-    with open(train_feat_file, 'wb') as f:
-        pickle.dump(train_outputs, f)
+    save_train_outputs(train_feat_file, train_outputs, stats)
     logger.info('saved.')
 
     score_cache = {}
@@ -186,9 +185,8 @@ def test_button_clicked():
     env_id = ailia.get_gpu_environment_id()
     net = ailia.Net(model_path, weight_path, env_id=env_id)
 
-    # load trained model
-    with open("train.pkl", 'rb') as f:
-        train_outputs = pickle.load(f)
+    # load trained model (memory-mapped)
+    train_outputs = load_train_outputs(TRAIN_FEAT_FILE)
     
     threshold = slider_index / 100.0
 
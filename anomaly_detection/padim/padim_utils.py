@@ -4,12 +4,12 @@ import cv2
 from collections import OrderedDict
 import random
 import pickle
+import sys
 
 from PIL import Image
 from image_utils import normalize_image  # noqa: E402
 from detector_utils import load_image  # noqa: E402
 
-from scipy.spatial.distance import mahalanobis
 from scipy.ndimage import gaussian_filter
 
 from sklearn.metrics import precision_recall_curve
@@ -31,32 +31,13 @@ def embedding_concat(x, y):
     assert H1 == W1
 
     s = H1 // H2
-    sel = [np.array([i for i in range(i, H1, s)]) for i in range(s)]
-
-    a = np.zeros((B, C1 * s * s, H2 * W2))
-    for b in range(B):
-        for c in range(C1):
-            for i in range(s * s):
-                a[b, c * s * s + i, :] = x[
-                    b, c, sel[i // s][:, None], sel[i % s]
-                ].flatten()
-    x = a.reshape((B, C1, -1, H2, W2))
-    z = np.zeros((B, C1 + C2, s * s, H2, W2))
-    for i in range(s * s):
-        z[:, :, i, :, :] = np.concatenate((x[:, :, i, :, :], y), axis=1)
-    z = z.reshape((B, -1, H2 * W2))
-
-    _, C3, _ = z.shape
-    a = np.zeros((B, C3 // (s * s), H1, W1))
-    for b in range(B):
-        for c in range(C3 // (s * s)):
-            for i in range(s * s):
-                x = z[b, c * s * s + i, :].reshape((H2, W2))
-                a[
-                    b, c, sel[i // s][:, None], sel[i % s]
-                ] = x
-
-    return a
+
+    # upsample y with nearest neighbor and stack it on x along the channel
+    # axis (same result as unfold -> concat -> fold with kernel/stride s)
+    y = np.repeat(np.repeat(y, s, axis=2), s, axis=3)
+    z = np.concatenate((x, y.astype(x.dtype, copy=False)), axis=1)
+
+    return z
 
 
 def preprocess(img, size, mask=False, keep_aspect = True):
@@ -152,32 +133,123 @@ def postprocess(outputs):
     return embedding_vectors
 
 
-def capture_training_frames_from_video(train_dir):
+def capture_training_frames_from_video(train_dir, max_frames=200):
+    """
+    Yield up to max_frames frames of the video (or camera) one by one,
+    so that the frames are absorbed without being kept in memory.
+    """
     if os.path.isfile(train_dir):
         capture = cv2.VideoCapture(train_dir)
     else:
         capture = cv2.VideoCapture(int(train_dir))
-    if not capture:
-        logger.error("file open failed")
-        sts.exit(-1)
-    train_imgs = []
+    if not capture.isOpened():
+        raise IOError("file open failed : %s" % train_dir)
+    n_frames = 0
     while(True):
         ret, frame = capture.read()
         if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
             break
         cv2.imshow("capture", frame)
-        train_imgs.append(frame)
-        if len(train_imgs) >= 200:
+        yield frame
+        n_frames += 1
+        if n_frames >= max_frames:
             break
     capture.release()
     cv2.destroyAllWindows()
-    return train_imgs
 
 
-def training(net, params, size, keep_aspect, batch_size, train_dir, aug, aug_num, seed, logger):
-    # set seed
-    random.seed(seed)
-    idx = random.sample(range(0, params["t_d"]), params["d"])
+class PadimStatistics:
+    """
+    Online accumulator of the multivariate Gaussian distribution of the
+    embedding vectors at each pixel.
+
+    Batches are merged with the parallel form of Welford's algorithm
+    (Chan et al.), so the memory usage is fixed by the feature size
+    (C, C, H * W) and does not depend on the number of absorbed images.
+    """
+
+    def __init__(self, idx, n=0, mean=None, m2=None):
+        self.idx = np.asarray(idx)
+        self.n = int(n)
+        self.mean = mean  # (C, H * W), float64
+        self.m2 = m2  # (C, C, H * W), sum of outer products of deviations
+
+    def update(self, embedding_vectors):
+        """
+        embedding_vectors: (B, C, H * W)
+        """
+        B = embedding_vectors.shape[0]
+        batch_mean = np.mean(embedding_vectors, axis=0, dtype=np.float64)
+        d = (embedding_vectors - batch_mean[np.newaxis]).astype(np.float32)
+        batch_m2 = np.einsum('bci,bdi->cdi', d, d)
+
+        if self.n == 0:
+            self.n = B
+            self.mean = batch_mean
+            self.m2 = batch_m2
+            return
+
+        n = self.n + B
+        delta = batch_mean - self.mean
+        self.mean += delta * (B / n)
+        self.m2 += batch_m2
+        self.m2 += np.einsum(
+            'ci,di->cdi', delta, delta * (self.n * B / n)).astype(np.float32)
+        self.n = n
+
+    def covariance(self):
+        if self.n < 2:
+            raise ValueError("at least 2 samples are required, but got %d" % self.n)
+        C = self.m2.shape[0]
+        cov = self.m2 / (self.n - 1)
+        cov += 0.01 * np.identity(C, dtype=cov.dtype)[:, :, np.newaxis]
+        return cov
+
+    def train_outputs(self):
+        cov = self.covariance()
+        cov_inv = inverse_covariance(cov)
+        mean = self.mean.astype(np.float32)
+        return [mean, cov, cov_inv, self.idx]
+
+
+def extract_embedding_vectors(net, params, imgs, idx):
+    # inference
+    net.set_input_shape(imgs.shape)
+    _ = net.predict(imgs)
+
+    outputs = OrderedDict([
+        ('layer1', []), ('layer2', []), ('layer3', [])
+    ])
+    for key, name in zip(outputs.keys(), params["feat_names"]):
+        outputs[key].append(net.get_blob_data(name))
+    for k, v in outputs.items():
+        outputs[k] = v[0]
+
+    embedding_vectors = postprocess(outputs)
+
+    # randomly select d dimension
+    embedding_vectors = embedding_vectors[:, idx, :, :]
+
+    # reshape 2d pixels to 1d features
+    B, C, H, W = embedding_vectors.shape
+    embedding_vectors = embedding_vectors.reshape(B, C, H * W)
+
+    return embedding_vectors
+
+
+def training_statistics(
+        net, params, size, keep_aspect, batch_size, train_dir, aug, aug_num, seed, logger,
+        stats=None):
+    """
+    Absorb the train images (or the video frames) into stats.
+    If stats is None, a new accumulator is created.
+    """
+    if stats is None:
+        # set seed
+        random.seed(seed)
+        idx = random.sample(range(0, params["t_d"]), params["d"])
+        stats = PadimStatistics(idx)
+    idx = stats.idx
 
     if os.path.isdir(train_dir):
         train_imgs = sorted([
@@ -187,9 +259,10 @@ def training(net, params, size, keep_aspect, batch_size, train_dir, aug, aug_num
         if len(train_imgs) == 0:
             logger.error("train images not found in '%s'" % train_dir)
             sys.exit(-1)
+        train_source = lambda: iter(train_imgs)
     else:
         logger.info("capture 200 frames from video")
-        train_imgs = capture_training_frames_from_video(train_dir)
+        train_source = lambda: capture_training_frames_from_video(train_dir)
 
     if not aug:
         logger.info('extract train set features without augmentation')
@@ -197,23 +270,29 @@ def training(net, params, size, keep_aspect, batch_size, train_dir, aug, aug_num
     else:
         logger.info('extract train set features with augmentation')
         aug_num = aug_num
-    mean = None
-    N = 0
+
+    def batches(source):
+        batch = []
+        for image_path in source:
+            batch.append(image_path)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     for i_aug in range(aug_num):
-        for i_img in range(0, len(train_imgs), batch_size):
+        i_img = 0
+        for batch in batches(train_source()):
             # prepare input data
             imgs = []
             if not aug:
                 logger.info('from (%s ~ %s) ' %
-                            (i_img,
-                             min(len(train_imgs) - 1,
-                                            i_img + batch_size)))
+                            (i_img, i_img + len(batch) - 1))
             else:
                 logger.info('from (%s ~ %s) on augmentation lap %d' %
-                            (i_img,
-                             min(len(train_imgs) - 1,
-                                            i_img + batch_size), i_aug))
-            for image_path in train_imgs[i_img:i_img + batch_size]:
+                            (i_img, i_img + len(batch) - 1, i_aug))
+            for image_path in batch:
                 if type(image_path) is str:
                     img = load_image(image_path)
                     img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
@@ -224,98 +303,133 @@ def training(net, params, size, keep_aspect, batch_size, train_dir, aug, aug_num
                 else:
                     img = preprocess_aug(img, size, keep_aspect=keep_aspect)
                 imgs.append(img)
-
-            # countup N
-            N += len(imgs)
+            i_img += len(batch)
 
             imgs = np.vstack(imgs)
 
             logger.debug(f'input images shape: {imgs.shape}')
-            net.set_input_shape(imgs.shape)
 
-            # inference
-            _ = net.predict(imgs)
+            embedding_vectors = extract_embedding_vectors(net, params, imgs, idx)
 
-            train_outputs = OrderedDict([
-                ('layer1', []), ('layer2', []), ('layer3', [])
-            ])
-            for key, name in zip(train_outputs.keys(), params["feat_names"]):
-                train_outputs[key].append(net.get_blob_data(name))
-            for k, v in train_outputs.items():
-                train_outputs[k] = v[0]
+            # calculate multivariate Gaussian distribution
+            # (update mean and covariance matrix for all pixels at once)
+            stats.update(embedding_vectors)
 
-            embedding_vectors = postprocess(train_outputs)
+    return stats
 
-            # randomly select d dimension
-            embedding_vectors = embedding_vectors[:, idx, :, :]
 
-            # reshape 2d pixels to 1d features
-            B, C, H, W = embedding_vectors.shape
-            embedding_vectors = embedding_vectors.reshape(B, C, H * W)
+def training(net, params, size, keep_aspect, batch_size, train_dir, aug, aug_num, seed, logger):
+    stats = training_statistics(
+        net, params, size, keep_aspect, batch_size, train_dir, aug, aug_num, seed, logger)
+    train_outputs = stats.train_outputs()
+    return train_outputs
 
-            # initialize mean and covariance matrix
-            if (mean is None):
-                mean = np.zeros((C, H * W), dtype=np.float32)
-                cov = np.zeros((C, C, H * W), dtype=np.float32)
 
-            # calculate multivariate Gaussian distribution
-            # (add up mean and covariance matrix)
-            mean += np.sum(embedding_vectors, axis=0)
-            for i in range(H * W):
-                # https://github.com/numpy/numpy/blob/v1.21.0/numpy/lib/function_base.py#L2324-L2543
-                m = embedding_vectors[:, :, i]
-                m = m - (mean[:, [i]].T / N)
-                cov[:, :, i] += m.T @ m
-
-    # devide mean by N
-    mean = mean / N
-    # devide covariance by N-1, and calculate inverse
-    I = np.identity(C)
-    for i in range(H * W):
-        cov[:, :, i] = (cov[:, :, i] / (N - 1)) + 0.01 * I
-
-    cov_inv = np.zeros(cov.shape)
-    for i in range(H * W):
-        cov_inv[:, :, i] = np.linalg.inv(cov[:, :, i])
-    
-    train_outputs = [mean, cov, cov_inv, idx]
+def save_train_outputs(train_feat_file, train_outputs, stats=None):
+    """
+    Save the learned distribution.
+
+    If train_feat_file ends with '.pkl', the list is pickled (legacy format).
+    Otherwise train_feat_file is a directory of .npy files which can be
+    memory-mapped by load_train_outputs. When stats is given, its state is
+    also saved so that new images can be absorbed later.
+    """
+    if train_feat_file.endswith('.pkl'):
+        with open(train_feat_file, 'wb') as f:
+            pickle.dump(train_outputs, f)
+        return
+
+    mean, _, cov_inv, idx = train_outputs
+    os.makedirs(train_feat_file, exist_ok=True)
+    np.save(os.path.join(train_feat_file, 'mean.npy'), mean)
+    np.save(os.path.join(train_feat_file, 'cov_inv.npy'), cov_inv)
+    np.save(os.path.join(train_feat_file, 'idx.npy'), np.asarray(idx))
+    if stats is not None:
+        np.save(os.path.join(train_feat_file, 'stats_n.npy'), np.asarray(stats.n))
+        np.save(os.path.join(train_feat_file, 'stats_mean.npy'), stats.mean)
+        np.save(os.path.join(train_feat_file, 'stats_m2.npy'), stats.m2)
+
+
+def load_train_outputs(train_feat_file):
+    """
+    Load the learned distribution saved by save_train_outputs.
+
+    For the directory format, cov_inv is memory-mapped read only, so the
+    model is available immediately and the pages are shared between
+    processes. The covariance itself is not needed for inference and is
+    returned as None.
+    """
+    if train_feat_file.endswith('.pkl'):
+        with open(train_feat_file, 'rb') as f:
+            train_outputs = pickle.load(f)
+        return train_outputs
+
+    mean = np.load(os.path.join(train_feat_file, 'mean.npy'))
+    cov_inv = np.load(os.path.join(train_feat_file, 'cov_inv.npy'), mmap_mode='r')
+    idx = np.load(os.path.join(train_feat_file, 'idx.npy'))
+    train_outputs = [mean, None, cov_inv, idx]
     return train_outputs
 
+
+def load_statistics(train_feat_file):
+    """
+    Load the accumulator state saved by save_train_outputs to continue training.
+    """
+    path = os.path.join(train_feat_file, 'stats_n.npy')
+    if train_feat_file.endswith('.pkl') or not os.path.exists(path):
+        raise ValueError("accumulator state not found in '%s'" % train_feat_file)
+
+    n = int(np.load(path))
+    mean = np.load(os.path.join(train_feat_file, 'stats_mean.npy'))
+    m2 = np.load(os.path.join(train_feat_file, 'stats_m2.npy'))
+    idx = np.load(os.path.join(train_feat_file, 'idx.npy'))
+    stats = PadimStatistics(idx, n, mean, m2)
+    return stats
+
+
+def inverse_covariance(cov, block=64):
+    """
+    Invert the per pixel covariance matrices (C, C, H * W) by batched calls
+    over blocks of pixels. Only one block is converted to float64 at a
+    time, and the inverse is stored as float32.
+    """
+    C, _, HW = cov.shape
+    cov_inv = np.empty((C, C, HW), dtype=np.float32)
+    for i in range(0, HW, block):
+        cov_block = np.asarray(cov[:, :, i:i + block], dtype=np.float64)
+        cov_inv[:, :, i:i + block] = np.linalg.inv(
+            cov_block.transpose(2, 0, 1)).transpose(1, 2, 0)
+    return cov_inv
+
+
+def mahalanobis_distance(embedding_vectors, mean, cov_inv):
+    """
+    Batched Mahalanobis distance for all samples and pixels.
+
+    embedding_vectors: (B, C, H * W)
+    mean: (C, H * W)
+    cov_inv: (C, C, H * W)
+    returns: (B, H * W)
+    """
+    delta = (embedding_vectors - mean[np.newaxis]).astype(np.float32, copy=False)
+    dist = np.einsum('bci,cdi,bdi->bi', delta, cov_inv, delta)
+    dist = np.sqrt(np.maximum(dist, 0))
+    return dist
+
+
 def infer(net, params, train_outputs, img):
     # prepare input data
     imgs = []
     imgs.append(img)
     imgs = np.vstack(imgs)
 
-    # inference
-    net.set_input_shape(imgs.shape)
-    _ = net.predict(imgs)
-
-    test_outputs = OrderedDict([
-        ('layer1', []), ('layer2', []), ('layer3', [])
-    ])
-    for key, name in zip(test_outputs.keys(), params["feat_names"]):
-        test_outputs[key].append(net.get_blob_data(name))
-    for k, v in test_outputs.items():
-        test_outputs[k] = v[0]
-
-    embedding_vectors = postprocess(test_outputs)
-
-    # randomly select d dimension
     idx = train_outputs[3]
-    embedding_vectors = embedding_vectors[:, idx, :, :]
-
-    # reshape 2d pixels to 1d features
-    B, C, H, W = embedding_vectors.shape
-    embedding_vectors = embedding_vectors.reshape(B, C, H * W)
+    embedding_vectors = extract_embedding_vectors(net, params, imgs, idx)
+    H = W = int(np.sqrt(embedding_vectors.shape[2]))
 
     # calculate distance matrix
-    dist_tmp = np.zeros([B, (H * W)])
-    for i in range(H * W):
-        mean = train_outputs[0][:, i]
-        conv_inv = train_outputs[2][:, :, i] # calculate inverse on training phase (np.linalg.inv(train_outputs[1][:, :, i]))
-        dist = [mahalanobis(sample[:, i], mean, conv_inv) for sample in embedding_vectors]
-        dist_tmp[:, i] = dist
+    # (inverse covariance is calculated on training phase)
+    dist_tmp = mahalanobis_distance(embedding_vectors, train_outputs[0], train_outputs[2])
 
     # upsample
     dist_tmp = dist_tmp.reshape(H, W)
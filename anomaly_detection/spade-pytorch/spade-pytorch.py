@@ -28,6 +28,9 @@ from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 from image_utils import normalize_image  # noqa: E402
 from detector_utils import load_image  # noqa: E402
+
+from spade_utils import MAX_MEMORY, knn, knn_torch, to_channels_last  # noqa: E402
+from spade_utils import FeatureStoreWriter, load_feature_store  # noqa: E402
 # logger
 from logging import getLogger  # noqa: E402
 
@@ -52,8 +55,8 @@ IMAGE_SIZE = 224
 
 parser = get_base_parser('SPADE', IMAGE_PATH, SAVE_IMAGE_PATH)
 parser.add_argument(
-    '-f', '--feat', metavar="PICKLE_FILE", default=None,
-    help='train set feature pkl files.'
+    '-f', '--feat', metavar="DIR", default=None,
+    help='directory of the train set features (or train set feature pkl file).'
 )
 parser.add_argument(
     '-bs', '--batch_size', default=32,
@@ -83,6 +86,10 @@ parser.add_argument(
     '-an', '--aug_num', type=int, default=5,
     help='specify the amplification number of augmentation.'
 )
+parser.add_argument(
+    '--max_memory', type=float, default=MAX_MEMORY,
+    help='memory ceiling (MB) of the distance computation blocks.'
+)
 args = update_parser(parser)
 
 
@@ -90,15 +97,6 @@ args = update_parser(parser)
 # Secondaty Functions
 # ======================
 
-def calc_dist_matrix(x, y):
-    """Calculate Euclidean distance matrix with torch.tensor"""
-    dist_matrix = x[:, None] - y[None, :]
-    dist_matrix = np.sum(np.power(dist_matrix, 2), axis=2)
-    dist_matrix = np.sqrt(dist_matrix)
-
-    return dist_matrix
-
-
 def plot_fig(
         file_list, test_imgs,
         score_map,
@@ -224,10 +222,17 @@ def preprocess_aug(img, mask=False, angle_range=[-10, 10], return_refs=False):
 
 
 def get_train_outputs(net):
+    """
+    Returns the train set features as channels last arrays,
+    memory-mapped from the feature directory.
+    """
     if args.feat:
         logger.info('loading train set feature from: %s' % args.feat)
-        with open(args.feat, 'rb') as f:
-            train_outputs = pickle.load(f)
+        if os.path.isdir(args.feat):
+            train_outputs = load_feature_store(args.feat)
+        else:
+            with open(args.feat, 'rb') as f:
+                train_outputs = to_channels_last(pickle.load(f))
         logger.info('loaded.')
         return train_outputs
 
@@ -249,10 +254,9 @@ def get_train_outputs(net):
         logger.info('extract train set features with augmentation')
         aug_num = args.aug_num
 
-    train_outputs = OrderedDict([
-        ('layer1', []), ('layer2', []), ('layer3', []),
-        ('avgpool', []),
-    ])
+    # the features are written to the memory-mapped files batch by batch
+    train_feat_dir = "%s_feat" % os.path.basename(os.path.normpath(train_dir))
+    writer = FeatureStoreWriter(train_feat_dir, len(train_imgs) * aug_num)
     for i_aug in range(aug_num):
         for i_img in range(0, len(train_imgs), batch_size):
             # prepare input data
@@ -285,21 +289,16 @@ def get_train_outputs(net):
             _ = net.predict(imgs)
 
             feat_names = ("356", "398", "460", "493")
-            for key, name in zip(train_outputs.keys(), feat_names):
-                x = net.get_blob_data(name)
-                train_outputs[key].append(x)
-
-    for k, v in train_outputs.items():
-        train_outputs[k] = np.vstack(v)
+            writer.append({
+                key: net.get_blob_data(name)
+                for key, name in zip(
+                    ('layer1', 'layer2', 'layer3', 'avgpool'), feat_names)
+            })
 
-    # save learned distribution
-    train_feat_file = "%s.pkl" % os.path.basename(train_dir)
-    logger.info('saving train set feature to: %s ...' % train_feat_file)
-    with open(train_feat_file, 'wb') as f:
-        pickle.dump(train_outputs, f)
-    logger.info('saved.')
+    writer.close()
+    logger.info('saved train set feature to: %s' % train_feat_dir)
 
-    return train_outputs
+    return load_feature_store(train_feat_dir)
 
 
 def recognize_from_image(net):
@@ -402,15 +401,11 @@ def recognize_from_image(net):
         for k, v in test_outputs.items():
             test_outputs[k] = np.vstack(v)
 
-        # calculate distance matrix
-        dist_matrix = calc_dist_matrix(
-            test_outputs['avgpool'].reshape(test_outputs['avgpool'].shape[0], -1),
-            train_outputs['avgpool'].reshape(train_outputs['avgpool'].shape[0], -1))
-
         # select K nearest neighbor
         top_k = 5
-        topk_indexes = np.argsort(dist_matrix, axis=1)
-        topk_indexes = topk_indexes[:, :top_k]
+        _, topk_indexes = knn(
+            test_outputs['avgpool'].reshape(test_outputs['avgpool'].shape[0], -1),
+            train_outputs['avgpool'], k=top_k, max_memory=args.max_memory)
 
         n = test_outputs['avgpool'].shape[0]
         for t_idx in range(n):
@@ -420,32 +415,23 @@ def recognize_from_image(net):
             score_maps = []
             for layer_name in ['layer1', 'layer2', 'layer3']:  # for each layer
                 # construct a gallery of features at all pixel locations of the K nearest neighbors
-                topk_feat_map = train_outputs[layer_name][topk_indexes[t_idx]]
-                test_feat_map = test_outputs[layer_name][t_idx:t_idx + 1]
+                topk_feat_map = train_outputs[layer_name][np.sort(topk_indexes[t_idx])]
+                c = topk_feat_map.shape[-1]
+                feat_gallery = topk_feat_map.reshape(-1, c)
 
-                feat_gallery = topk_feat_map.transpose(0, 3, 2, 1)
-                feat_gallery = feat_gallery.reshape(-1, feat_gallery.shape[-1])
-                feat_gallery = feat_gallery[:, :, None, None]
+                test_feat_map = test_outputs[layer_name][t_idx]
+                h, w = test_feat_map.shape[1:]
+                test_feat = test_feat_map.reshape(c, -1).T
 
-                # calculate distance matrix
-                dist_matrix_list = []
+                # distance to the nearest pixel of the gallery, the root mean
+                # squared difference over the channels
                 if use_pytorch and torch.cuda.is_available():
-                    feat_gallery = torch.tensor(feat_gallery, device='cuda')
-                    test_feat_map = torch.tensor(test_feat_map, device='cuda')
-                    for d_idx in range(feat_gallery.shape[0] // 100):
-                        dist_matrix = torch.pow(torch.mean(torch.pow(
-                            feat_gallery[d_idx * 100:d_idx * 100 + 100] - test_feat_map, 2), 1),
-                            0.5)
-                        dist_matrix_list.append(dist_matrix.cpu().detach().numpy())
+                    score_map, _ = knn_torch(
+                        test_feat, feat_gallery, k=1, max_memory=args.max_memory)
                 else:
-                    for d_idx in range(feat_gallery.shape[0] // 100):
-                        dist_matrix = np.power(feat_gallery[d_idx * 100:d_idx * 100 + 100] - test_feat_map, 2)
-                        dist_matrix = np.mean(dist_matrix, axis=1)
-                        dist_matrix = np.sqrt(dist_matrix)
-                        dist_matrix_list.append(dist_matrix)
-
-                dist_matrix = np.vstack(dist_matrix_list)
-                score_map = np.min(dist_matrix, axis=0)
+                    score_map, _ = knn(
+                        test_feat, feat_gallery, k=1, max_memory=args.max_memory)
+                score_map = np.sqrt(score_map / c).reshape(h, w).astype(np.float32)
                 score_map = np.asarray(
                     Image.fromarray(score_map).resize(
                         (IMAGE_SIZE, IMAGE_SIZE), resample=Image.BILINEAR))
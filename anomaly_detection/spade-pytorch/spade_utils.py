@@ -0,0 +1,198 @@
+import os
+
+import numpy as np
+
+# default memory ceiling of the distance computation (MB)
+MAX_MEMORY = 256
+
+LAYER_NAMES = ('layer1', 'layer2', 'layer3', 'avgpool')
+
+
+# ======================
+# Blocked kNN
+# ======================
+
+def block_sizes(n_query, n_gallery, dim, max_memory=MAX_MEMORY):
+    """
+    Number of gallery and query rows processed at once, so that the
+    float32 blocks of gallery rows, query rows and distances fit in
+    max_memory (MB).
+    """
+    budget = int(max_memory * 1024 * 1024) // 4  # float32 elements
+
+    # half of the budget for the gallery rows
+    block_g = max(1, min(n_gallery, budget // 2 // dim))
+    # the other half for the query rows and the distance block
+    block_q = max(1, min(n_query, budget // 2 // (block_g + dim)))
+    return block_q, block_g
+
+
+def knn(queries, gallery, k=1, max_memory=MAX_MEMORY):
+    """
+    k nearest gallery rows of each query row by Euclidean distance.
+
+    The squared distances are computed by blocks as
+    |q|^2 + |g|^2 - 2 q.g with float32 matrix products, so that no
+    (n_query, n_gallery, dim) tensor is created. The gallery (which may be
+    a memory-mapped array) is read only once, block by block.
+
+    queries: (n_query, dim)
+    gallery: (n_gallery, dim)
+    returns: the squared distances (n_query, k) in increasing order and
+        the gallery indices (n_query, k)
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    n_query, dim = queries.shape
+    n_gallery = gallery.shape[0]
+    k = min(k, n_gallery)
+
+    block_q, block_g = block_sizes(n_query, n_gallery, dim, max_memory)
+    query_sq = np.einsum('ij,ij->i', queries, queries)
+
+    best_d = np.full((n_query, k), np.inf, dtype=np.float32)
+    best_i = np.zeros((n_query, k), dtype=np.int64)
+    for g0 in range(0, n_gallery, block_g):
+        g = np.ascontiguousarray(gallery[g0:g0 + block_g], dtype=np.float32)
+        g_sq = np.einsum('ij,ij->i', g, g)
+        g_idx = np.arange(g0, g0 + len(g))
+
+        for q0 in range(0, n_query, block_q):
+            q1 = min(q0 + block_q, n_query)
+            d = queries[q0:q1] @ g.T
+            d *= -2
+            d += query_sq[q0:q1, None]
+            d += g_sq[None, :]
+
+            if k == 1:
+                idx = np.argmin(d, axis=1)
+                v = d[np.arange(len(d)), idx]
+                better = v < best_d[q0:q1, 0]
+                best_d[q0:q1, 0][better] = v[better]
+                best_i[q0:q1, 0][better] = g_idx[idx[better]]
+            else:
+                # merge the running k best with the block
+                cand_d = np.concatenate([best_d[q0:q1], d], axis=1)
+                cand_i = np.concatenate([
+                    best_i[q0:q1],
+                    np.broadcast_to(g_idx, d.shape)], axis=1)
+                part = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+                best_d[q0:q1] = np.take_along_axis(cand_d, part, axis=1)
+                best_i[q0:q1] = np.take_along_axis(cand_i, part, axis=1)
+
+    order = np.argsort(best_d, axis=1, kind='stable')
+    best_d = np.take_along_axis(best_d, order, axis=1)
+    best_i = np.take_along_axis(best_i, order, axis=1)
+
+    # the expanded form can be slightly negative by rounding
+    np.maximum(best_d, 0, out=best_d)
+
+    return best_d, best_i
+
+
+def knn_torch(queries, gallery, k=1, max_memory=MAX_MEMORY, device='cuda'):
+    """
+    knn() with the blocks computed by PyTorch on device (e.g. a GPU).
+
+    The blocks are the same as knn(), so the device memory of the distance
+    computation is also bounded by max_memory (MB). Only the gallery block
+    being processed is copied to the device.
+    """
+    import torch
+
+    queries = torch.as_tensor(
+        np.ascontiguousarray(queries, dtype=np.float32), device=device)
+    n_query, dim = queries.shape
+    n_gallery = gallery.shape[0]
+    k = min(k, n_gallery)
+
+    block_q, block_g = block_sizes(n_query, n_gallery, dim, max_memory)
+    query_sq = torch.sum(queries * queries, dim=1)
+
+    best_d = torch.full((n_query, k), float('inf'), device=device)
+    best_i = torch.zeros((n_query, k), dtype=torch.int64, device=device)
+    for g0 in range(0, n_gallery, block_g):
+        g = torch.as_tensor(
+            np.ascontiguousarray(gallery[g0:g0 + block_g], dtype=np.float32),
+            device=device)
+        g_sq = torch.sum(g * g, dim=1)
+        g_idx = torch.arange(g0, g0 + len(g), device=device)
+
+        for q0 in range(0, n_query, block_q):
+            q1 = min(q0 + block_q, n_query)
+            d = torch.addmm(g_sq[None, :], queries[q0:q1], g.T, alpha=-2)
+            d += query_sq[q0:q1, None]
+
+            # merge the running k best with the block
+            cand_d = torch.cat([best_d[q0:q1], d], dim=1)
+            cand_i = torch.cat([best_i[q0:q1], g_idx.expand(d.shape)], dim=1)
+            v, part = torch.topk(cand_d, k, dim=1, largest=False, sorted=False)
+            best_d[q0:q1] = v
+            best_i[q0:q1] = torch.gather(cand_i, 1, part)
+
+    best_d, order = torch.sort(best_d, dim=1, stable=True)
+    best_i = torch.gather(best_i, 1, order)
+
+    # the expanded form can be slightly negative by rounding
+    best_d = torch.clamp(best_d, min=0)
+
+    return best_d.cpu().numpy(), best_i.cpu().numpy()
+
+
+# ======================
+# Train features store
+# ======================
+
+def to_channels_last(outputs):
+    """
+    Feature maps (n, C, H, W) -> (n, H, W, C) and avgpool (n, C, 1, 1) ->
+    (n, C), so that the pixels of a feature map are contiguous rows.
+    """
+    return {
+        'avgpool': outputs['avgpool'].reshape(outputs['avgpool'].shape[0], -1),
+        **{
+            name: np.ascontiguousarray(outputs[name].transpose(0, 2, 3, 1))
+            for name in LAYER_NAMES[:3]
+        }
+    }
+
+
+class FeatureStoreWriter:
+    """
+    Write the train features batch by batch to one .npy file by layer in
+    the directory path, without keeping them in memory.
+    """
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+        self.arrays = None
+        self.n = 0
+
+    def append(self, outputs):
+        outputs = to_channels_last(outputs)
+        if self.arrays is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.arrays = {
+                name: np.lib.format.open_memmap(
+                    os.path.join(self.path, name + '.npy'), mode='w+',
+                    dtype=np.float32,
+                    shape=(self.count,) + outputs[name].shape[1:])
+                for name in LAYER_NAMES
+            }
+        n = len(outputs['avgpool'])
+        for name in LAYER_NAMES:
+            self.arrays[name][self.n:self.n + n] = outputs[name]
+        self.n += n
+
+    def close(self):
+        for a in self.arrays.values():
+            a.flush()
+        self.arrays = None
+
+
+def load_feature_store(path):
+    """Memory-map the train features saved by FeatureStoreWriter"""
+    return {
+        name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        for name in LAYER_NAMES
+    }
@@ -1,6 +1,7 @@
 import time
 import sys
 import argparse
+import re
 
 import numpy as np
 
@@ -32,6 +33,12 @@ REMOTE_PATH_SSRM = 'https://storage.googleapis.com/ailia-models/pytorch-dc-tts/'
 
 MAX_T = 210
 
+# fixed shape mode: the time axis of the text2mel input grows by this number of steps
+T2M_BUCKET = 32
+
+VOCAB = "PE abcdefghijklmnopqrstuvwxyz'.?"  # P: Padding, E: EOS.
+EOS = VOCAB.index('E')
+
 # ======================
 # Arguemnt Parser Config
 # ======================
@@ -47,12 +54,25 @@ parser.add_argument(
     '--ailia_audio', action='store_true',
     help='use ailia audio library'
 )
+parser.add_argument(
+    '--fixed_shape', action='store_true',
+    help='run text2mel at preallocated shapes, reshaped every ' + str(T2M_BUCKET) +
+         ' steps instead of every step'
+)
+parser.add_argument(
+    '--split_sentences', action='store_true',
+    help='split the input text into sentences, synthesized in one batch (implies --fixed_shape)'
+)
+parser.add_argument(
+    '--check_fixed_shape', action='store_true',
+    help='check that text2mel at fixed shapes gives the mel frames of the step by step text2mel'
+)
 args = update_parser(parser, check_input_type=False)
 
 if args.ailia_audio:
-    from pytorch_dc_tts_utils_ailia import get_test_data, save_to_wav
+    from pytorch_dc_tts_utils_ailia import get_test_data, save_to_wav, save_sentences_to_wav
 else:
-    from pytorch_dc_tts_utils import get_test_data, save_to_wav
+    from pytorch_dc_tts_utils import get_test_data, save_to_wav, save_sentences_to_wav
 
 # ======================
 # Main function
@@ -90,29 +110,131 @@ def inference_by_ssr(net_ssrm, Y):
     return Z
 
 
+def inference_by_text2mel_fixed(net_t2m, L):
+    """
+    Text2Mel of a batch of sentences at preallocated shapes.
+
+    The mel frames are written in place to one (n, 80, MAX_T + 1) buffer,
+    of which the network gets the first frames by buckets of T2M_BUCKET
+    steps, so that it is reshaped once per bucket instead of every step.
+    The frames after the current step are zeros, which do not change the
+    current frame as the audio encoder and decoder are causal.
+    Each sentence ends at its own EOS (a sentence without EOS runs for
+    MAX_T steps), and the finished sentences are removed from the batch at
+    the next reshape.
+
+    Returns the mel frames and the number of frames of each sentence.
+    """
+    n = L.shape[0]
+    Y = np.zeros((n, 80, MAX_T + 1), np.float32)
+    lengths = np.full(n, MAX_T + 1)
+    done = np.zeros(n, bool)
+    active = np.arange(n)
+    width = 0
+
+    for t in range(MAX_T):
+        if t + 1 > width:
+            # the unfinished sentences, with the next bucket of steps
+            active = active[~done[active]]
+            width = min((t // T2M_BUCKET + 1) * T2M_BUCKET, MAX_T + 1)
+            L_active = L[active]
+            net_t2m.set_input_blob_shape(L_active.shape, net_t2m.find_blob_index_by_name('input.1'))
+            net_t2m.set_input_blob_shape((len(active), 80, width), net_t2m.find_blob_index_by_name('input.2'))
+
+        _, Y_t, A = net_t2m.predict({'input.1':L_active, 'input.2':Y[active, :, :width]})
+        Y[active, :, t + 1] = Y_t[:, :, t]
+
+        attention = np.argmax(A[:, :, t], 1)
+        eos = (L_active[np.arange(len(active)), attention] == EOS) & ~done[active]
+        done[active[eos]] = True
+        lengths[active[eos]] = t + 2
+        if np.all(done):
+            break
+
+    return Y, lengths
+
+
+def inference_by_ssr_batch(net_ssrm, Y, lengths):
+    # zeros after the end of each sentence, and SSRN of the longest one
+    Y = Y[:, :, :np.max(lengths)] * (np.arange(np.max(lengths)) < lengths[:, None, None])
+    Z = inference_by_ssr(net_ssrm, Y)
+    scale = Z.shape[2] // Y.shape[2]
+    return [z[:, :scale * n].T for z, n in zip(Z, lengths)]
+
+
+def synthesize(net_t2m, net_ssrm, sentences):
+    """
+    Synthesize the sentences in one batch.
+    Returns the linear spectrogram (T, 1+n_fft//2) of each sentence.
+    """
+    L = get_test_data(sentences, max(len(x) for x in sentences))
+    Y, lengths = inference_by_text2mel_fixed(net_t2m, L)
+    return inference_by_ssr_batch(net_ssrm, Y, lengths)
+
+
+def check_fixed_shape(net_t2m, sentence):
+    """
+    Compare the mel frames of text2mel at fixed shapes with the ones of the
+    step by step text2mel on one sentence.
+    """
+    L, Y, zeros, A = preprocess(sentence)
+    Y_step = inference_by_text2mel(net_t2m, L, Y, zeros, A)
+    Y_fixed, lengths = inference_by_text2mel_fixed(net_t2m, L)
+    Y_fixed = Y_fixed[:, :, :lengths[0]]
+
+    if Y_fixed.shape != Y_step.shape:
+        logger.error(f'fixed shape: {Y_fixed.shape[2]} frames, step by step: {Y_step.shape[2]} frames')
+        return False
+    diff = np.max(np.abs(Y_fixed - Y_step))
+    logger.info(f'fixed shape: {lengths[0]} frames, max difference {diff}')
+    return diff < 1e-4
+
+
+def split_sentences(text):
+    return [x for x in re.split(r'(?<=[.?!])\s+', text.strip()) if x]
+
+
 def generate_sentence(sentence):
+    fixed_shape = args.fixed_shape or args.split_sentences
+    sentences = split_sentences(sentence) if args.split_sentences else [sentence]
+
     # prepare data
-    L, Y, zeros, A = preprocess(sentence)
+    if not fixed_shape:
+        L, Y, zeros, A = preprocess(sentence)
 
     # model initialize
     net_t2m = ailia.Net(MODEL_PATH_T2M, WEIGHT_PATH_T2M, env_id=args.env_id)
     net_ssrm = ailia.Net(MODEL_PATH_SSRM, WEIGHT_PATH_SSRM, env_id=args.env_id)
 
+    if args.check_fixed_shape:
+        if not check_fixed_shape(net_t2m, sentences[0]):
+            logger.error('text2mel at fixed shapes differs from the step by step text2mel')
+            sys.exit(1)
+        logger.info('text2mel at fixed shapes matches the step by step text2mel')
+
+    def run():
+        if fixed_shape:
+            return synthesize(net_t2m, net_ssrm, sentences)
+        return inference(net_t2m, net_ssrm, L, Y, zeros, A)
+
     # inference
     logger.info('Start inference...')
     if args.benchmark:
         logger.info('BENCHMARK mode')
         for c in range(5):
             start = int(round(time.time() * 1000))
-            out = inference(net_t2m, net_ssrm, L, Y, zeros, A)
+            out = run()
             end = int(round(time.time() * 1000))
             logger.info("\tailia processing time {} ms".format(end-start))
     else:
-        out = inference(net_t2m, net_ssrm, L, Y, zeros, A)
+        out = run()
 
     savepath = args.savepath
     logger.info(f'saved at : {savepath}')
-    save_to_wav(out, savepath)
+    if fixed_shape:
+        save_sentences_to_wav(out, savepath)
+    else:
+        save_to_wav(out, savepath)
 
     logger.info('Script finished successfully.')
 
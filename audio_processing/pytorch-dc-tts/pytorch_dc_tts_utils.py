@@ -30,6 +30,15 @@ def save_to_wav(mag, filename):
     scipy.io.wavfile.write(filename, hp.sr, wav)
 
 
+def save_sentences_to_wav(mags, filename, pause=0.25):
+    """Generate the audio of each sentence, and save them joined by pauses of `pause` seconds."""
+    silence = np.zeros(int(pause * hp.sr), np.float32)
+    wavs = []
+    for mag in mags:
+        wavs += [spectrogram2wav(mag), silence]
+    scipy.io.wavfile.write(filename, hp.sr, np.concatenate(wavs[:-1]))
+
+
 def spectrogram2wav(mag):
     '''# Generate wave file from linear magnitude spectrogram
     Args:
@@ -1,6 +1,7 @@
 import time
 import sys
 import argparse
+import threading
 
 import numpy as np
 
@@ -10,7 +11,7 @@ import soundfile as sf
 
 # import original modules
 sys.path.append('../../util')
-from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
+from utils import get_base_parser, update_parser, get_savepath, prefetch_batches  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 
 # logger
@@ -56,6 +57,15 @@ parser.add_argument(
     '--ailia_audio', action='store_true',
     help='use ailia audio library'
 )
+parser.add_argument(
+    '--chunk_sec', type=float, default=0,
+    help='separate the audio by chunks of this length (seconds), joined by overlap-add, '
+         'so that the memory does not grow with the audio length (0: whole audio at once)'
+)
+parser.add_argument(
+    '--overlap_sec', type=float, default=1.0,
+    help='overlap between two chunks (seconds), crossfaded'
+)
 args = update_parser(parser)
 
 if args.ailia_audio:
@@ -115,7 +125,69 @@ def src_sep(data, session) :
     return sep
 
 
-def recognize_one_audio(input_path):
+def chunk_length(chunk_sec):
+    """Chunk length in samples, giving a number of STFT frames multiple of MULT"""
+    n_frames = max(1, int(round(chunk_sec * DESIRED_SR / HOP_LEN / MULT))) * MULT
+    return (n_frames - 1) * HOP_LEN
+
+
+def crossfade(n, overlap, first, last):
+    """Weights of a chunk, the fades of two overlapping chunks summing to 1"""
+    w = np.ones(n, dtype=np.float32)
+    ramp = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+    if not first:
+        w[:overlap] = ramp
+    if not last:
+        w[n - overlap:] = ramp[::-1]
+    return w
+
+
+def src_sep_chunked(wav, session):
+    """
+    Separate the audio by fixed-length chunks, so that the size of the
+    STFT features and of the network activations does not depend on the
+    audio length. The separated chunks are crossfaded over their overlap.
+    With args.workers, the chunks are converted (and inferred with
+    onnxruntime) by a thread pool.
+    """
+    n = chunk_length(args.chunk_sec)
+    overlap = max(1, min(int(args.overlap_sec * DESIRED_SR), n // 2))
+    length = wav.shape[1]
+    starts = list(range(0, max(length - overlap, 1), n - overlap))
+
+    # an ailia.Net is not run by several threads at once
+    lock = threading.Lock()
+
+    def run(start):
+        chunk = wav[:, start:start + n]
+        if chunk.shape[1] < n:
+            # same input shape for all the chunks
+            chunk = np.pad(chunk, ((0, 0), (0, n - chunk.shape[1])))
+        input_feature = tfconvert(chunk, WINDOW_LEN, HOP_LEN, MULT)
+        if args.onnx:
+            return src_sep(input_feature, session)
+        with lock:
+            return src_sep(input_feature, session)
+
+    out = np.zeros(wav.shape, dtype=np.float32)
+    for i, (_, sep) in enumerate(prefetch_batches(starts, run, 1, args.workers)):
+        start = starts[i]
+        m = min(n, length - start)
+        w = crossfade(n, overlap, i == 0, i == len(starts) - 1)
+        out[:, start:start + m] += sep[0][:, :m] * w[:m]
+
+    return out
+
+
+def separate(wav, session):
+    if args.chunk_sec > 0:
+        return src_sep_chunked(wav, session)
+
+    input_feature = tfconvert(wav, WINDOW_LEN, HOP_LEN, MULT)
+    return src_sep(input_feature, session)
+
+
+def recognize_one_audio(input_path, session):
     # load audio
     logger.info('Loading wavfile...')
     wav, sr = sf.read(input_path)
@@ -145,31 +217,17 @@ def recognize_one_audio(input_path):
     logger.info('Generating input feature...')
     wav = preemphasis(wav)
 
-    input_feature = tfconvert(wav, WINDOW_LEN, HOP_LEN, MULT)
-
-    # create instance
-    if not args.onnx :
-        logger.info('Use ailia')
-        env_id = args.env_id
-        logger.info(f'env_id: {env_id}')
-        memory_mode = ailia.get_memory_mode(reuse_interstage=True)
-        session = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=env_id, memory_mode=memory_mode)
-    else :
-        logger.info('Use onnxruntime')
-        import onnxruntime
-        session = onnxruntime.InferenceSession(WEIGHT_PATH)
-
     # inference
     logger.info('Start inference...')
     if args.benchmark:
         logger.info('BENCHMARK mode')
         for c in range(5) :
             start = int(round(time.time() * 1000))
-            sep = src_sep(input_feature, session)
+            sep = separate(wav, session)
             end = int(round(time.time() * 1000))
             logger.info("\tprocessing time {} ms".format(end-start))
     else:
-        sep = src_sep(input_feature, session)
+        sep = separate(wav, session)
 
     # postprocessing
     logger.info('Start postprocessing...')
@@ -186,15 +244,28 @@ def recognize_one_audio(input_path):
     sf.write(savepath, out_wav, DESIRED_SR)
     
     logger.info('Saved separated signal. ')
-    logger.info('Script finished successfully.')
 
 
 def main():
     # model files check and download
     check_and_download_models(WEIGHT_PATH, MODEL_PATH, REMOTE_PATH)
 
+    # create instance, shared by the input files
+    if not args.onnx :
+        logger.info('Use ailia')
+        env_id = args.env_id
+        logger.info(f'env_id: {env_id}')
+        memory_mode = ailia.get_memory_mode(reuse_interstage=True)
+        session = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=env_id, memory_mode=memory_mode)
+    else :
+        logger.info('Use onnxruntime')
+        import onnxruntime
+        session = onnxruntime.InferenceSession(WEIGHT_PATH)
+
     for input_file in args.input:
-        recognize_one_audio(input_file)
+        recognize_one_audio(input_file, session)
+
+    logger.info('Script finished successfully.')
 
 if __name__ == "__main__":
      main()
@@ -124,7 +124,7 @@ class AiliaTokenizer:
     def convert_tokens_to_string(self, tokens):
         """Converts a sequence of tokens (string) in a single string."""
         text = "".join(tokens)
-        text = bytearray([self.byte_decoder[c] for c in text]).decode("utf-8", errors="error")
+        text = bytearray([self.byte_decoder[c] for c in text]).decode("utf-8", errors="replace")
         return text
 
     def decode(self, tokens):
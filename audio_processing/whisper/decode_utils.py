@@ -1,9 +1,148 @@
+import time
+
 import numpy as np
 from scipy.special import log_softmax, logsumexp
 
 from math_utils import softmax
 
 
+class KVCacheArena:
+    """
+    Key/value cache of the decoder for one decode call,
+    of shape [n_layer * 2, n_batch, n_ctx, n_state].
+
+    With the fixed kv_cache models, the cache is allocated once with the
+    fixed length and given to each step with the offset of the new tokens.
+    The cache returned by the step replaces it, so that neither zeroing nor
+    copying of the past positions is done per step (the positions after the
+    offset are not attended by the model). With double_buffer, the step
+    writes the cache to a second buffer (onnxruntime I/O binding) and the
+    two buffers are swapped.
+    With the dynamic kv_cache models, the cache grows by one position per
+    step, as required by the model.
+
+    The beams are reordered by index: the row i of the tokens is stored in
+    the row perm[i] of the cache, and only the rows forked from another
+    beam are copied, up to the filled length. Rows are only reused inside
+    their group (the beams of one audio), since they share the audio
+    features.
+    """
+
+    def __init__(self, shape, group_size=1, fixed=True, double_buffer=False):
+        self.shape = tuple(shape)
+        self.group_size = group_size
+        self.fixed = fixed
+        self.length = 0
+        self.perm = np.arange(self.shape[1])
+
+        # profile
+        self.steps = 0
+        self.alloc_bytes = self.copy_bytes = 0
+        self.alloc_time = self.copy_time = 0.0
+
+        self.buffer = self.spare = None
+        if fixed:
+            self.buffer = self._alloc(self.shape)
+            if double_buffer:
+                self.spare = self._alloc(self.shape)
+
+    def _alloc(self, shape):
+        start = time.perf_counter()
+        buf = np.zeros(shape, dtype=np.float32)
+        self.alloc_time += time.perf_counter() - start
+        self.alloc_bytes += buf.nbytes
+        return buf
+
+    def input(self, n_tokens):
+        """The cache to give to the next step of n_tokens tokens"""
+        if self.fixed:
+            return self.buffer
+
+        # dynamic model: the input has the length of the output
+        shape = self.shape[:2] + (self.length + n_tokens,) + self.shape[3:]
+        buf = self._alloc(shape)
+        if self.length > 0:
+            start = time.perf_counter()
+            buf[:, :, :self.length] = self.buffer
+            self.copy_time += time.perf_counter() - start
+            self.copy_bytes += self.buffer.nbytes
+        return buf
+
+    def update(self, kv_cache, n_tokens):
+        """Take the cache returned by the step"""
+        if kv_cache is self.spare:
+            self.buffer, self.spare = self.spare, self.buffer
+        else:
+            self.buffer = kv_cache
+        self.length += n_tokens
+        self.steps += 1
+
+    def to_physical(self, x):
+        """Rows in token order -> rows in cache order"""
+        out = np.empty_like(x)
+        out[self.perm] = x
+        return out
+
+    def to_logical(self, x):
+        """Rows in cache order -> rows in token order"""
+        return x[self.perm]
+
+    def reorder(self, source_indices):
+        """The row i of the tokens now continues the row source_indices[i]"""
+        source = self.perm[np.asarray(source_indices, dtype=np.int64)]
+        n = len(source)
+        perm = np.full(n, -1, dtype=np.int64)
+
+        # the first beam continuing a row keeps it
+        _, first = np.unique(source, return_index=True)
+        perm[first] = source[first]
+
+        # the other ones get a copy in a row left free in their group
+        forked = np.nonzero(perm < 0)[0]
+        if len(forked) > 0:
+            used = np.zeros(n, dtype=bool)
+            used[source[first]] = True
+            free = np.nonzero(~used)[0]
+            free_group = free // self.group_size
+            dst = np.empty(len(forked), dtype=np.int64)
+            taken = np.zeros(len(free), dtype=bool)
+            for k, i in enumerate(forked):
+                j = np.nonzero(~taken & (free_group == source[i] // self.group_size))[0][0]
+                taken[j] = True
+                dst[k] = free[j]
+            perm[forked] = dst
+
+            start = time.perf_counter()
+            self.buffer[:, dst, :self.length] = self.buffer[:, source[forked], :self.length]
+            self.copy_time += time.perf_counter() - start
+            self.copy_bytes += self.buffer[:, :len(dst), :self.length].nbytes
+
+        self.perm = perm
+
+    def select(self, rows):
+        """Keep only the given rows (in token order), e.g. of the unfinished audios"""
+        physical = self.perm[np.asarray(rows, dtype=np.int64)]
+        self.shape = (self.shape[0], len(physical)) + self.shape[2:]
+        self.perm = np.arange(len(physical))
+
+        start = time.perf_counter()
+        self.buffer = np.ascontiguousarray(self.buffer[:, physical])
+        self.copy_time += time.perf_counter() - start
+        self.copy_bytes += self.buffer.nbytes
+        if self.spare is not None:
+            self.spare = self._alloc(self.shape)
+
+    def summary(self):
+        steps = max(self.steps, 1)
+        return (
+            f"kv_cache {self.shape} steps: {self.steps}, "
+            f"alloc: {self.alloc_bytes / 2**20:.1f} MB {self.alloc_time * 1000:.2f} ms "
+            f"({self.alloc_time * 1000 / steps:.3f} ms/step), "
+            f"copy: {self.copy_bytes / 2**20:.1f} MB {self.copy_time * 1000:.2f} ms "
+            f"({self.copy_time * 1000 / steps:.3f} ms/step)"
+        )
+
+
 class MaximumLikelihoodRanker:
     """
     Select the sample with the highest log probabilities, penalized using either
@@ -39,6 +178,14 @@ class GreedyDecoder:
     def reset(self):
         pass
 
+    def finished_rows(self, tokens):
+        """Rows whose sequence has ended with EOT"""
+        return tokens[:, -1] == self.eot
+
+    def select(self, rows):
+        """Keep only the given rows in the next updates"""
+        pass
+
     def update(self, tokens, logits, sum_logprobs, rearrange_kv_cache):
         temperature = self.temperature
         if temperature == 0:
@@ -72,11 +219,26 @@ class BeamSearchDecoder:
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
         self.finished_sequences = None
+        self.active = None  # audios of the rows in the batch
 
         assert self.max_candidates > 0, f"Invalid beam size ({beam_size}) or patience ({patience})"
 
     def reset(self):
         self.finished_sequences = None
+        self.active = None
+
+    def finished_rows(self, tokens):
+        """Rows of the audios which have enough finished sequences"""
+        if self.finished_sequences is None:
+            return np.zeros(tokens.shape[0], dtype=bool)
+        finished = [
+            len(self.finished_sequences[i]) >= self.max_candidates for i in self.active
+        ]
+        return np.repeat(finished, self.beam_size)
+
+    def select(self, rows):
+        """Keep only the given rows (all the beams of an audio) in the next updates"""
+        self.active = self.active[np.asarray(rows)[::self.beam_size] // self.beam_size]
 
     def update(self, tokens, logits, sum_logprobs, rearrange_kv_cache):
         if tokens.shape[0] % self.beam_size != 0:
@@ -85,6 +247,7 @@ class BeamSearchDecoder:
         n_audio = tokens.shape[0] // self.beam_size
         if self.finished_sequences is None:  # for the first update
             self.finished_sequences = [{} for _ in range(n_audio)]
+            self.active = np.arange(n_audio)
 
         logprobs = log_softmax(logits, axis=-1)
         next_tokens, source_indices, finished_sequences = [], [], []
@@ -125,8 +288,9 @@ class BeamSearchDecoder:
         rearrange_kv_cache(source_indices)
 
         # add newly finished sequences to self.finished_sequences
-        assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(self.finished_sequences, finished_sequences):
+        assert len(self.active) == len(finished_sequences)
+        for i, newly_finished in zip(self.active, finished_sequences):
+            previously_finished = self.finished_sequences[i]
             for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
                 if len(previously_finished) >= self.max_candidates:
                     break  # the candidate list is full
@@ -134,7 +298,7 @@ class BeamSearchDecoder:
 
         # mark as completed if all audio has enough number of samples
         completed = all(
-            len(sequences) >= self.max_candidates for sequences in self.finished_sequences
+            len(self.finished_sequences[i]) >= self.max_candidates for i in self.active
         )
         return tokens, completed
 
@@ -0,0 +1,187 @@
+import numpy as np
+
+from clip_utils import ClipBuffer
+
+# hard-coded audio hyperparameters, as in audio_utils
+SAMPLE_RATE = 16000
+N_FFT = 400
+N_MELS = 80
+HOP_LENGTH = 160
+N_FRAMES = 3000
+
+
+def mel_filter_bank(sr=SAMPLE_RATE, n_fft=N_FFT, n_mels=N_MELS):
+    """
+    The Slaney-style mel filterbank of librosa.filters.mel, in numpy only,
+    so that the streaming mode works with both audio_utils and
+    ailia_audio_utils.
+    """
+    f_sp = 200.0 / 3
+    min_log_hz = 1000.0
+    min_log_mel = min_log_hz / f_sp
+    logstep = np.log(6.4) / 27.0
+
+    def hz_to_mel(f):
+        f = np.asarray(f, dtype=np.float64)
+        return np.where(
+            f >= min_log_hz,
+            min_log_mel + np.log(np.maximum(f, min_log_hz) / min_log_hz) / logstep,
+            f / f_sp)
+
+    def mel_to_hz(m):
+        return np.where(
+            m >= min_log_mel,
+            min_log_hz * np.exp(logstep * (m - min_log_mel)),
+            f_sp * m)
+
+    fftfreqs = np.fft.rfftfreq(n_fft, 1.0 / sr)
+    mel_f = mel_to_hz(np.linspace(hz_to_mel(0), hz_to_mel(sr / 2), n_mels + 2))
+
+    fdiff = np.diff(mel_f)
+    ramps = mel_f[:, None] - fftfreqs[None, :]
+    lower = -ramps[:-2] / fdiff[:-1, None]
+    upper = ramps[2:] / fdiff[1:, None]
+    weights = np.maximum(0, np.minimum(lower, upper))
+
+    # area normalization
+    weights *= (2.0 / (mel_f[2:] - mel_f[:-2]))[:, None]
+
+    return weights.astype(np.float32)
+
+
+class StreamingLogMel:
+    """
+    Log-mel spectrogram of an audio stream, computed incrementally.
+
+    Each push computes the STFT frames of the new samples only, and writes
+    their log-mel to a ring buffer of the latest max_frames frames. The
+    frames are those of log_mel_spectrogram() of the whole stream (the
+    start is reflect-padded, and flush() pads the end), and window()
+    normalizes them as log_mel_spectrogram() does for the selected frames.
+    """
+
+    def __init__(self, max_frames=N_FRAMES, n_mels=N_MELS):
+        n = np.arange(N_FFT)
+        self.window_fn = (0.5 - 0.5 * np.cos(2 * np.pi * n / N_FFT)).astype(np.float32)
+        self.filters = mel_filter_bank(n_mels=n_mels)
+        self.log_mel = ClipBuffer(max_frames, (n_mels,), time_axis=1)
+        self.frames = 0  # number of frames computed since the start
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._started = False
+
+    @property
+    def seconds(self):
+        return self.frames * HOP_LENGTH / SAMPLE_RATE
+
+    def push(self, samples):
+        """
+        Add the samples, and return the energy (mean square) of each new
+        frame for the voice activity detection
+        """
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1)
+        pending = np.concatenate([self._pending, samples])
+        if not self._started:
+            if len(pending) <= N_FFT // 2:
+                self._pending = pending
+                return np.zeros(0, dtype=np.float32)
+            pending = np.concatenate([pending[N_FFT // 2:0:-1], pending])
+            self._started = True
+        self._pending = pending
+
+        return self._compute()
+
+    def flush(self):
+        """End of the stream, compute the last frames"""
+        if not self._started:
+            return np.zeros(0, dtype=np.float32)
+        pad = self._pending[-2:-N_FFT // 2 - 2:-1]
+        self._pending = np.concatenate([self._pending, pad])
+
+        # log_mel_spectrogram() drops the last frame
+        n = (len(self._pending) - N_FFT) // HOP_LENGTH
+        return self._compute(n)
+
+    def _compute(self, n=None):
+        pending = self._pending
+        if n is None:
+            n = (len(pending) - N_FFT) // HOP_LENGTH + 1 if len(pending) >= N_FFT else 0
+        if n <= 0:
+            return np.zeros(0, dtype=np.float32)
+
+        frames = np.lib.stride_tricks.sliding_window_view(pending, N_FFT)[::HOP_LENGTH][:n]
+        spec = np.fft.rfft(frames * self.window_fn, axis=-1)
+        power = spec.real ** 2 + spec.imag ** 2
+        mel_spec = power.astype(np.float32) @ self.filters.T
+        self.log_mel.extend(np.log10(np.clip(mel_spec, 1e-10, None)))
+
+        self.frames += n
+        self._pending = pending[n * HOP_LENGTH:]
+
+        return np.mean(frames ** 2, axis=1)
+
+    def window(self, start=0):
+        """
+        The normalized log-mel spectrogram of the frames from start (frame
+        index since the start of the stream) to now, shape = (80, n_frames)
+        """
+        n = max(0, min(self.frames - start, self.log_mel.length))
+        x = self.log_mel.clip()[:, self.log_mel.length - n:]
+        if n > 0:
+            x = np.maximum(x, np.max(x) - 8.0)
+        return (x + 4.0) / 4.0
+
+
+class EnergyVAD:
+    """
+    Voice activity detection on the frame energies.
+
+    A frame is speech when its energy is above threshold, and the stream
+    is silent once no speech was found for hangover frames.
+    """
+
+    def __init__(self, threshold=0.001, hangover=50):
+        self.threshold = threshold
+        self.hangover = hangover
+        self.silence = hangover  # number of frames since the last speech frame
+
+    @property
+    def active(self):
+        return self.silence < self.hangover
+
+    def update(self, energy):
+        """Returns the number of frames since the last speech frame, for each new frame"""
+        n = len(energy)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        idx = np.arange(n)
+        last = np.maximum.accumulate(np.where(energy >= self.threshold, idx, -1))
+        since = np.where(last >= 0, idx - last, self.silence + idx + 1)
+        self.silence = int(since[-1])
+        return since
+
+
+class StablePrefix:
+    """
+    Stable-prefix commit policy of the streaming hypotheses: the tokens on
+    which the last `agreement` hypotheses of the same audio agree are
+    stable, and can be committed.
+    """
+
+    def __init__(self, agreement=2):
+        self.agreement = agreement
+        self.hypotheses = []
+
+    def update(self, tokens):
+        """Add a hypothesis, and return the length of its stable prefix"""
+        self.hypotheses = (self.hypotheses + [list(tokens)])[-self.agreement:]
+        if len(self.hypotheses) < self.agreement:
+            return 0
+
+        n = min(len(x) for x in self.hypotheses)
+        for i in range(n):
+            if any(x[i] != tokens[i] for x in self.hypotheses):
+                return i
+        return n
+
+    def reset(self):
+        self.hypotheses = []
@@ -15,13 +15,14 @@ sys.path.append('../../util')
 from logging import getLogger  # noqa
 
 from decode_utils import (ApplyTimestampRules, BeamSearchDecoder,
-                          GreedyDecoder, MaximumLikelihoodRanker,
+                          GreedyDecoder, KVCacheArena, MaximumLikelihoodRanker,
                           SuppressBlank, SuppressTokens)
 from math_utils import softmax
 from microphone_utils import start_microphone_input  # noqa
 from model_utils import check_and_download_models  # noqa
 from languages import LANGUAGES, TO_LANGUAGE_CODE
-from utils import get_base_parser, get_savepath, update_parser  # noqa
+from stream_utils import EnergyVAD, StablePrefix, StreamingLogMel
+from utils import get_base_parser, get_savepath, prefetch_batches, update_parser  # noqa
 
 logger = getLogger(__name__)
 
@@ -32,6 +33,14 @@ logger = getLogger(__name__)
 WAV_PATH = 'demo.wav'
 SAVE_TEXT_PATH = 'output.txt'
 
+# batch mode: the windows are cut at the quietest frame of their last seconds
+VAD_SEARCH_SECONDS = 5
+VAD_SMOOTH_FRAMES = 10
+
+# stream mode: audio kept before the speech onset, and microphone queue size
+STREAM_MARGIN_FRAMES = 20
+STREAM_QUEUE_SIZE = 100
+
 # ======================
 # Workaround
 # ======================
@@ -94,6 +103,19 @@ parser.add_argument(
     "--no_speech_threshold", type=float, default=0.6,
     help="if the probability of the <|nospeech|> token is higher than this value"
          " AND the decoding has failed due to `logprob_threshold`, consider the segment as silence")
+parser.add_argument(
+    '--stream', action='store_true',
+    help='streaming transcription of the input audio (or of the microphone with -V), '
+         'with partial hypotheses committed once stable')
+parser.add_argument(
+    '--stream_step', type=float, default=1.0,
+    help='seconds of audio between two decodings of the stream')
+parser.add_argument(
+    '--vad_threshold', type=float, default=0.001,
+    help='energy (mean square) of the speech frames, for the stream')
+parser.add_argument(
+    '--vad_silence', type=float, default=0.5,
+    help='seconds of silence ending an utterance of the stream')
 parser.add_argument(
     '--onnx',
     action='store_true',
@@ -112,7 +134,7 @@ parser.add_argument(
 parser.add_argument(
     '--profile',
     action='store_true',
-    help='display profile.'
+    help='display profile, and the kv_cache allocation and copy time of each decoding.'
 )
 parser.add_argument(
     '--ailia_audio',
@@ -263,7 +285,7 @@ def get_suppress_tokens(tokenizer, options):
     return tuple(sorted(set(suppress_tokens)))
 
 
-def new_kv_cache(n_group, length=451):
+def kv_cache_shape(n_group, length=451):
     model_type = args.model_type
     if model_type == "tiny.en" or model_type == "tiny":
         size = [8, n_group, length, 384]
@@ -278,7 +300,15 @@ def new_kv_cache(n_group, length=451):
     else:
         raise ValueError(f"Unsupported model type: {model_type}")
 
-    return np.zeros(size, dtype=np.float32)
+    return size
+
+
+def new_kv_cache_arena(n_group, group_size=1):
+    """KV cache of one decode call, see KVCacheArena"""
+    return KVCacheArena(
+        kv_cache_shape(n_group), group_size,
+        fixed=not args.dynamic_kv_cache,
+        double_buffer=args.onnx and not args.dynamic_kv_cache)
 
 
 # ======================
@@ -302,33 +332,50 @@ def get_audio_features(enc_net, mel):
     return audio_features
 
 
+def run_decoder_onnx(dec_net, tokens, audio_features, kv_cache, offset, arena):
+    if arena.spare is None:
+        kv_cache = kv_cache.astype(np.float32)
+        return dec_net.run(None, {
+            'tokens': tokens, 'audio_features': audio_features,
+            'kv_cache': kv_cache, 'offset': offset})
+
+    # write the new cache to the spare buffer of the arena, without
+    # allocation of the output
+    logits_name, kv_cache_name = [x.name for x in dec_net.get_outputs()]
+    binding = dec_net.io_binding()
+    binding.bind_cpu_input('tokens', tokens)
+    binding.bind_cpu_input('audio_features', np.ascontiguousarray(audio_features))
+    binding.bind_cpu_input('offset', offset)
+    binding.bind_input(
+        'kv_cache', 'cpu', 0, np.float32, kv_cache.shape, kv_cache.ctypes.data)
+    binding.bind_output(logits_name, 'cpu')
+    binding.bind_output(
+        kv_cache_name, 'cpu', 0, np.float32, arena.spare.shape, arena.spare.ctypes.data)
+    dec_net.run_with_iobinding(binding)
+    logits = binding.copy_outputs_to_cpu()[0]
+    return logits, arena.spare
+
+
 def inference_logits(dec_net, tokens, audio_features, kv_cache=None, initial_token_length=None):
+    """
+    Run one decoding step. kv_cache is the KVCacheArena of the previous
+    steps (None for the first step), updated in place and returned.
+    """
     n_group = tokens.shape[0]
     initial_token_length = initial_token_length if initial_token_length else tokens.shape[-1]
     if kv_cache is None:
-        if not args.dynamic_kv_cache:
-            kv_cache = new_kv_cache(n_group)
-        else:
-            kv_cache = new_kv_cache(n_group, initial_token_length)
-        offset = 0
-        length = initial_token_length
-    else:
-        offset = kv_cache.shape[2]
-        if not args.dynamic_kv_cache:
-            length = offset + 1
-            _kv_cache = new_kv_cache(n_group)
-            _kv_cache[:, :, :offset, :] = kv_cache
-        else:
-            _kv_cache = new_kv_cache(n_group, offset + 1)
-            _kv_cache[:, :, :-1, :] = kv_cache
-        kv_cache = _kv_cache
+        kv_cache = new_kv_cache_arena(n_group)
+    arena = kv_cache
 
     if tokens.shape[-1] > initial_token_length:
         # only need to use the last token except in the first forward pass
         tokens = tokens[:, -1:]
 
-    tokens = tokens.astype(np.int64)
-    offset = np.array(offset, dtype=np.int64)
+    # the rows of the cache may be in another order than the beams
+    tokens = arena.to_physical(tokens.astype(np.int64))
+    n_tokens = tokens.shape[-1]
+    kv_cache = arena.input(n_tokens)
+    offset = np.array(arena.length, dtype=np.int64)
 
     if not args.onnx:
         if REQUIRE_CONSTANT_SHAPE_BETWEEN_INFERENCE:
@@ -341,16 +388,12 @@ def inference_logits(dec_net, tokens, audio_features, kv_cache=None, initial_tok
 
         output = dec_net.predict([tokens, audio_features, kv_cache, offset])
     else:
-        kv_cache = kv_cache.astype(np.float32)
-        output = dec_net.run(None, {
-            'tokens': tokens, 'audio_features': audio_features,
-            'kv_cache': kv_cache, 'offset': offset})
+        output = run_decoder_onnx(dec_net, tokens, audio_features, kv_cache, offset, arena)
     logits, kv_cache = output
 
-    if not args.dynamic_kv_cache:
-        return logits, kv_cache[:, :, :length, :]
-    else:
-        return logits, kv_cache
+    arena.update(kv_cache, n_tokens)
+
+    return arena.to_logical(logits), arena
 
 
 def detect_language(enc_net, dec_net, mel, tokenizer=None):
@@ -403,7 +446,7 @@ def detect_language(enc_net, dec_net, mel, tokenizer=None):
 def decode(enc_net, dec_net, mel, options):
     single = mel.ndim == 2
     if single:
-        mel = mel.unsqueeze(0)
+        mel = np.expand_dims(mel, axis=0)
 
     language = options.get("language") or "en"
     tokenizer = get_tokenizer(is_multilingual(), language=language, task='transcribe')
@@ -447,8 +490,9 @@ def decode(enc_net, dec_net, mel, options):
     n_audio = mel.shape[0]
 
     audio_features = get_audio_features(enc_net, mel)
-    tokens = np.repeat(np.array([initial_tokens]), n_audio, axis=-1)
+    tokens = np.repeat(np.array([initial_tokens]), n_audio, axis=0)
     languages = [language] * audio_features.shape[0]
+    result_features = audio_features
 
     # repeat the audio & text tensors by the group size, for beam search or best-of-n sampling
     audio_features = np.repeat(audio_features, n_group, axis=0)
@@ -458,7 +502,16 @@ def decode(enc_net, dec_net, mel, options):
     sum_logprobs = np.zeros(n_batch)
     no_speech_probs = [np.nan] * n_batch
     initial_token_length = len(initial_tokens)
-    kv_cache = None
+    # allocated once, updated in place by the decoding steps
+    kv_cache = new_kv_cache_arena(n_batch, n_group)
+
+    # rows of the batch still decoded, and the result of the finished rows
+    rows = np.arange(n_batch)
+    # with ailia, a change of the input shape re-creates the decoder, so the
+    # finished rows stay in the batch, masked by their saved result
+    compact_rows = args.onnx or not REQUIRE_CONSTANT_SHAPE_BETWEEN_INFERENCE
+    finished_tokens = [None] * n_batch
+    finished_logprobs = np.zeros(n_batch)
 
     # sampling loop
     for i in range(sample_len):
@@ -482,7 +535,7 @@ def decode(enc_net, dec_net, mel, options):
             logit_filter.apply(logits, tokens)
 
         def rearrange_kv_cache(source_indices):
-            kv_cache[...] = kv_cache[:, source_indices]
+            kv_cache.reorder(source_indices)
 
         # expand the tokens tensor with the selected next tokens
         tokens, completed = decoder.update(tokens, logits, sum_logprobs, rearrange_kv_cache)
@@ -490,8 +543,37 @@ def decode(enc_net, dec_net, mel, options):
         if completed or tokens.shape[-1] > n_ctx:
             break
 
+        # keep the result of the rows when they finish, and drop the finished
+        # rows from the batch once they are half of it (if the shape may
+        # change), so that the next steps only decode the unfinished ones
+        finished = decoder.finished_rows(tokens)
+        for r in np.nonzero(finished)[0]:
+            if finished_tokens[rows[r]] is None:
+                finished_tokens[rows[r]] = tokens[r]
+                finished_logprobs[rows[r]] = sum_logprobs[r]
+        if compact_rows and 2 * np.count_nonzero(finished) >= len(finished):
+            keep = np.nonzero(~finished)[0]
+            rows, tokens, sum_logprobs = rows[keep], tokens[keep], sum_logprobs[keep]
+            audio_features = audio_features[keep]
+            kv_cache.select(keep)
+            decoder.select(keep)
+
+    if args.profile:
+        logger.info(kv_cache.summary())
+
+    # gather the rows again, the ones finished first being padded with EOT
+    for r, t, logprob in zip(rows, tokens, sum_logprobs):
+        if finished_tokens[r] is None:
+            finished_tokens[r] = t
+            finished_logprobs[r] = logprob
+    length = max(len(t) for t in finished_tokens)
+    tokens = np.array([
+        np.pad(t, (0, length - len(t)), constant_values=tokenizer.eot) for t in finished_tokens
+    ])
+    sum_logprobs = finished_logprobs
+
     # reshape the tensors to have (n_audio, n_group) as the first two dimensions
-    audio_features = audio_features[:: n_group]
+    audio_features = result_features
     no_speech_probs = no_speech_probs[:: n_group]
     assert audio_features.shape[0] == len(no_speech_probs) == n_audio
 
@@ -573,12 +655,9 @@ def decode_with_fallback(enc_net, dec_net, segment, decode_options):
     return results
 
 
-def predict(wav, enc_net, dec_net, immediate=False, microphone=False):
-    language = args.language
+def get_decode_options():
     temperature = args.temperature
     temperature_increment_on_fallback = args.temperature_increment_on_fallback
-    logprob_threshold = args.logprob_threshold
-    no_speech_threshold = args.no_speech_threshold
 
     if temperature_increment_on_fallback is not None:
         temperature = tuple(np.arange(temperature, 1.0 + 1e-6, temperature_increment_on_fallback))
@@ -586,13 +665,22 @@ def predict(wav, enc_net, dec_net, immediate=False, microphone=False):
         temperature = [temperature]
 
     decode_options = {
-        'task': 'transcribe', 'language': language,
+        'task': 'transcribe', 'language': args.language,
         'temperature': temperature, 'best_of': args.best_of,
         'beam_size': args.beam_size, 'patience': args.patience,
         'length_penalty': args.length_penalty, 'suppress_tokens': args.suppress_tokens,
-        'logprob_threshold': logprob_threshold,
+        'logprob_threshold': args.logprob_threshold,
         'prompt': []
     }
+    return decode_options
+
+
+def predict(wav, enc_net, dec_net, immediate=False, microphone=False):
+    language = args.language
+    logprob_threshold = args.logprob_threshold
+    no_speech_threshold = args.no_speech_threshold
+
+    decode_options = get_decode_options()
 
     mel = log_mel_spectrogram(wav)
 
@@ -725,6 +813,328 @@ def predict(wav, enc_net, dec_net, immediate=False, microphone=False):
     return d
 
 
+def split_at_silences(mel):
+    """
+    Split the mel spectrogram into windows of at most N_FRAMES frames, each
+    cut at the quietest frame of its last VAD_SEARCH_SECONDS seconds, so
+    that the words are not cut between two windows.
+    """
+    num_frames = mel.shape[-1]
+    search_frames = VAD_SEARCH_SECONDS * SAMPLE_RATE // HOP_LENGTH
+    energy = np.convolve(
+        mel.mean(axis=0), np.ones(VAD_SMOOTH_FRAMES) / VAD_SMOOTH_FRAMES, mode='same')
+
+    windows = []
+    start = 0
+    while num_frames - start > N_FRAMES:
+        lo = start + N_FRAMES - search_frames
+        end = lo + int(np.argmin(energy[lo:start + N_FRAMES]))
+        windows.append((start, end))
+        start = end
+    windows.append((start, num_frames))
+
+    return windows
+
+
+def window_segments(tokens, tokenizer, offset, duration):
+    """
+    Split the decoded tokens of a window starting at offset (seconds) into
+    (start, end, text_tokens) at the timestamp tokens, as in predict().
+    The tokens after the last pair of timestamps are kept up to the end of
+    the window, instead of being decoded again with the next window.
+    """
+    input_stride = N_FRAMES // dims.n_audio_ctx
+    time_precision = input_stride * HOP_LENGTH / SAMPLE_RATE
+    timestamp_begin = tokenizer.timestamp_begin
+
+    timestamp_tokens = tokens >= timestamp_begin
+    consecutive = np.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[0] + 1
+
+    segments = []
+    last_slice = 0
+    for current_slice in consecutive:
+        sliced_tokens = tokens[last_slice:current_slice]
+        segments.append((
+            offset + (sliced_tokens[0] - timestamp_begin) * time_precision,
+            offset + (sliced_tokens[-1] - timestamp_begin) * time_precision,
+            sliced_tokens[1:-1],
+        ))
+        last_slice = current_slice
+
+    rest = tokens[last_slice:]
+    if np.any(rest < tokenizer.eot):
+        start = offset
+        if rest[0] >= timestamp_begin:
+            start += (rest[0] - timestamp_begin) * time_precision
+        end = offset + duration
+        timestamps = rest[1:][rest[1:] >= timestamp_begin]
+        if len(timestamps) > 0:
+            end = offset + (timestamps[-1] - timestamp_begin) * time_precision
+        segments.append((start, end, rest))
+
+    return segments
+
+
+def predict_batch(audio_paths, enc_net, dec_net, batch_size):
+    """
+    Transcribe the audio files by decoding batch_size 30-second windows at
+    once, the windows coming from the files split at silences.
+
+    The windows are decoded independently, without the previous text as
+    prompt. Yields (audio_path, result) in the order of the files.
+    """
+    logprob_threshold = args.logprob_threshold
+    no_speech_threshold = args.no_speech_threshold
+    decode_options = get_decode_options()
+
+    files = {}  # files being transcribed
+    queues = {}  # windows to decode by language
+    next_file = 0
+
+    def run_batch(language, windows):
+        segment = np.stack([
+            pad_or_trim(files[i]['mel'][:, start:end], N_FRAMES)
+            for i, _, start, end in windows
+        ])
+        tokenizer = get_tokenizer(is_multilingual(), language=language, task='transcribe')
+        results = decode_with_fallback(
+            enc_net, dec_net, segment, {**decode_options, 'language': language})
+
+        for (i, w, start, end), result in zip(windows, results):
+            f = files[i]
+            f['remaining'] -= 1
+            if no_speech_threshold is not None:
+                # no voice activity check
+                should_skip = result.no_speech_prob > no_speech_threshold
+                if logprob_threshold is not None and result.avg_logprob > logprob_threshold:
+                    should_skip = False
+                if should_skip:
+                    continue
+
+            offset = float(start * HOP_LENGTH / SAMPLE_RATE)
+            duration = (end - start) * HOP_LENGTH / SAMPLE_RATE
+            segments = []
+            for seg_start, seg_end, text_tokens in window_segments(
+                    np.array(result.tokens), tokenizer, offset, duration):
+                text = tokenizer.decode([t for t in text_tokens if t < tokenizer.eot])
+                if len(text.strip()) == 0:  # skip empty text output
+                    continue
+                segments.append({
+                    "seek": start,
+                    "start": seg_start,
+                    "end": seg_end,
+                    "text": text,
+                    "tokens": result.tokens,
+                    "temperature": result.temperature,
+                    "avg_logprob": result.avg_logprob,
+                    "no_speech_prob": result.no_speech_prob,
+                })
+            f['windows'][w] = segments
+
+    def completed():
+        nonlocal next_file
+        while next_file in files and files[next_file]['remaining'] == 0:
+            f = files.pop(next_file)
+            segments = [seg for window in f['windows'] for seg in window]
+            for i, seg in enumerate(segments):
+                seg['id'] = i
+            yield f['path'], dict(
+                text=''.join(seg['text'] for seg in segments),
+                segments=segments,
+                language=f['language'],
+            )
+            next_file += 1
+
+    loaded = prefetch_batches(audio_paths, load_audio, 1, args.workers)
+    for i, (paths, wav) in enumerate(loaded):
+        mel = log_mel_spectrogram(wav[0])
+
+        language = args.language
+        if language is None:
+            _, probs = detect_language(enc_net, dec_net, pad_or_trim(mel, N_FRAMES))
+            language = max(probs, key=probs.get)
+            logger.info(f"{paths[0]}: Detected language: {LANGUAGES[language].title()}")
+
+        windows = split_at_silences(mel)
+        files[i] = {
+            'path': paths[0], 'mel': mel, 'language': language,
+            'windows': [[] for _ in windows], 'remaining': len(windows),
+        }
+        queue = queues.setdefault(language, [])
+        queue.extend((i, w, start, end) for w, (start, end) in enumerate(windows))
+        while len(queue) >= batch_size:
+            run_batch(language, queue[:batch_size])
+            del queue[:batch_size]
+
+        yield from completed()
+
+    for language, queue in queues.items():
+        for j in range(0, len(queue), batch_size):
+            run_batch(language, queue[j:j + batch_size])
+    yield from completed()
+
+
+def recognize_from_audio_batch(enc_net, dec_net):
+    logger.info('Start inference...')
+    start = int(round(time.time() * 1000))
+    outputs = predict_batch(args.input, enc_net, dec_net, args.batch_size)
+    for audio_path, output in outputs:
+        logger.info(audio_path)
+        for res in output['segments']:
+            logger.info(f"[{format_timestamp(res['start'])} --> {format_timestamp(res['end'])}] {res['text']}")
+    end = int(round(time.time() * 1000))
+    if args.benchmark:
+        logger.info(f'\tailia processing time {end - start} ms')
+
+    logger.info('Script finished successfully.')
+
+
+def transcribe_stream(enc_net, dec_net, chunks):
+    """
+    Streaming transcription of the audio chunks.
+
+    The log-mel spectrogram is computed incrementally, and the audio not
+    committed yet is decoded every args.stream_step seconds while the VAD
+    detects speech. The segments on which two successive hypotheses agree
+    are committed, and the next decodings start after them, so that the
+    decoded audio, and the latency, are bounded whatever the length of the
+    utterance. The end of an utterance commits the whole hypothesis.
+
+    Yields the segments, with final=False for the partial hypotheses.
+    """
+    frames_per_second = SAMPLE_RATE // HOP_LENGTH
+    input_stride = N_FRAMES // dims.n_audio_ctx
+    step_frames = max(1, int(args.stream_step * frames_per_second))
+    max_frames = N_FRAMES - step_frames
+
+    log_mel = StreamingLogMel(N_FRAMES)
+    vad = EnergyVAD(args.vad_threshold, int(args.vad_silence * frames_per_second))
+    stable = StablePrefix()
+
+    decode_options = {**get_decode_options(), 'temperature': 0}
+    language = args.language
+    tokenizer = None
+    committed = []  # committed tokens, the prompt of the next decodings
+    start = 0  # first frame not committed
+    decoded = 0  # frame of the last decoding
+    pending = False  # speech not committed
+
+    def run():
+        nonlocal language, tokenizer
+        mel = pad_or_trim(log_mel.window(start), N_FRAMES)
+        if language is None:
+            _, probs = detect_language(enc_net, dec_net, mel)
+            language = max(probs, key=probs.get)
+            logger.info(f"Detected language: {LANGUAGES[language].title()}")
+        if tokenizer is None:
+            tokenizer = get_tokenizer(is_multilingual(), language=language, task='transcribe')
+
+        options = {**decode_options, 'language': language, 'prompt': committed}
+        result = decode_with_fallback(enc_net, dec_net, mel[None], options)[0]
+        return np.array(result.tokens, dtype=np.int64)
+
+    def segments(tokens, begin, end, final):
+        offset = begin / frames_per_second
+        duration = (end - begin) / frames_per_second
+        for seg_start, seg_end, text_tokens in window_segments(tokens, tokenizer, offset, duration):
+            text = tokenizer.decode([t for t in text_tokens if t < tokenizer.eot])
+            if len(text.strip()) > 0:
+                yield {
+                    "start": seg_start, "end": seg_end, "text": text,
+                    "final": final, "time": log_mel.seconds,
+                }
+
+    def commit(tokens, end):
+        nonlocal start, committed
+        yield from segments(tokens, start, end, True)
+        committed = (committed + tokens.tolist())[-(dims.n_text_ctx // 2):]
+        start = end
+        stable.reset()
+
+    for chunk in chunks:
+        vad.update(log_mel.push(chunk))
+        now = log_mel.frames
+
+        if not vad.active:
+            if pending:
+                # end of the utterance
+                yield from commit(run(), now)
+                pending = False
+            start = max(start, now - STREAM_MARGIN_FRAMES)
+            continue
+
+        pending = True
+        if now - decoded < step_frames:
+            continue
+        decoded = now
+
+        tokens = run()
+        begin = start
+        timestamp = tokens >= tokenizer.timestamp_begin
+        n = stable.update(tokens)
+        if now - start >= max_frames:
+            n = len(tokens)  # the window is full, commit what is decoded
+
+        # commit the stable segments, up to their closing timestamp
+        ends = np.nonzero(timestamp[1:n] & ~timestamp[:max(n - 1, 0)])[0] + 2
+        if len(ends) > 0:
+            k = ends[-1]
+            end = start + int(tokens[k - 1] - tokenizer.timestamp_begin) * input_stride
+            yield from commit(tokens[:k], min(end, now))
+            tokens = tokens[k:]
+        elif now - start >= max_frames:
+            yield from commit(tokens, now)
+            tokens = tokens[:0]
+
+        yield from segments(tokens, begin, now, False)
+
+    vad.update(log_mel.flush())
+    if pending:
+        yield from commit(run(), log_mel.frames)
+
+
+def wav_chunks(wav, chunk=SAMPLE_RATE // 10):
+    """The wav as a stream of chunks, standing in for the microphone"""
+    for i in range(0, len(wav), chunk):
+        yield wav[i:i + chunk]
+
+
+def microphone_chunks(mic_info):
+    p = mic_info['p']
+    que = mic_info['que']
+    while p.is_alive():
+        try:
+            yield que.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+def recognize_from_stream(enc_net, dec_net, mic_info=None):
+    if mic_info is None:
+        sources = ((audio_path, wav_chunks(load_audio(audio_path))) for audio_path in args.input)
+    else:
+        logger.info("Please speak something")
+        sources = [('microphone', microphone_chunks(mic_info))]
+
+    try:
+        for name, chunks in sources:
+            logger.info(name)
+            for seg in transcribe_stream(enc_net, dec_net, chunks):
+                span = f"[{format_timestamp(seg['start'])} --> {format_timestamp(seg['end'])}]"
+                if seg['final']:
+                    latency = seg['time'] - seg['end']
+                    logger.info(f"{span} {seg['text']} (latency {latency:.2f}s)")
+                else:
+                    logger.info(f"{span} ... {seg['text']}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if mic_info is not None:
+            mic_info['fin'].set()
+
+    logger.info('Script finished successfully.')
+
+
 def recognize_from_audio(enc_net, dec_net):
     immediate = True
 
@@ -829,7 +1239,9 @@ def main():
     mic_info = None
     if args.V:
         # in microphone input mode, start thread before load the model.
-        mic_info = start_microphone_input(SAMPLE_RATE, sc=False, speaker=False)
+        mic_info = start_microphone_input(
+            SAMPLE_RATE, sc=False, speaker=False,
+            queue_size=STREAM_QUEUE_SIZE if args.stream else 2, stream=args.stream)
 
     pf = platform.system()
     if pf == "Darwin":
@@ -854,9 +1266,15 @@ def main():
         else:
             dec_net = onnxruntime.InferenceSession(WEIGHT_DEC_PATH)
 
-    if args.V:
+    if args.stream:
+        # streaming mode, from the microphone with -V
+        recognize_from_stream(enc_net, dec_net, mic_info)
+    elif args.V:
         # microphone input mode
         recognize_from_microphone(enc_net, dec_net, mic_info)
+    elif args.batch_size > 1:
+        # throughput mode, several windows decoded at once
+        recognize_from_audio_batch(enc_net, dec_net)
     else:
         recognize_from_audio(enc_net, dec_net)
 
@@ -0,0 +1,284 @@
+import json
+import os
+
+import numpy as np
+
+# logger
+from logging import getLogger  # noqa: E402
+
+logger = getLogger(__name__)
+
+# ======================
+# Parameters
+# ======================
+INDEX_DIR = 'gallery_index'
+EMBEDS_FILE = 'embeds.npy'
+META_FILE = 'meta.json'
+IVF_FILE = 'ivf.npz'
+
+# number of gallery rows scored at once by the exact search
+SEARCH_BLOCK = 65536
+
+
+def l2_normalize(x, eps=1e-12):
+    x = np.asarray(x, dtype=np.float32)
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norm, eps)
+
+
+def merge_top_k(best_s, best_i, scores, idx, k):
+    """Merge the running (n, k) best scores with a block of scores"""
+    cand_s = np.concatenate([best_s, scores], axis=1)
+    cand_i = np.concatenate([best_i, np.broadcast_to(idx, scores.shape)], axis=1)
+    if cand_s.shape[1] > k:
+        part = np.argpartition(-cand_s, k - 1, axis=1)[:, :k]
+        cand_s = np.take_along_axis(cand_s, part, axis=1)
+        cand_i = np.take_along_axis(cand_i, part, axis=1)
+    return cand_s, cand_i
+
+
+def assign_clusters(x, centroids):
+    """Nearest centroid of each normalized row of x, by blocks of rows"""
+    return np.concatenate([
+        np.argmax(x[i:i + SEARCH_BLOCK] @ centroids.T, axis=1)
+        for i in range(0, len(x), SEARCH_BLOCK)
+    ]) if len(x) > 0 else np.zeros(0, dtype=np.int64)
+
+
+def kmeans(x, n_clusters, rows=None, n_iter=10, max_samples_per_cluster=64, seed=0):
+    """
+    Spherical k-means of the normalized rows of x (all of them, or the row
+    indices rows), trained on a sample of at most max_samples_per_cluster
+    rows by cluster. Only the sampled rows are read, so that x may be
+    memory-mapped. Returns the centroids.
+    """
+    rng = np.random.RandomState(seed)
+    rows = np.arange(len(x)) if rows is None else np.asarray(rows)
+    n_samples = min(len(rows), n_clusters * max_samples_per_cluster)
+    x = np.asarray(x[np.sort(rng.choice(rows, n_samples, replace=False))])
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = assign_clusters(x, centroids)
+        order = np.argsort(assign, kind='stable')
+        clusters, starts = np.unique(assign[order], return_index=True)
+        # the clusters without member keep their centroid
+        centroids[clusters] = np.add.reduceat(x[order], starts, axis=0)
+        centroids = l2_normalize(centroids)
+    return centroids
+
+
+class GalleryIndex:
+    """
+    Embeddings of the gallery images for the retrieval.
+
+    The L2-normalized embeddings are the rows of one float32 .npy matrix,
+    memory-mapped so that a large catalog is not loaded in memory, with
+    the image ids (paths relative to the gallery root) of the rows in a
+    JSON file. Appending writes only the new rows, a deleted row is only
+    marked dead until the dead rows are the majority and are compacted.
+
+    The cosine distances to a query are given by one matrix multiply, and
+    the k nearest images by argpartition. An optional IVF index
+    (k-means coarse quantizer) restricts the search to the rows of the
+    n_probe nearest clusters for million-item catalogs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dim = None
+        self.ids = []  # id of each row, None for the deleted rows
+        self.mtimes = []
+        self.rows = {}  # id -> row
+        self.embeds = None  # memory-mapped (capacity, dim) matrix
+        self.centroids = None
+        self.lists = None  # IVF cluster of each row
+        self._inverted = None
+
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.dim = meta['dim']
+            self.ids = meta['ids']
+            self.mtimes = meta['mtimes']
+            self.rows = {x: i for i, x in enumerate(self.ids) if x is not None}
+            self.embeds = np.load(
+                os.path.join(path, EMBEDS_FILE), mmap_mode='r+')
+
+            ivf_path = os.path.join(path, IVF_FILE)
+            if os.path.exists(ivf_path):
+                data = np.load(ivf_path)
+                self.centroids = data['centroids']
+                self.lists = data['lists']
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, id):
+        return id in self.rows
+
+    @property
+    def alive(self):
+        alive = np.zeros(len(self.ids), dtype=bool)
+        alive[list(self.rows.values())] = True
+        return alive
+
+    def _reserve(self, n):
+        capacity = 0 if self.embeds is None else len(self.embeds)
+        if n <= capacity:
+            return
+
+        # grow the file geometrically, so that appending a few images at a
+        # time does not rewrite the whole matrix each time
+        os.makedirs(self.path, exist_ok=True)
+        capacity = max(n, 2 * capacity, 1024)
+        path = os.path.join(self.path, EMBEDS_FILE)
+        tmp_path = path + '.tmp'
+        embeds = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.float32, shape=(capacity, self.dim))
+        count = len(self.ids)
+        if count > 0:
+            embeds[:count] = self.embeds[:count]
+        embeds.flush()
+        del embeds
+        self.embeds = None
+        os.replace(tmp_path, path)
+        self.embeds = np.load(path, mmap_mode='r+')
+
+    def append(self, ids, embeds, mtimes=None):
+        embeds = l2_normalize(np.asarray(embeds).reshape(len(ids), -1))
+        if len(ids) == 0:
+            return
+        if self.dim is None:
+            self.dim = embeds.shape[1]
+        if embeds.shape[1] != self.dim:
+            raise ValueError(
+                f'Embedding dimension {embeds.shape[1]} does not match '
+                f'the index ({self.dim}).')
+
+        # a re-added id replaces its previous row
+        self.delete([x for x in ids if x in self.rows])
+
+        begin = len(self.ids)
+        self._reserve(begin + len(ids))
+        self.embeds[begin:begin + len(ids)] = embeds
+        for i, x in enumerate(ids):
+            self.rows[x] = begin + i
+        self.ids.extend(ids)
+        self.mtimes.extend(mtimes if mtimes is not None else [0] * len(ids))
+
+        if self.centroids is not None:
+            self.lists = np.concatenate([
+                self.lists, assign_clusters(embeds, self.centroids)])
+            self._inverted = None
+
+    def delete(self, ids):
+        for x in ids:
+            row = self.rows.pop(x)
+            self.ids[row] = None
+        if len(self.ids) > 2 * len(self.rows) + 1024:
+            self.compact()
+
+    def compact(self):
+        """Remove the deleted rows from the matrix"""
+        alive = np.nonzero(self.alive)[0]
+        embeds = np.array(self.embeds[alive])
+        lists = self.lists[alive] if self.lists is not None else None
+
+        self.ids = [self.ids[i] for i in alive]
+        self.mtimes = [self.mtimes[i] for i in alive]
+        self.rows = {x: i for i, x in enumerate(self.ids)}
+        self.embeds[:len(alive)] = embeds
+        self.lists = lists
+        self._inverted = None
+
+    def build_ivf(self, n_lists):
+        """Cluster the embeddings for the approximate search"""
+        alive = np.nonzero(self.alive)[0]
+        n_lists = min(n_lists, len(alive))
+        if n_lists <= 0:
+            return
+        logger.info(f'Building the IVF index ({n_lists} lists)...')
+        self.centroids = kmeans(self.embeds, n_lists, rows=alive)
+        self.lists = np.full(len(self.ids), -1, dtype=np.int64)
+        for i in range(0, len(alive), SEARCH_BLOCK):
+            rows = alive[i:i + SEARCH_BLOCK]
+            self.lists[rows] = assign_clusters(self.embeds[rows], self.centroids)
+        self._inverted = None
+
+    def inverted_lists(self):
+        """Rows sorted by cluster and the start of each cluster in them"""
+        if self._inverted is None:
+            order = np.argsort(self.lists, kind='stable')
+            starts = np.searchsorted(
+                self.lists[order], np.arange(len(self.centroids) + 1))
+            self._inverted = order, starts
+        return self._inverted
+
+    def search(self, queries, k, n_probe=None):
+        """
+        Returns the k nearest images of each query as a list of
+        [(id, cosine distance), ...], nearest first.
+
+        If the IVF index is built and n_probe is given, only the images of
+        the n_probe clusters nearest to the query are compared.
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return [[] for _ in range(len(np.atleast_2d(queries)))]
+        queries = l2_normalize(np.asarray(queries).reshape(-1, self.dim))
+        n = len(queries)
+        best_s = np.zeros((n, 0), dtype=np.float32)
+        best_i = np.zeros((n, 0), dtype=np.int64)
+
+        alive = self.alive
+        if self.centroids is not None and n_probe:
+            order, starts = self.inverted_lists()
+            probe = np.argsort(
+                -(queries @ self.centroids.T), axis=1)[:, :n_probe]
+            results = []
+            for q, p in zip(queries, probe):
+                rows = np.sort(np.concatenate(
+                    [order[starts[c]:starts[c + 1]] for c in p]))
+                rows = rows[alive[rows]]
+                s = self.embeds[rows] @ q
+                s, i = merge_top_k(
+                    best_s[:1], best_i[:1], s[None], rows, min(k, len(rows)))
+                results.append(self._sorted(s, i)[0])
+            return results
+
+        # exact search, by blocks of the memory-mapped matrix
+        for r0 in range(0, len(self.ids), SEARCH_BLOCK):
+            rows = np.nonzero(alive[r0:r0 + SEARCH_BLOCK])[0] + r0
+            if len(rows) == 0:
+                continue
+            block = self.embeds[r0:r0 + SEARCH_BLOCK][rows - r0]
+            scores = queries @ block.T
+            best_s, best_i = merge_top_k(best_s, best_i, scores, rows, k)
+
+        return self._sorted(best_s, best_i)
+
+    def _sorted(self, scores, rows):
+        order = np.argsort(-scores, axis=1, kind='stable')
+        scores = np.take_along_axis(scores, order, axis=1)
+        rows = np.take_along_axis(rows, order, axis=1)
+        return [
+            [(self.ids[r], float(1 - s)) for r, s in zip(rr, ss)]
+            for rr, ss in zip(rows, scores)
+        ]
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        if self.embeds is not None:
+            self.embeds.flush()
+        meta_path = os.path.join(self.path, META_FILE)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'dim': self.dim, 'ids': self.ids, 'mtimes': self.mtimes}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+        ivf_path = os.path.join(self.path, IVF_FILE)
+        if self.centroids is not None:
+            with open(ivf_path, 'wb') as f:
+                np.savez(f, centroids=self.centroids, lists=self.lists)
+        elif os.path.exists(ivf_path):
+            os.remove(ivf_path)
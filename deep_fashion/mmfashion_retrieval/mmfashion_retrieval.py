@@ -6,7 +6,6 @@ import onnx
 import onnxruntime
 import cv2
 import matplotlib.pyplot as plt
-from scipy.spatial.distance import cosine
 
 import ailia
 
@@ -59,6 +58,17 @@ parser.add_argument(
     default=5, type=int,
     help='Retrieve the top k results'
 )
+parser.add_argument(
+    '--ivf_lists',
+    default=0, type=int,
+    help='Number of clusters of the approximate (IVF) index of the gallery. '
+    '0 searches the whole gallery exactly.'
+)
+parser.add_argument(
+    '--n_probe',
+    default=8, type=int,
+    help='Number of the nearest clusters searched with the IVF index'
+)
 args = update_parser(parser)
 
 
@@ -68,21 +78,15 @@ args = update_parser(parser)
 def check(onnx_model):
     onnx.checker.check_model(onnx_model)
 
-def search_gallery(net, pred, filename=None):
-    gallery_imgs, gallery_embeds = process_gallery(args.gallery, net)
-    show_retrieved_images(pred, gallery_embeds, gallery_imgs, args.topk, filename)
-
-def show_retrieved_images(query_feat, gallery_embeds, gallery_imgs, topk, filename):
-    query_dist = {}
-    for img in gallery_imgs:
-        cosine_dist = cosine(
-            gallery_embeds[img].flatten(), query_feat.flatten())
-        query_dist[img] = cosine_dist
+def search_gallery(index, pred, filename=None):
+    show_retrieved_images(pred, index, args.topk, filename)
 
-    order = sorted(query_dist.items(), key=lambda x: x[1])
+def show_retrieved_images(query_feat, index, topk, filename):
+    # [(image, cosine distance), ...] in increasing distance
+    order = index.search(query_feat.flatten(), topk, args.n_probe)[0]
 
     logger.info('Retrieved Top%d Results' % topk)
-    show_topk_retrieved_images(order[:topk], filename)
+    show_topk_retrieved_images(order, filename)
 
 def show_topk_retrieved_images(retrieved_idxes, input_image):
     fig = plt.figure(figsize=(15, 2.5))
@@ -110,7 +114,7 @@ def show_img(filename, fig, title, topk, idx):
 # ======================
 # Main functions
 # ======================
-def recognize_from_image(filename, net):
+def recognize_from_image(filename, net, index):
     # prepare input data
     img = load_image(filename)
     #logger.info(f'input image shape: {img.shape}')
@@ -130,13 +134,13 @@ def recognize_from_image(filename, net):
         preds_ailia = net.predict(img)
 
     #logger.info(f'output shape: {preds_ailia.shape}')
-    search_gallery(net, preds_ailia, filename)
+    search_gallery(index, preds_ailia, filename)
 
     savepath = get_savepath(args.savepath, filename)
     plt.savefig(savepath, bbox_inches='tight')
     logger.info(f'saved at : {savepath}')
 
-def recognize_from_video(filename, net):
+def recognize_from_video(filename, net, index):
     capture = webcamera_utils.get_capture(args.video)
 
     # create video writer if savepath is specified as video format
@@ -155,7 +159,7 @@ def recognize_from_video(filename, net):
         x = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         x = preprocess(x)
         preds_ailia = net.predict(x)
-        search_gallery(net, preds_ailia, x[0].transpose(1, 2, 0))
+        search_gallery(index, preds_ailia, x[0].transpose(1, 2, 0))
 
         # save results
         if writer is not None:
@@ -177,14 +181,18 @@ def main():
     # net initialize
     net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
 
+    # embeddings of the gallery, updated with the added/removed images
+    index = process_gallery(
+        args.gallery, net, args.batch_size, args.workers, args.ivf_lists)
+
     if args.video is not None:
         # video mode
-        recognize_from_video(SAVE_IMAGE_PATH, net)
+        recognize_from_video(SAVE_IMAGE_PATH, net, index)
     else:
         # image mode
         # input image loop
         for image_path in args.input:
-            recognize_from_image(image_path, net)
+            recognize_from_image(image_path, net, index)
     logger.info('Script finished successfully.')
 
 if __name__ == '__main__':
@@ -9,6 +9,8 @@ from pathlib import Path
 # import original modules
 sys.path.append('../../util')
 from detector_utils import load_image  # noqa: E402
+from utils import prefetch_batches  # noqa: E402
+from gallery_index import GalleryIndex, INDEX_DIR
 
 # logger
 from logging import getLogger  # noqa: E402
@@ -39,60 +41,84 @@ def preprocess(img):
     img = np.expand_dims(img, 0)
     return img
 
-def process_embeds(gallery, gallery_imgs, gallery_embeds, model):
+def load_gallery_image(path):
+    img = load_image(path)
+    img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+    return preprocess(img)[0]
+
+
+def embed_images(gallery, keys, model, batch_size=1, workers=0):
+    """Yields the keys and the embeddings of the gallery images by batches"""
+    paths = [os.path.join(gallery, key) for key in keys]
+    key_of = dict(zip(paths, keys))
+    for batch_paths, imgs in prefetch_batches(paths, load_gallery_image, batch_size, workers):
+        embeds = model.predict(imgs)
+        yield [key_of[x] for x in batch_paths], embeds.reshape(len(imgs), -1)
+
+
+def import_legacy_embeds(gallery, index):
+    # embeddings of the former gallery_embeds.pkl format
+    legacy_path = os.path.join(gallery, 'gallery_embeds.pkl')
+    if len(index) > 0 or not os.path.isfile(legacy_path):
+        return
+    with open(legacy_path, 'rb') as file:
+        gallery_embeds = pickle.load(file)
+    if gallery_embeds:
+        keys = list(gallery_embeds)
+        mtimes = [os.path.getmtime(os.path.join(gallery, key))
+                  if os.path.exists(os.path.join(gallery, key)) else 0
+                  for key in keys]
+        index.append(keys, np.stack(
+            [np.asarray(gallery_embeds[key]).flatten() for key in keys]), mtimes)
+        logger.info(f'Imported the embeds of {legacy_path}')
+
+
+def process_embeds(gallery, gallery_imgs, index, model, batch_size=1, workers=0):
     logger.info('Exploring the gallery... (it may take a while)')
-    modified = False
+    mtimes = {key: os.path.getmtime(os.path.join(gallery, key)) for key in gallery_imgs}
 
-    # If some images have been removed from the gallery
-    if len(gallery_imgs) <= len(gallery_embeds):
-        removed_keys = set(gallery_embeds) - set(gallery_imgs)
-        for key in removed_keys:
-            modified = True
-            del gallery_embeds[key]
+    # If some images have been removed or replaced from the gallery
+    removed_keys = [
+        key for key, mtime in zip(index.ids, index.mtimes)
+        if key is not None and mtimes.get(key) != mtime
+    ]
+    index.delete(removed_keys)
 
     # If some images have been added or replaced from the gallery
-    if len(gallery_imgs) >= len(gallery_embeds):
-        added_keys = set(gallery_imgs) - set(gallery_embeds)
-        for key in added_keys:
-            modified = True
-            # prepare input data
-            img = load_image(os.path.join(gallery, key))
-            img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
-            img = preprocess(img)
-            # inference
-            embed = model.predict(img)
-            gallery_embeds[key] = embed
-
-            if len(gallery_embeds)+1 % 500 == 0: 
-                print(f"{len(gallery_embeds)}/{len(gallery_imgs)}")
-    
-    # Saves the new embeds dict if modified
-    if modified:
-        folder = os.path.join(gallery, 'gallery_embeds.pkl')
-        with open(folder, 'wb') as file:
-            pickle.dump(gallery_embeds, file)
-            logger.info(f'Gallery embeds saved at : {folder}')
+    added_keys = [key for key in gallery_imgs if key not in index]
+    for i, (keys, embeds) in enumerate(embed_images(
+            gallery, added_keys, model, batch_size, workers)):
+        index.append(keys, embeds, [mtimes[key] for key in keys])
+        if (i + 1) % 100 == 0:
+            print(f"{len(index)}/{len(gallery_imgs)}")
 
+    # Saves the index if modified
+    if removed_keys or added_keys:
+        index.save()
+        logger.info(f'Gallery index saved at : {index.path}')
 
-def process_gallery(gallery, net):
-    
+
+def process_gallery(gallery, net, batch_size=1, workers=0, ivf_lists=0):
     gallery_imgs_path = os.path.join(gallery, 'gallery_imgs.txt')
-    gallery_embeds_path = os.path.join(gallery, 'gallery_embeds.pkl')
 
     generate_images_filename_txt(gallery)
     gallery_imgs = open(gallery_imgs_path, 'r').read().splitlines()
 
-    if os.path.isfile(gallery_embeds_path):
-        file = open(gallery_embeds_path, "rb")
-        gallery_embeds = pickle.load(file)
-        file.close()
-    else:
-        gallery_embeds = {}
+    index = GalleryIndex(os.path.join(gallery, INDEX_DIR))
+    import_legacy_embeds(gallery, index)
+    process_embeds(gallery, gallery_imgs, index, net, batch_size, workers)
 
-    process_embeds(gallery, gallery_imgs, gallery_embeds, net)
+    # (re)build the approximate index if requested
+    if ivf_lists > 0:
+        if index.centroids is None or len(index.centroids) != min(ivf_lists, len(index)):
+            index.build_ivf(ivf_lists)
+            index.save()
+    elif index.centroids is not None:
+        index.centroids = index.lists = None
+        index.save()
+
+    return index
 
-    return gallery_imgs, gallery_embeds
-    
 
 def generate_images_filename_txt(root):
     # looks recursively for .jpg/.JPG or .png/.PNG files from the root directory
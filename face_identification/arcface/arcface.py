@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 
@@ -15,6 +16,8 @@ from model_utils import check_and_download_models  # noqa: E402
 from detector_utils import hsv_to_rgb  # noqa: E402
 from nms_utils import nms_between_categories  # noqa: E402
 
+from arcface_utils import l2_normalize, FaceGallery, ASSIGNMENT  # noqa: E402
+
 # logger
 from logging import getLogger   # noqa: E402
 logger = getLogger(__name__)
@@ -81,6 +84,25 @@ parser.add_argument(
     '-ft', '--face_threshold', type=float, default=FACE_THRESHOLD,
     help='Threshold for face detection'
 )
+parser.add_argument(
+    '--gallery', metavar='GALLERY', default=None,
+    help='Gallery file (.npz) of the enrolled faces. In video mode, the ' +
+    'detected faces are identified against it.'
+)
+parser.add_argument(
+    '--enroll', metavar='IMAGE', nargs='+', default=None,
+    help='Face images (or directories of face images) to add to the ' +
+    'gallery, named after the file names.'
+)
+parser.add_argument(
+    '--assignment', default='greedy', choices=list(ASSIGNMENT.keys()),
+    help='Assignment of the detected faces to the tracks and the gallery.'
+)
+parser.add_argument(
+    '--face_batch', type=int, default=0,
+    help='Number of faces embedded by one inference. ' +
+    '0 uses the batch size of the model.'
+)
 args = update_parser(parser)
 
 WEIGHT_PATH = args.arch + '.onnx'
@@ -152,6 +174,36 @@ def cosin_metric(x1, x2):
     return np.dot(x1, x2) / (np.linalg.norm(x1) * np.linalg.norm(x2))
 
 
+def set_face_batch(net):
+    if args.face_batch > 0:
+        net.set_input_shape((args.face_batch * 2, 1, IMAGE_HEIGHT, IMAGE_WIDTH))
+
+
+def embed_faces(net, images):
+    """
+    images: list of preprocessed faces (2, 1, H, W), the image and its flip
+    returns: (n, feature_dim) features, the concatenation of the features
+        of the image and of its flip
+    """
+    if len(images) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    # several faces are packed in each inference
+    batch_size = net.get_input_shape()[0]
+    data = np.concatenate(images, axis=0)
+    n = len(data)
+    preds = []
+    for i in range(0, n, batch_size):
+        chunk = data[i:i + batch_size]
+        if len(chunk) < batch_size:
+            pad = np.zeros((batch_size - len(chunk),) + chunk.shape[1:], dtype=chunk.dtype)
+            chunk = np.concatenate([chunk, pad], axis=0)
+        preds.append(net.predict(chunk))
+    preds = np.concatenate(preds, axis=0)[:n]
+
+    return preds.reshape(len(images), -1)
+
+
 # ======================
 # Face Tracking
 # ======================
@@ -173,6 +225,11 @@ class FaceTrack():
         self.frame_no.append(frame_no)
         self.score = score
 
+    def mean_feature(self):
+        """Mean of the normalized features, its dot product with a normalized
+        feature is the average cosine similarity to the features of the track"""
+        return np.mean(l2_normalize(np.asarray(self.fe)), axis=0)
+
     def pop(self, frame_no):
         if len(self.frame_no) > FACE_TRACK_T:
             self.fe.pop(0)
@@ -186,65 +243,32 @@ class FaceTrack():
                 self.frame_no.pop(0)
 
 
-def face_identification(tracks, net, detections, frame_no):
-    BATCH_SIZE = net.get_input_shape()[0]
-
-    for i in range(len(detections)):
-        resized_frame = detections[i]["resized_frame"]
-
-        # prepare target face and input face
-        input_frame = preprocess_image(resized_frame, input_is_bgr=True)
-        if BATCH_SIZE == 4:
-            input_data = np.concatenate([input_frame, input_frame], axis=0)
-        else:
-            input_data = input_frame
-
-        # inference
-        preds_ailia = net.predict(input_data)
-
-        # postprocessing
-        if BATCH_SIZE == 4:
-            fe_1 = np.concatenate([preds_ailia[0], preds_ailia[1]], axis=0)
-            fe_2 = np.concatenate([preds_ailia[2], preds_ailia[3]], axis=0)
-        else:
-            fe_1 = np.concatenate([preds_ailia[0], preds_ailia[1]], axis=0)
-            fe_2 = fe_1
-
-        detections[i]["fe"] = fe_2
-
-    score_matrix = np.zeros((len(detections), len(tracks)))
+def face_identification(tracks, net, detections, frame_no, gallery=None):
+    # embed all the faces of the frame at once
+    features = embed_faces(net, [
+        preprocess_image(d["resized_frame"], input_is_bgr=True)
+        for d in detections
+    ])
     for i in range(len(detections)):
-        for j in range(len(tracks)):
-            max_sim = 0
-            avg_sim = 0
-            for k in range(len(tracks[j].fe)):
-                sim = cosin_metric(detections[i]["fe"], tracks[j].fe[k])
-                avg_sim = avg_sim + sim
-                if max_sim < sim:
-                    max_sim = sim
-            score_matrix[i, j] = max_sim
-            if len(tracks[j].fe) >= 1:
-                avg_sim = avg_sim / len(tracks[j].fe)
-            score_matrix[i, j] = avg_sim
-
-    for i in range(len(detections)):
-        if len(tracks) == 0:
-            continue
-
-        # search max score between detections and tracks
-        max_score = np.unravel_index(
-            np.argmax(score_matrix), score_matrix.shape
-        )
-
-        det_sim = max_score[0]
-        id_sim = max_score[1]
-        score_sim = score_matrix[det_sim, id_sim]
-
-        detections[det_sim]["id_sim"] = id_sim
-        detections[det_sim]["score_sim"] = score_sim
-
-        score_matrix[det_sim, :] = 0
-        score_matrix[:, id_sim] = 0
+        detections[i]["fe"] = features[i]
+
+    # identify the enrolled faces
+    if gallery is not None:
+        results = gallery.identify(features, args.threshold, args.assignment)
+        for i, (name, score) in enumerate(results):
+            detections[i]["name"] = name
+
+    # average cosine similarity between the detections and the tracks
+    cols = [j for j in range(len(tracks)) if len(tracks[j].fe) >= 1]
+    if len(detections) > 0 and len(cols) > 0:
+        score_matrix = np.zeros((len(detections), len(tracks)), dtype=np.float32)
+        score_matrix[:, cols] = l2_normalize(features) @ \
+            np.stack([tracks[j].mean_feature() for j in cols]).T
+
+        matches = ASSIGNMENT[args.assignment](score_matrix)
+        for det_sim, id_sim in matches:
+            detections[det_sim]["id_sim"] = id_sim
+            detections[det_sim]["score_sim"] = score_matrix[det_sim, id_sim]
 
     for i in range(len(tracks)):
         tracks[i].score = 0
@@ -343,9 +367,13 @@ def display_detections(ui, w, h, detections):
             int((detection["bottom_right"][1])-8)
         )
 
+        label = f"{detection['id_sim']}"
+        if detection.get("name") is not None:
+            label = f"{label} {detection['name']}"
+
         cv2.putText(
             ui,
-            f"{detection['id_sim']}",
+            label,
             text_position,
             cv2.FONT_HERSHEY_SIMPLEX,
             fontScale,
@@ -446,12 +474,57 @@ def compare_images():
         logger.info('They are the same face!')
 
 
+def image_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, f) for f in os.listdir(path)
+                if os.path.splitext(f)[1].lower() in ('.jpg', '.jpeg', '.png', '.bmp')
+            ))
+        else:
+            files.append(path)
+    return files
+
+
+def enroll_faces():
+    gallery_path = args.gallery if args.gallery else 'gallery.npz'
+    if os.path.exists(gallery_path):
+        gallery = FaceGallery.load(gallery_path)
+    else:
+        gallery = FaceGallery()
+
+    # net initialize
+    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
+    set_face_batch(net)
+
+    # the images are read by chunks to bound the memory
+    files = image_files(args.enroll)
+    chunk_size = 256
+    for i in range(0, len(files), chunk_size):
+        paths = files[i:i + chunk_size]
+        features = embed_faces(net, [prepare_input_data(p) for p in paths])
+        names = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+        gallery.add(features, names)
+        logger.info(f'enrolled {min(i + chunk_size, len(files))}/{len(files)} faces')
+
+    gallery.save(gallery_path)
+    logger.info(f'{len(gallery)} faces in {gallery_path}')
+
+
 def compare_video():
     # prepare base image
     tracks = []
 
+    # gallery of the enrolled faces
+    gallery = None
+    if args.gallery is not None:
+        gallery = FaceGallery.load(args.gallery)
+        logger.info(f'{len(gallery)} faces enrolled in {args.gallery}')
+
     # net initialize
     net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
+    set_face_batch(net)
 
     # detector initialize
     if args.face == "blazeface":
@@ -507,7 +580,12 @@ def compare_video():
         detections = get_faces(detector, frame, w, h)
 
         # track face
-        face_identification(tracks, net, detections, frame_no)
+        start = int(round(time.time() * 1000))
+        face_identification(tracks, net, detections, frame_no, gallery)
+        if args.benchmark:
+            end = int(round(time.time() * 1000))
+            logger.info(
+                f'\tidentification of {len(detections)} faces: {end - start} ms')
         frame_no = frame_no+1
 
         # display result
@@ -539,7 +617,10 @@ def main():
             FACE_WEIGHT_PATH, FACE_MODEL_PATH, FACE_REMOTE_PATH
         )
 
-    if args.video is None:
+    if args.enroll is not None:
+        # add the faces to the gallery
+        enroll_faces()
+    elif args.video is None:
         # still image mode
         # comparing two images specified args.inputs
         if len(args.inputs)==0:
@@ -0,0 +1,172 @@
+import numpy as np
+
+
+def l2_normalize(x, axis=-1, eps=1e-12):
+    x = np.asarray(x, dtype=np.float32)
+    norm = np.linalg.norm(x, axis=axis, keepdims=True)
+    return x / np.maximum(norm, eps)
+
+
+def assign_greedy(score_matrix, threshold=-np.inf):
+    """
+    Match rows and columns by decreasing score, each row and column at
+    most once. Returns a list of (row, col) with score >= threshold.
+    """
+    n, m = score_matrix.shape
+    if n == 0 or m == 0:
+        return []
+    order = np.argsort(-score_matrix, axis=None, kind='stable')
+    rows, cols = np.unravel_index(order, score_matrix.shape)
+    scores = score_matrix[rows, cols]
+
+    row_used = np.zeros(n, dtype=bool)
+    col_used = np.zeros(m, dtype=bool)
+    matches = []
+    for r, c, s in zip(rows, cols, scores):
+        if s < threshold or len(matches) == min(n, m):
+            break
+        if row_used[r] or col_used[c]:
+            continue
+        row_used[r] = col_used[c] = True
+        matches.append((int(r), int(c)))
+    return matches
+
+
+def assign_hungarian(score_matrix, threshold=-np.inf):
+    """
+    Match rows and columns maximizing the total score.
+    Returns a list of (row, col) with score >= threshold.
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    if score_matrix.size == 0:
+        return []
+    rows, cols = linear_sum_assignment(score_matrix, maximize=True)
+    return [
+        (int(r), int(c)) for r, c in zip(rows, cols)
+        if score_matrix[r, c] >= threshold
+    ]
+
+
+def top_k(scores, k):
+    """(n, k) best scores of each row and their column indices, best first"""
+    n, m = scores.shape
+    k = min(k, m)
+    if k < m:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(m), (n, 1))
+    top = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+ASSIGNMENT = {
+    'greedy': assign_greedy,
+    'hungarian': assign_hungarian,
+}
+
+
+class FaceGallery:
+    """
+    Index of enrolled faces.
+
+    The features are stored L2-normalized as rows of one float32 matrix,
+    so that the cosine similarities between the queries and the whole
+    gallery are a single matrix multiply.
+    """
+
+    def __init__(self, dim=None):
+        self.dim = dim
+        self._features = np.zeros((0, dim or 0), dtype=np.float32)
+        self._size = 0
+        self.names = []
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def features(self):
+        return self._features[:self._size]
+
+    def add(self, features, names):
+        features = l2_normalize(np.atleast_2d(features))
+        if isinstance(names, str):
+            names = [names]
+        if len(features) != len(names):
+            raise ValueError('The numbers of features and names differ.')
+        if self.dim is None:
+            self.dim = features.shape[1]
+            self._features = np.zeros((0, self.dim), dtype=np.float32)
+        if features.shape[1] != self.dim:
+            raise ValueError(
+                f'Feature dimension {features.shape[1]} does not match '
+                f'the gallery ({self.dim}).')
+
+        # grow the storage geometrically so that enrolling one face at a
+        # time does not copy the whole gallery each time
+        n = self._size + len(features)
+        if n > len(self._features):
+            capacity = max(n, 2 * len(self._features), 64)
+            buf = np.zeros((capacity, self.dim), dtype=np.float32)
+            buf[:self._size] = self.features
+            self._features = buf
+        self._features[self._size:n] = features
+        self._size = n
+        self.names.extend(names)
+
+    def remove(self, name):
+        keep = np.array([x != name for x in self.names], dtype=bool)
+        self._features = self.features[keep].copy()
+        self._size = len(self._features)
+        self.names = [x for x, k in zip(self.names, keep) if k]
+
+    def scores(self, queries):
+        """(n, len(gallery)) cosine similarities"""
+        # gallery-major product, the gallery rows are read contiguously once
+        return (self.features @ l2_normalize(np.atleast_2d(queries)).T).T
+
+    def search(self, queries, k=1):
+        """
+        Returns the (n, k) scores and gallery indices of the k nearest
+        enrolled faces of each query, best first.
+        """
+        return top_k(self.scores(queries), k)
+
+    def identify(self, queries, threshold, assignment='greedy', k=5):
+        """
+        Identify the faces seen together in one frame. A gallery entry is
+        given to at most one query.
+
+        Returns a list of (name, score) for each query, name is None if
+        the face is not enrolled.
+        """
+        n = len(np.atleast_2d(queries))
+        results = [(None, 0.0)] * n
+        if n == 0 or self._size == 0:
+            return results
+
+        # the assignment only needs the candidates near any of the queries
+        scores = self.scores(queries)
+        _, idx = top_k(scores, k)
+        cols = np.unique(idx)
+        sub = scores[:, cols]
+        for r, c in ASSIGNMENT[assignment](sub, threshold):
+            results[r] = (self.names[cols[c]], float(sub[r, c]))
+        return results
+
+    def save(self, path):
+        # write through a file object so that the path is kept as given
+        with open(path, 'wb') as f:
+            np.savez(
+                f, features=self.features,
+                names=np.array(self.names, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        features = data['features']
+        gallery = cls(features.shape[1])
+        if len(features) > 0:
+            gallery.add(features, [str(x) for x in data['names']])
+        return gallery
@@ -10,15 +10,17 @@ import ailia
 # import original modules
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
+from utils import prefetch_batches  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 from detector_utils import load_image  # noqa: E402C
-from classifier_utils import plot_results, print_results  # noqa: E402
+from classifier_utils import plot_results, print_results, MAX_CLASS_COUNT  # noqa: E402
 from math_utils import softmax  # noqa: E402C
 import webcamera_utils  # noqa: E402
 # logger
 from logging import getLogger  # noqa: E402
 
 from simple_tokenizer import SimpleTokenizer as _Tokenizer
+from text_feature_cache import TextFeatureCache, model_key
 
 logger = getLogger(__name__)
 
@@ -43,6 +45,9 @@ SAVE_IMAGE_PATH = 'output.png'
 
 IMAGE_SIZE = 224
 
+TEXT_CACHE_DIR = 'text_feature_cache'
+TEXT_BATCH_SIZE = 256
+
 # ======================
 # Arguemnt Parser Config
 # ======================
@@ -68,6 +73,19 @@ parser.add_argument(
     action='store_true',
     help='execute onnxruntime version.'
 )
+parser.add_argument(
+    '--text_cache', default=TEXT_CACHE_DIR, metavar='DIR', type=str,
+    help='directory of the cache of the text features.'
+)
+parser.add_argument(
+    '--no_text_cache',
+    action='store_true',
+    help='encode the texts on each launch, without the cache.'
+)
+parser.add_argument(
+    '-k', '--top_k', default=MAX_CLASS_COUNT, type=int,
+    help='number of the labels shown for each image.'
+)
 args = update_parser(parser)
 
 
@@ -131,9 +149,7 @@ def preprocess(img):
     return img
 
 
-def predict(net, img, text_feature):
-    img = preprocess(img)
-
+def predict_image_feature(net, img):
     # feedforward
     if not args.onnx:
         output = net.predict([img])
@@ -144,6 +160,14 @@ def predict(net, img, text_feature):
 
     image_feature = image_feature / np.linalg.norm(image_feature, ord=2, axis=-1, keepdims=True)
 
+    return image_feature
+
+
+def predict(net, img, text_feature):
+    img = preprocess(img)
+
+    image_feature = predict_image_feature(net, img)
+
     logit_scale = 100
     logits_per_image = (image_feature * logit_scale).dot(text_feature.T)
 
@@ -168,7 +192,31 @@ def predict_text_feature(net, text):
     return text_feature
 
 
-def recognize_from_image(net_image, net_text):
+def top_k_probs(logits, k):
+    """
+    Softmax probabilities of the k best labels of each row of logits,
+    without normalizing nor sorting the other labels.
+
+    returns: the (n, k) label indices and probabilities, best first
+    """
+    n, m = logits.shape
+    k = min(k, m)
+    if k < m:
+        idx = np.argpartition(-logits, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(m), (n, 1))
+    top = np.take_along_axis(logits, idx, axis=1)
+    order = np.argsort(-top, axis=1, kind='stable')
+    idx = np.take_along_axis(idx, order, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+
+    # log-sum-exp over all the labels for the normalization
+    max_logit = top[:, :1]
+    log_sum = np.log(np.sum(np.exp(logits - max_logit), axis=1, keepdims=True))
+    return idx, np.exp(top - max_logit - log_sum)
+
+
+def load_text_inputs():
     text_inputs = args.text_inputs
     desc_file = args.desc_file
     if desc_file:
@@ -176,8 +224,21 @@ def recognize_from_image(net_image, net_text):
             text_inputs = [x.strip() for x in f.readlines() if x.strip()]
     elif text_inputs is None:
         text_inputs = [f"a {c}" for c in ("human", "dog", "cat")]
+    return text_inputs
+
+
+def get_text_feature(net_text, text_inputs, text_cache):
+    if text_cache is None:
+        return predict_text_feature(net_text, text_inputs)
 
-    text_feature = predict_text_feature(net_text, text_inputs)
+    return text_cache.get(
+        text_inputs, lambda texts: predict_text_feature(net_text, texts),
+        TEXT_BATCH_SIZE)
+
+
+def recognize_from_image(net_image, net_text, text_cache):
+    text_inputs = load_text_inputs()
+    text_feature = get_text_feature(net_text, text_inputs, text_cache)
 
     # input image loop
     for image_path in args.input:
@@ -209,21 +270,62 @@ def recognize_from_image(net_image, net_text):
 
         # show results
         pred = np.expand_dims(pred,axis=0)
-        print_results(pred, text_inputs)
+        print_results(pred, text_inputs, args.top_k)
 
     logger.info('Script finished successfully.')
 
 
-def recognize_from_video(net_image, net_text):
-    text_inputs = args.text_inputs
-    desc_file = args.desc_file
-    if desc_file:
-        with open(desc_file) as f:
-            text_inputs = [x.strip() for x in f.readlines() if x.strip()]
-    elif text_inputs is None:
-        text_inputs = [f"a {c}" for c in ("human", "dog", "cat")]
+def recognize_from_image_batch(net_image, net_text, text_cache):
+    text_inputs = load_text_inputs()
+    text_feature = get_text_feature(net_text, text_inputs, text_cache)
+
+    def load_input(image_path):
+        img = load_image(image_path)
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        return preprocess(img)[0]
 
-    text_feature = predict_text_feature(net_text, text_inputs)
+    # input image loop
+    for image_paths, input_data in prefetch_batches(
+            args.input, load_input, args.batch_size, args.workers):
+        logger.info(image_paths)
+
+        # inference
+        logger.info('Start inference...')
+        if args.benchmark:
+            logger.info('BENCHMARK mode')
+            total_time_estimation = 0
+            for i in range(args.benchmark_count):
+                start = int(round(time.time() * 1000))
+                image_feature = predict_image_feature(net_image, input_data)
+                end = int(round(time.time() * 1000))
+                estimation_time = (end - start)
+
+                # Loggin
+                logger.info(f'\tailia processing estimation time {estimation_time} ms')
+                if i != 0:
+                    total_time_estimation = total_time_estimation + estimation_time
+
+            logger.info(f'\taverage time estimation {total_time_estimation / (args.benchmark_count - 1)} ms')
+        else:
+            image_feature = predict_image_feature(net_image, input_data)
+
+        logit_scale = 100
+        logits_per_image = (image_feature * logit_scale).dot(text_feature.T)
+        indices, probs = top_k_probs(logits_per_image, args.top_k)
+
+        # show results (only the top k labels have a probability)
+        for image_path, idx, prob in zip(image_paths, indices, probs):
+            logger.info(image_path)
+            pred = np.zeros((1, len(text_inputs)), dtype=probs.dtype)
+            pred[0, idx] = prob
+            print_results(pred, text_inputs, args.top_k)
+
+    logger.info('Script finished successfully.')
+
+
+def recognize_from_video(net_image, net_text, text_cache):
+    text_inputs = load_text_inputs()
+    text_feature = get_text_feature(net_text, text_inputs, text_cache)
 
     capture = webcamera_utils.get_capture(args.video)
     # create video writer if savepath is specified as video format
@@ -246,7 +348,7 @@ def recognize_from_video(net_image, net_text):
         
         pred = predict(net_image, img, text_feature)
 
-        plot_results(frame, np.expand_dims(pred,axis=0), text_inputs)
+        plot_results(frame, np.expand_dims(pred,axis=0), text_inputs, args.top_k)
 
         cv2.imshow('frame', frame)
         frame_shown = True
@@ -295,12 +397,21 @@ def main():
         net_image = onnxruntime.InferenceSession(WEIGHT_IMAGE_PATH)
         net_text = onnxruntime.InferenceSession(WEIGHT_TEXT_PATH)
 
+    if args.no_text_cache:
+        text_cache = None
+    else:
+        text_cache = TextFeatureCache(
+            args.text_cache, model_key(WEIGHT_TEXT_PATH, args.model_type))
+
     if args.video is not None:
         # video mode
-        recognize_from_video(net_image, net_text)
+        recognize_from_video(net_image, net_text, text_cache)
+    elif args.batch_size > 1 or args.workers > 0:
+        # batch mode
+        recognize_from_image_batch(net_image, net_text, text_cache)
     else:
         # image mode
-        recognize_from_image(net_image, net_text)
+        recognize_from_image(net_image, net_text, text_cache)
 
 if __name__ == '__main__':
     main()
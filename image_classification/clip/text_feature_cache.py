@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def prompt_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def model_key(weight_path, model_type):
+    """
+    Identify the text encoder by model type and weight file, so that the
+    features of another (or an updated) model are never reused.
+    """
+    size = os.path.getsize(weight_path) if os.path.exists(weight_path) else 0
+    return f'{model_type}_{os.path.basename(weight_path)}_{size}'
+
+
+class TextFeatureCache:
+    """
+    On-disk cache of the L2-normalized text features.
+
+    The features of one model are stored in one .npz file of cache_dir, as
+    a (n, dim) float32 matrix with the SHA-1 of each prompt, so that only
+    the prompts never seen before are encoded.
+    """
+
+    def __init__(self, cache_dir, key):
+        self.path = os.path.join(cache_dir, key + '.npz')
+        self.index = {}
+        self.features = None
+        if os.path.exists(self.path):
+            data = np.load(self.path)
+            self.features = data['features']
+            self.index = {str(k): i for i, k in enumerate(data['keys'])}
+
+    def get(self, texts, encode_fn, batch_size=256):
+        """
+        Returns the (len(texts), dim) features of texts, encoding the
+        missing ones with encode_fn(texts) by batches of batch_size.
+        """
+        keys = [prompt_key(x) for x in texts]
+        missing = list(dict.fromkeys(
+            (k, x) for k, x in zip(keys, texts) if k not in self.index))
+
+        if missing:
+            new = np.concatenate([
+                encode_fn([x for _, x in missing[i:i + batch_size]])
+                for i in range(0, len(missing), batch_size)
+            ]).astype(np.float32)
+            n = 0 if self.features is None else len(self.features)
+            for i, (k, _) in enumerate(missing):
+                self.index[k] = n + i
+            self.features = new if self.features is None \
+                else np.concatenate([self.features, new])
+            self.save()
+
+        return self.features[[self.index[k] for k in keys]]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        keys = np.empty(len(self.index), dtype='<U40')
+        for k, i in self.index.items():
+            keys[i] = k
+
+        # write to a temporary file first, so that a concurrent process
+        # never reads a partially written cache
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, features=self.features, keys=keys)
+        os.replace(tmp_path, self.path)
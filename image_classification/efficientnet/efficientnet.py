@@ -9,7 +9,7 @@ import efficientnet_labels
 
 # import original modules
 sys.path.append('../../util')
-from utils import get_base_parser, update_parser  # noqa: E402
+from utils import get_base_parser, update_parser, prefetch_batches  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 from image_utils import load_image  # noqa: E402
 from classifier_utils import plot_results, print_results  # noqa: E402
@@ -52,9 +52,49 @@ MAX_CLASS_COUNT = 3
 SLEEP_TIME = 0  # for web cam mode
 
 
+def preprocess_batch_image(image_path):
+    # same input as ailia.Classifier (NETWORK_IMAGE_RANGE_S_FP32), for ailia.Net
+    input_data = load_image(
+        image_path,
+        (IMAGE_HEIGHT, IMAGE_WIDTH),
+        normalize_type='127.5',
+        gen_input_ailia=False
+    )
+    return input_data.transpose(2, 0, 1).astype(np.float32)  # HWC -> CHW
+
+
 # ======================
 # Main functions
 # ======================
+def recognize_from_image_batch():
+    # net initialize
+    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
+
+    # input image loop
+    for image_paths, input_data in prefetch_batches(
+            args.input, preprocess_batch_image, args.batch_size, args.workers):
+        logger.info(image_paths)
+
+        # inference
+        logger.info('Start inference...')
+        if args.benchmark:
+            logger.info('BENCHMARK mode')
+            for i in range(args.benchmark_count):
+                start = int(round(time.time() * 1000))
+                output = net.predict(input_data)
+                end = int(round(time.time() * 1000))
+                logger.info(f'\tailia processing time {end - start} ms')
+        else:
+            output = net.predict(input_data)
+        output = output.reshape(len(image_paths), -1)
+
+        # show results
+        for i in range(len(image_paths)):
+            print_results(output[i:i + 1], efficientnet_labels.imagenet_category, MAX_CLASS_COUNT)
+
+    logger.info('Script finished successfully.')
+
+
 def recognize_from_image():
     # net initialize
     classifier = ailia.Classifier(
@@ -161,6 +201,9 @@ def main():
     if args.video is not None:
         # video mode
         recognize_from_video()
+    elif args.batch_size > 1 or args.workers > 0:
+        # batch mode
+        recognize_from_image_batch()
     else:
         # image mode
         recognize_from_image()
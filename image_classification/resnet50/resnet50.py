@@ -15,9 +15,9 @@ from logging import getLogger  # noqa: E402
 import webcamera_utils  # noqa: E402
 from classifier_utils import (plot_results, print_results,  # noqa: E402
                               write_predictions)
-from image_utils import imread  # noqa: E402
+from image_utils import imread, normalize_image  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
-from utils import get_base_parser, get_savepath, update_parser  # noqa: E402
+from utils import get_base_parser, get_savepath, update_parser, prefetch_batches  # noqa: E402
 
 logger = getLogger(__name__)
 
@@ -102,9 +102,58 @@ def preprocess_image(img):
     return img
 
 
+def preprocess_batch_image(image_path):
+    # same input as ailia.Classifier, for ailia.Net
+    img = imread(image_path, cv2.IMREAD_UNCHANGED)
+    img = preprocess_image(img)
+    img = cv2.resize(img, (IMAGE_WIDTH, IMAGE_HEIGHT))
+    img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB).astype(np.float32)
+    if IMAGE_RANGE == ailia.NETWORK_IMAGE_RANGE_IMAGENET:
+        img = normalize_image(img, 'ImageNet')
+    else:
+        img = img - 128
+    img = img.transpose(2, 0, 1).astype(np.float32)  # HWC -> CHW
+    return img
+
+
 # ======================
 # Main functions
 # ======================
+def recognize_from_image_batch():
+    # net initialize
+    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
+
+    # input image loop
+    for image_paths, input_data in prefetch_batches(
+            args.input, preprocess_batch_image, args.batch_size, args.workers):
+        logger.info(image_paths)
+
+        # inference
+        logger.info('Start inference...')
+        if args.benchmark:
+            logger.info('BENCHMARK mode')
+            for i in range(args.benchmark_count):
+                start = int(round(time.time() * 1000))
+                output = net.predict(input_data)
+                end = int(round(time.time() * 1000))
+                logger.info(f'\tailia processing time {end - start} ms')
+        else:
+            output = net.predict(input_data)
+        output = output.reshape(len(image_paths), -1)
+
+        for i, image_path in enumerate(image_paths):
+            # show results
+            print_results(output[i:i + 1], resnet50_labels.imagenet_category, MAX_CLASS_COUNT)
+
+            # write prediction
+            if args.write_prediction:
+                savepath = get_savepath(args.savepath, image_path)
+                pred_file = '%s.txt' % savepath.rsplit('.', 1)[0]
+                write_predictions(pred_file, output[i:i + 1], resnet50_labels.imagenet_category)
+
+    logger.info('Script finished successfully.')
+
+
 def recognize_from_image():
     # net initialize
     classifier = ailia.Classifier(
@@ -207,6 +256,9 @@ def main():
     if args.video is not None:
         # video mode
         recognize_from_video()
+    elif args.batch_size > 1 or args.workers > 0:
+        # batch mode
+        recognize_from_image_batch()
     else:
         # image mode
         recognize_from_image()
@@ -21,7 +21,7 @@ import webcamera_utils  # noqa: E402
 from classifier_utils import plot_results, print_results  # noqa: E402
 from image_utils import imread, load_image  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
-from utils import get_base_parser, update_parser  # noqa: E402
+from utils import get_base_parser, update_parser, get_savepath, prefetch_batches  # noqa: E402
 
 logger = getLogger(__name__)
 
@@ -202,6 +202,60 @@ def recognize_from_image():
     logger.info('Script finished successfully.')
 
 
+def recognize_from_image_batch():
+    # net initialize
+    classifier = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
+    # adjust prediction label
+    labels = np.array(vit_labels.imagenet_category)
+
+    def load_input(image_path):
+        image = imread(image_path)[:, :, ::-1]
+        return prep_input(image)[0], image
+
+    # input image loop
+    for inputs, input_data in prefetch_batches(
+            args.input, load_input, args.batch_size, args.workers):
+        image_paths = [image_path for image_path, _ in inputs]
+        logger.info(image_paths)
+
+        # inference
+        logger.info('Start inference...')
+        if args.benchmark:
+            logger.info('BENCHMARK mode')
+            for i in range(args.benchmark_count):
+                start = int(round(time.time() * 1000))
+                output = classifier.run(input_data)
+                end = int(round(time.time() * 1000))
+                logger.info(f'\tailia processing time {end - start} ms')
+        else:
+            output = classifier.run(input_data)
+
+        for i, (image_path, image) in enumerate(inputs):
+            # pick up logits and attention map
+            logits = output[0][i:i + 1]
+            att_mat = np.array([x[i] for x in output[1:]])
+            # get prediction label and its score
+            probs = np.exp(logits[0])
+            probs = probs / np.sum(probs)
+            topN = np.argsort(-probs)[:MAX_CLASS_COUNT]
+            print('\n  Prediction Label and Attention Map! (%s)' % image_path)
+            for idx in topN:
+                print(f'    {probs[idx]:.5f} : {labels[idx]}')
+            print()
+
+            # calculate attention map
+            mask = calc_attention_map(att_mat, height_org=np.shape(image)[0],
+                                               width_org=np.shape(image)[1])
+            # visualize result
+            image_figure = visualize_result(image, mask, probs[topN], labels[topN])
+            # save visualization
+            savepath = get_savepath(args.savepath, image_path)
+            logger.info(f'saved at : {savepath}')
+            cv2.imwrite(savepath, image_figure[..., ::-1])
+
+    logger.info('Script finished successfully.')
+
+
 def recognize_from_video():
     # net initialize
     classifier = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
@@ -276,6 +330,9 @@ def main():
     if args.video is not None:
         # video mode
         recognize_from_video()
+    elif args.batch_size > 1 or args.workers > 0:
+        # batch mode
+        recognize_from_image_batch()
     else:
         # image mode
         recognize_from_image()
@@ -1,10 +1,13 @@
 import os
+import gc
 import copy
 import functools
 
 import cv2
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage.transform import resize
 import matplotlib.pyplot as plt
 
@@ -1155,6 +1158,10 @@ def vis_depth_discontinuity(
         return [u_over, b_over, l_over, r_over]
 
 
+# number of patches given to weighted_median at once
+WEIGHTED_MEDIAN_CHUNK = 1 << 16
+
+
 def bilateral_filter(
         depth, config, discontinuity_map=None, mask=None, window_size=False):
     sigma_s = config['sigma_s']
@@ -1164,8 +1171,7 @@ def bilateral_filter(
     midpt = window_size // 2
     ax = np.arange(-midpt, midpt + 1.)
     xx, yy = np.meshgrid(ax, ax)
-    if discontinuity_map is not None:
-        spatial_term = np.exp(-(xx ** 2 + yy ** 2) / (2. * sigma_s ** 2))
+    spatial_term = np.exp(-(xx ** 2 + yy ** 2) / (2. * sigma_s ** 2))
 
     # padding
     depth = depth[1:-1, 1:-1]
@@ -1179,75 +1185,63 @@ def bilateral_filter(
     # filtering
     output = depth.copy()
     pad_depth_patches = rolling_window(pad_depth, [window_size, window_size], [1, 1])
+    pH, pW = pad_depth_patches.shape[:2]
+    center = (window_size * window_size) // 2
+
     if discontinuity_map is not None:
-        pad_discontinuity_patches = rolling_window(pad_discontinuity_map, [window_size, window_size], [1, 1])
         pad_discontinuity_hole_patches = rolling_window(pad_discontinuity_hole, [window_size, window_size], [1, 1])
+        if mask is not None:
+            pad_mask = np.pad(mask, (midpt, midpt), 'constant')
+            pad_mask_patches = rolling_window(pad_mask, [window_size, window_size], [1, 1])
+
+        # only the pixels with a discontinuity in their patch are filtered
+        any_discontinuity = cv2.dilate(
+            (pad_discontinuity_map != 0).astype(np.uint8),
+            np.ones((window_size, window_size), np.uint8),
+            borderType=cv2.BORDER_CONSTANT, borderValue=0)[midpt:midpt + pH, midpt:midpt + pW]
+        target = any_discontinuity > 0
+        if mask is not None:
+            target &= mask != 0
+        pi, pj = np.nonzero(target)
+
+        for c0 in range(0, len(pi), WEIGHTED_MEDIAN_CHUNK):
+            ci, cj = pi[c0:c0 + WEIGHTED_MEDIAN_CHUNK], pj[c0:c0 + WEIGHTED_MEDIAN_CHUNK]
+            depth_patch = pad_depth_patches[ci, cj].reshape(len(ci), -1)
+            coef = pad_discontinuity_hole_patches[ci, cj].reshape(len(ci), -1).astype(np.float32)
+            if mask is not None:
+                coef = coef * pad_mask_patches[ci, cj].reshape(len(ci), -1)
+            output[ci, cj] = weighted_median(depth_patch, coef, depth_patch[:, center])
+    else:
+        spatial_term = spatial_term.ravel()
+        rows = max(1, WEIGHTED_MEDIAN_CHUNK // pW)
+        for r0 in range(0, pH, rows):
+            depth_patch = pad_depth_patches[r0:r0 + rows].reshape(-1, window_size * window_size)
+            patch_midpt = depth_patch[:, center]
+            range_term = np.exp(-(depth_patch - patch_midpt[:, None]) ** 2 / (2. * sigma_r ** 2))
+            coef = spatial_term * range_term
+            output[r0:r0 + rows] = weighted_median(
+                depth_patch, coef, patch_midpt).reshape(-1, pW)
 
-    if mask is not None:
-        pad_mask = np.pad(mask, (midpt, midpt), 'constant')
-        pad_mask_patches = rolling_window(pad_mask, [window_size, window_size], [1, 1])
+    return output
 
-    if discontinuity_map is not None:
-        pH, pW = pad_depth_patches.shape[:2]
-        for pi in range(pH):
-            for pj in range(pW):
-                if mask is not None and mask[pi, pj] == 0:
-                    continue
-                if discontinuity_map is not None:
-                    if bool(pad_discontinuity_patches[pi, pj].any()) is False:
-                        continue
-                    discontinuity_patch = pad_discontinuity_patches[pi, pj]
-                    discontinuity_holes = pad_discontinuity_hole_patches[pi, pj]
-                depth_patch = pad_depth_patches[pi, pj]
-                depth_order = depth_patch.ravel().argsort()
-                patch_midpt = depth_patch[window_size // 2, window_size // 2]
-                if discontinuity_map is not None:
-                    coef = discontinuity_holes.astype(np.float32)
-                    if mask is not None:
-                        coef = coef * pad_mask_patches[pi, pj]
-                else:
-                    range_term = np.exp(-(depth_patch - patch_midpt) ** 2 / (2. * sigma_r ** 2))
-                    coef = spatial_term * range_term
-                if coef.max() == 0:
-                    output[pi, pj] = patch_midpt
-                    continue
-                if discontinuity_map is not None and (coef.max() == 0):
-                    output[pi, pj] = patch_midpt
-                else:
-                    coef = coef / (coef.sum())
-                    coef_order = coef.ravel()[depth_order]
-                    cum_coef = np.cumsum(coef_order)
-                    ind = np.digitize(0.5, cum_coef)
-                    output[pi, pj] = depth_patch.ravel()[depth_order][ind]
-    else:
-        pH, pW = pad_depth_patches.shape[:2]
-        for pi in range(pH):
-            for pj in range(pW):
-                if discontinuity_map is not None:
-                    if pad_discontinuity_patches[pi, pj][window_size // 2, window_size // 2] == 1:
-                        continue
-                    discontinuity_patch = pad_discontinuity_patches[pi, pj]
-                    discontinuity_holes = (1. - discontinuity_patch)
-                depth_patch = pad_depth_patches[pi, pj]
-                depth_order = depth_patch.ravel().argsort()
-                patch_midpt = depth_patch[window_size // 2, window_size // 2]
-                range_term = np.exp(-(depth_patch - patch_midpt) ** 2 / (2. * sigma_r ** 2))
-                if discontinuity_map is not None:
-                    coef = spatial_term * range_term * discontinuity_holes
-                else:
-                    coef = spatial_term * range_term
-                if coef.sum() == 0:
-                    output[pi, pj] = patch_midpt
-                    continue
-                if discontinuity_map is not None and (coef.sum() == 0):
-                    output[pi, pj] = patch_midpt
-                else:
-                    coef = coef / (coef.sum())
-                    coef_order = coef.ravel()[depth_order]
-                    cum_coef = np.cumsum(coef_order)
-                    ind = np.digitize(0.5, cum_coef)
-                    output[pi, pj] = depth_patch.ravel()[depth_order][ind]
 
+def weighted_median(values, weights, default):
+    """
+    Weighted median of each row of values (n, k) with weights (n, k).
+    The rows whose weights are all zero take the default value (n,).
+    """
+    order = np.argsort(values, axis=1)
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    weight_sum = weights.sum(axis=1, keepdims=True)
+    valid = weight_sum[:, 0] != 0
+
+    coef = weights[valid] / weight_sum[valid]
+    cum_coef = np.cumsum(np.take_along_axis(coef, order[valid], axis=1), axis=1)
+    # same as np.digitize(0.5, cum_coef) for each row
+    ind = np.sum(cum_coef <= 0.5, axis=1)
+
+    output = np.array(default, copy=True)
+    output[valid] = sorted_values[valid, ind]
     return output
 
 
@@ -2166,94 +2160,175 @@ def convert2tensor(input_dict):
 ### mesh
 
 
-def create_mesh(depth, image, int_mtx, config):
-    H, W, C = image.shape
-    ext_H, ext_W = H + 2 * config['extrapolation_thickness'], W + 2 * config['extrapolation_thickness']
-    LDI = netx.Graph(H=ext_H, W=ext_W, noext_H=H, noext_W=W, cam_param=int_mtx)
-    xy2depth = {}
-    int_mtx_pix = int_mtx * np.array([[W], [H], [1.]])
-    LDI.graph['cam_param_pix'], LDI.graph['cam_param_pix_inv'] = int_mtx_pix, np.linalg.inv(int_mtx_pix)
-    disp = 1. / (-depth)
-    LDI.graph['hoffset'], LDI.graph['woffset'] = config['extrapolation_thickness'], config['extrapolation_thickness']
-    LDI.graph['bord_up'], LDI.graph['bord_down'] = LDI.graph['hoffset'] + 0, LDI.graph['hoffset'] + H
-    LDI.graph['bord_left'], LDI.graph['bord_right'] = LDI.graph['woffset'] + 0, LDI.graph['woffset'] + W
-    for idx in range(H):
-        for idy in range(W):
-            x, y = idx + LDI.graph['hoffset'], idy + LDI.graph['woffset']
-            LDI.add_node((x, y, -depth[idx, idy]),
-                         color=image[idx, idy],
-                         disp=disp[idx, idy],
-                         synthesis=False,
-                         cc_id=set())
-            xy2depth[(x, y)] = [-depth[idx, idy]]
-    for x, y, d in LDI.nodes:
-        two_nes = [ne for ne in [(x + 1, y), (x, y + 1)] if
-                   ne[0] < LDI.graph['bord_down'] and ne[1] < LDI.graph['bord_right']]
-        [LDI.add_edge((ne[0], ne[1], xy2depth[ne][0]), (x, y, d)) for ne in two_nes]
-    LDI = calculate_fov(LDI)
-    image = np.pad(image,
-                   pad_width=((config['extrapolation_thickness'], config['extrapolation_thickness']),
-                              (config['extrapolation_thickness'], config['extrapolation_thickness']),
-                              (0, 0)),
-                   mode='constant')
-    depth = np.pad(depth,
-                   pad_width=((config['extrapolation_thickness'], config['extrapolation_thickness']),
-                              (config['extrapolation_thickness'], config['extrapolation_thickness'])),
-                   mode='constant')
-
-    return LDI, xy2depth, image, depth
-
-
-def tear_edges(mesh, threshold=0.00025, xy2depth=None):
-    remove_edge_list = []
-    remove_horizon, remove_vertical = np.zeros((2, mesh.graph['H'], mesh.graph['W']))
-    mesh_nodes = mesh.nodes
-    for edge in mesh.edges:
-        if abs(mesh_nodes[edge[0]]['disp'] - mesh_nodes[edge[1]]['disp']) > threshold:
-            remove_edge_list.append((edge[0], edge[1]))
-
-            near, far = edge if abs(edge[0][2]) < abs(edge[1][2]) else edge[::-1]
-
-            mesh_nodes[far]['near'] = [] if mesh_nodes[far].get('near') is None else mesh_nodes[far]['near'].append(
-                near)
-            mesh_nodes[near]['far'] = [] if mesh_nodes[near].get('far') is None else mesh_nodes[near]['far'].append(far)
-
-            if near[0] == far[0]:
-                remove_horizon[near[0], np.minimum(near[1], far[1])] = 1
-            elif near[1] == far[1]:
-                remove_vertical[np.minimum(near[0], far[0]), near[1]] = 1
-    mesh.remove_edges_from(remove_edge_list)
-
-    remove_edge_list = []
-
-    dang_horizon = np.where(np.roll(remove_horizon, 1, 0) + np.roll(remove_horizon, -1, 0) - remove_horizon == 2)
-    dang_vertical = np.where(np.roll(remove_vertical, 1, 1) + np.roll(remove_vertical, -1, 1) - remove_vertical == 2)
-
-    horizon_condition = lambda x, y: mesh.graph['bord_up'] + 1 <= x < mesh.graph['bord_down'] - 1
-    vertical_condition = lambda x, y: mesh.graph['bord_left'] + 1 <= y < mesh.graph['bord_right'] - 1
-
-    prjto3d = lambda x, y: (x, y, xy2depth[(x, y)][0])
-
-    node_existence = lambda x, y: mesh.has_node(prjto3d(x, y))
-
-    for x, y in zip(dang_horizon[0], dang_horizon[1]):
-        if horizon_condition(x, y) and node_existence(x, y) and node_existence(x, y + 1):
-            remove_edge_list.append((prjto3d(x, y), prjto3d(x, y + 1)))
-    for x, y in zip(dang_vertical[0], dang_vertical[1]):
-        if vertical_condition(x, y) and node_existence(x, y) and node_existence(x + 1, y):
-            remove_edge_list.append((prjto3d(x, y), prjto3d(x + 1, y)))
-    mesh.remove_edges_from(remove_edge_list)
-
-    return mesh
+class LayeredDepthImage:
+    """
+    Array-backed layered depth image for the first stages of write_ply:
+    the creation of the mesh, the tearing of the edges at the depth
+    discontinuities and the removal of the small connected components.
+
+    Each pixel is one node stored in (H, W) grids, and the 4-connectivity
+    is stored as two boolean grids: `down` for the edge between (x, y) and
+    (x + 1, y), and `right` for the edge between (x, y) and (x, y + 1).
+    The networkx graph is built only once, with the pixels kept after the
+    removal of the small connected components.
+    """
 
+    def __init__(self, depth, image, int_mtx, config):
+        H, W, C = image.shape
+        self.noext_H, self.noext_W = H, W
+        self.offset = config['extrapolation_thickness']
+        self.ext_H, self.ext_W = H + 2 * self.offset, W + 2 * self.offset
+        self.int_mtx = int_mtx
+        self.image = image
+        self.z = -depth
+        self.disp = 1. / (-depth)
+
+        self.down = np.zeros((H, W), dtype=bool)
+        self.down[:-1, :] = True
+        self.right = np.zeros((H, W), dtype=bool)
+        self.right[:, :-1] = True
+
+        # number of torn edges whose other end is nearer / farther, see
+        # tear_edges
+        self.near_count = np.zeros((H, W), dtype=np.int64)
+        self.far_count = np.zeros((H, W), dtype=np.int64)
+
+    def graph_attributes(self):
+        H, W = self.noext_H, self.noext_W
+        attr = dict(H=self.ext_H, W=self.ext_W, noext_H=H, noext_W=W, cam_param=self.int_mtx)
+        int_mtx_pix = self.int_mtx * np.array([[W], [H], [1.]])
+        attr['cam_param_pix'], attr['cam_param_pix_inv'] = int_mtx_pix, np.linalg.inv(int_mtx_pix)
+        attr['hoffset'], attr['woffset'] = self.offset, self.offset
+        attr['bord_up'], attr['bord_down'] = self.offset + 0, self.offset + H
+        attr['bord_left'], attr['bord_right'] = self.offset + 0, self.offset + W
+        k = self.int_mtx
+        attr['hFov'] = 2 * np.arctan(1. / (2 * k[0, 0]))
+        attr['vFov'] = 2 * np.arctan(1. / (2 * k[1, 1]))
+        attr['aspect'] = H / W
+        return attr
+
+    def tear_edges(self, threshold=0.00025):
+        """
+        Remove the edges whose disparity difference is above threshold, and
+        the dangling edges between two torn edges.
+        """
+        disp, z = self.disp, np.abs(self.z)
+        H, W = self.noext_H, self.noext_W
+
+        torn_down = np.zeros((H, W), dtype=bool)
+        torn_down[:-1] = self.down[:-1] & (np.abs(disp[:-1] - disp[1:]) > threshold)
+        torn_right = np.zeros((H, W), dtype=bool)
+        torn_right[:, :-1] = self.right[:, :-1] & (np.abs(disp[:, :-1] - disp[:, 1:]) > threshold)
+
+        # the first node of the edge is nearer if its depth is strictly
+        # smaller, else the second one
+        for torn, first, second in (
+                (torn_down, (slice(0, H - 1), slice(None)), (slice(1, H), slice(None))),
+                (torn_right, (slice(None), slice(0, W - 1)), (slice(None), slice(1, W)))):
+            t = torn[first]
+            first_near = z[first] < z[second]
+            self.far_count[first] += t & first_near
+            self.near_count[second] += t & first_near
+            self.near_count[first] += t & ~first_near
+            self.far_count[second] += t & ~first_near
+        self.down &= ~torn_down
+        self.right &= ~torn_right
+
+        # remove the dangling edges between two torn edges
+        o = self.offset
+        remove_horizon = np.zeros((self.ext_H, self.ext_W))
+        remove_vertical = np.zeros((self.ext_H, self.ext_W))
+        remove_horizon[o:o + H, o:o + W] = torn_right
+        remove_vertical[o:o + H, o:o + W] = torn_down
+        dang_horizon = np.roll(remove_horizon, 1, 0) + np.roll(remove_horizon, -1, 0) - remove_horizon == 2
+        dang_vertical = np.roll(remove_vertical, 1, 1) + np.roll(remove_vertical, -1, 1) - remove_vertical == 2
+        dang_horizon[:o + 1] = dang_horizon[o + H - 1:] = False
+        dang_vertical[:, :o + 1] = dang_vertical[:, o + W - 1:] = False
+        self.right &= ~dang_horizon[o:o + H, o:o + W]
+        self.down &= ~dang_vertical[o:o + H, o:o + W]
+
+    def padded_image_depth(self):
+        """The image and depth padded by the extrapolation area"""
+        o = self.offset
+        image = np.pad(self.image, pad_width=((o, o), (o, o), (0, 0)), mode='constant')
+        depth = np.pad(-self.z, pad_width=((o, o), (o, o)), mode='constant')
+        return image, depth
+
+    def generate_init_node(self, min_node_in_cc):
+        """
+        Remove the connected components of less than min_node_in_cc pixels,
+        found on the sparse adjacency of the grid, and build the networkx
+        graph of the kept pixels.
 
-def calculate_fov(mesh):
-    k = mesh.graph['cam_param']
-    mesh.graph['hFov'] = 2 * np.arctan(1. / (2 * k[0, 0]))
-    mesh.graph['vFov'] = 2 * np.arctan(1. / (2 * k[1, 1]))
-    mesh.graph['aspect'] = mesh.graph['noext_H'] / mesh.graph['noext_W']
+        Returns the networkx graph and info_on_pix.
+        """
+        H, W = self.noext_H, self.noext_W
+        n = H * W
+        ids = np.arange(n).reshape(H, W)
+        src = np.concatenate([ids[self.down], ids[self.right]])
+        dst = np.concatenate([ids[self.down] + W, ids[self.right] + 1])
+        adj = coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n)).tocsr()
+        _, labels = connected_components(adj, directed=False)
+        keep = (np.bincount(labels)[labels] >= min_node_in_cc).reshape(H, W)
+
+        mesh = netx.Graph(**self.graph_attributes())
+        o = self.offset
+        kx, ky = (a.tolist() for a in np.nonzero(keep))
+        z = list(self.z[keep])
+        disp = list(self.disp[keep])
+        color = list(self.image[keep])
+        near_count = self.near_count[keep].tolist()
+        far_count = self.far_count[keep].tolist()
+        keys = [(x + o, y + o, d) for x, y, d in zip(kx, ky, z)]
+
+        info_on_pix = {}
+
+        def nodes():
+            for i, key in enumerate(keys):
+                attr = dict(
+                    color=color[i],
+                    disp=disp[i],
+                    synthesis=False,
+                    cc_id=set())
+                # as upstream, 'near' / 'far' is [] after an odd number of
+                # torn edges and None after an even one
+                if near_count[i] > 0:
+                    attr['near'] = [] if near_count[i] % 2 == 1 else None
+                if far_count[i] > 0:
+                    attr['far'] = [] if far_count[i] % 2 == 1 else None
+                info_on_pix[(key[0], key[1])] = [{
+                    'depth': key[2],
+                    'color': color[i],
+                    'synthesis': False,
+                    'disp': disp[i]}]
+                yield key, attr
+
+        # the edges are added in raster order, down then right, as upstream,
+        # so that the neighbors of each node are iterated in the same order
+        index = np.full(n, -1, dtype=np.int64)
+        index[keep.ravel()] = np.arange(len(keys))
+        down = self.down & keep
+        down[:-1] &= keep[1:]
+        right = self.right & keep
+        right[:, :-1] &= keep[:, 1:]
+        edge_ids = np.stack([
+            np.where(down, ids + W, -1),
+            np.where(right, ids + 1, -1)], axis=-1).reshape(-1, 2)
+        src, k = np.nonzero(edge_ids >= 0)
+        src, dst = index[src].tolist(), index[edge_ids[src, k]].tolist()
+
+        # the collector would scan the growing graph again and again while
+        # the millions of node and edge containers are allocated
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            mesh.add_nodes_from(nodes())
+            mesh.add_edges_from((keys[u], keys[v]) for u, v in zip(src, dst))
+        finally:
+            if gc_enabled:
+                gc.enable()
 
-    return mesh
+        return mesh, info_on_pix
 
 
 def reproject_3d_int_detail(
@@ -2262,43 +2337,6 @@ def reproject_3d_int_detail(
     return [abs_z * ((sy + 0.5 - w_offset) * k_00 + k_02), abs_z * ((sx + 0.5 - h_offset) * k_11 + k_12), abs_z]
 
 
-def generate_init_node(mesh, min_node_in_cc):
-    mesh_nodes = mesh.nodes
-
-    info_on_pix = {}
-
-    ccs = sorted(netx.connected_components(mesh), key=len, reverse=True)
-    remove_nodes = []
-
-    for cc in ccs:
-
-        remove_flag = True if len(cc) < min_node_in_cc else False
-        if remove_flag is False:
-            for (nx, ny, nd) in cc:
-                info_on_pix[(nx, ny)] = [{'depth': nd,
-                                          'color': mesh_nodes[(nx, ny, nd)]['color'],
-                                          'synthesis': False,
-                                          'disp': mesh_nodes[(nx, ny, nd)]['disp']}]
-        else:
-            [remove_nodes.append((nx, ny, nd)) for (nx, ny, nd) in cc]
-
-    for node in remove_nodes:
-        far_nodes = [] if mesh_nodes[node].get('far') is None else mesh_nodes[node]['far']
-        for far_node in far_nodes:
-            if mesh.has_node(far_node) and mesh_nodes[far_node].get('near') is not None and node in \
-                    mesh_nodes[far_node]['near']:
-                mesh_nodes[far_node]['near'].remove(node)
-        near_nodes = [] if mesh_nodes[node].get('near') is None else mesh_nodes[node]['near']
-        for near_node in near_nodes:
-            if mesh.has_node(near_node) and mesh_nodes[near_node].get('far') is not None and node in \
-                    mesh_nodes[near_node]['far']:
-                mesh_nodes[near_node]['far'].remove(node)
-
-    [mesh.remove_node(node) for node in remove_nodes]
-
-    return mesh, info_on_pix
-
-
 def get_neighbors(mesh, node):
     return [*mesh.neighbors(node)]
 
@@ -4000,11 +4038,14 @@ def write_ply(image,
               depth_edge_model_init,
               depth_feat_model):
     depth = depth.astype(np.float64)
-    input_mesh, xy2depth, image, depth = create_mesh(depth, image, int_mtx, config)
+    # create the mesh and remove the small components on the grid arrays
+    ldi = LayeredDepthImage(depth, image, int_mtx, config)
+    ldi.tear_edges(config['depth_threshold'])
+    input_mesh, info_on_pix = ldi.generate_init_node(min_node_in_cc=200)
+    image, depth = ldi.padded_image_depth()
+    del ldi
 
     H, W = input_mesh.graph['H'], input_mesh.graph['W']
-    input_mesh = tear_edges(input_mesh, config['depth_threshold'], xy2depth)
-    input_mesh, info_on_pix = generate_init_node(input_mesh, min_node_in_cc=200)
     edge_ccs, input_mesh, edge_mesh = group_edges(
         input_mesh, config, image, remove_conflict_ordinal=False)
 
@@ -28,6 +28,26 @@ parser.add_argument(
 parser.add_argument(
     '--outlength', '-o', default=30
 )
+parser.add_argument(
+    '--prompts', metavar='TEXT_FILE', default=None,
+    help='text file of prompts (one per line), which are generated in one batch.'
+)
+parser.add_argument(
+    '--top_k', type=int, default=0,
+    help='sample from the top k tokens (0 to disable).'
+)
+parser.add_argument(
+    '--top_p', type=float, default=1.0,
+    help='sample from the smallest set of tokens whose cumulative probability exceeds top_p.'
+)
+parser.add_argument(
+    '--temperature', type=float, default=1.0,
+    help='temperature of the sampling.'
+)
+parser.add_argument(
+    '--seed', type=int, default=None,
+    help='random seed of the sampling.'
+)
 parser.add_argument(
     '--onnx',
     action='store_true',
@@ -57,20 +77,35 @@ def main():
         logger.info("This model requires multiple input shape, so running on CPU")
         ailia_model = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=0)#args.env_id)
     tokenizer = AutoTokenizer.from_pretrained("gpt2-medium")
-    logger.info("Input : "+args.input)
+
+    if args.prompts:
+        with open(args.prompts) as f:
+            spans = [line.rstrip('\n') for line in f if line.strip()]
+    else:
+        spans = [args.input]
+    for span in spans:
+        logger.info("Input : "+span)
+
+    options = {
+        'top_k': args.top_k,
+        'top_p': args.top_p,
+        'temperature': args.temperature,
+        'seed': args.seed,
+    }
 
     # inference
     if args.benchmark:
         logger.info('BENCHMARK mode')
         for i in range(5):
             start = int(round(time.time() * 1000))
-            output = generate_text(tokenizer, ailia_model, args.input, int(args.outlength), args.onnx)
+            outputs = generate_texts(tokenizer, ailia_model, spans, int(args.outlength), args.onnx, **options)
             end = int(round(time.time() * 1000))
             logger.info("\tailia processing time {} ms".format(end - start))
     else:
-        output = generate_text(tokenizer, ailia_model, args.input, int(args.outlength), args.onnx)
+        outputs = generate_texts(tokenizer, ailia_model, spans, int(args.outlength), args.onnx, **options)
 
-    logger.info("output : "+output)
+    for output in outputs:
+        logger.info("output : "+output)
     logger.info('Script finished successfully.')
 
 
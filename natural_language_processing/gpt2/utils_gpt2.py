@@ -1,36 +1,138 @@
 import numpy as np
 
 
-def generate_text(tokenizer, ailia_model, span, outputlength, onnx_runtime=False):
-    model_input = tokenizer.encode_plus(span)
-    model_input = {name : np.atleast_2d(value) for name, value in model_input.items()}
-
-    model_input['input_ids'] = np.array(model_input['input_ids'], dtype='int64')
-    model_input['attention_mask'] = np.array(model_input['attention_mask'], dtype='int64')
-
+def run_model(ailia_model, model_input, onnx_runtime=False):
     if onnx_runtime:
-      onnx_result = ailia_model.run(None,model_input)
+      return ailia_model.run(None, model_input)
     else:
-      onnx_result = ailia_model.run(model_input)
+      return ailia_model.run(model_input)
+
+
+def softmax(x):
+    x = x - np.max(x, axis=-1, keepdims=True)
+    e = np.exp(x)
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+def select_tokens(logits, outputlength, top_k=0, top_p=1.0, temperature=1.0, rng=None):
+    """
+    Select the next token of each row from logits (batch, vocab).
+
+    When neither top_k nor top_p is given, the first element of the top
+    outputlength candidates is taken as in the original implementation.
+    Otherwise the token is sampled from the top-k / nucleus (top-p) filtered
+    distribution.
+    """
+    if top_k <= 0 and top_p >= 1.0:
+      K = outputlength
+      return np.array([np.argpartition(-l, K)[:K][0] for l in logits])
+
+    rng = rng if rng is not None else np.random
+    logits = logits.astype(np.float64) / max(temperature, 1e-5)
+
+    if top_k > 0 and top_k < logits.shape[-1]:
+      kth = np.partition(logits, -top_k, axis=-1)[:, [-top_k]]
+      logits = np.where(logits < kth, -np.inf, logits)
+
+    probs = softmax(logits)
+
+    if top_p < 1.0:
+      order = np.argsort(-probs, axis=-1)
+      sorted_probs = np.take_along_axis(probs, order, axis=-1)
+      cum_probs = np.cumsum(sorted_probs, axis=-1)
+      # keep the smallest set whose cumulative probability exceeds top_p
+      remove = (cum_probs - sorted_probs) > top_p
+      sorted_probs[remove] = 0
+      probs = np.zeros_like(probs)
+      np.put_along_axis(probs, order, sorted_probs, axis=-1)
+      probs = probs / np.sum(probs, axis=-1, keepdims=True)
+
+    cum_probs = np.cumsum(probs, axis=-1)
+    r = rng.random_sample((probs.shape[0], 1))
+    index = np.sum(cum_probs < r, axis=-1)
+    return np.minimum(index, probs.shape[-1] - 1)
+
+
+def encode_prompts(tokenizer, spans):
+    ids = [tokenizer.encode(span) for span in spans]
+    lengths = np.array([len(x) for x in ids], dtype='int64')
+    max_len = int(np.max(lengths))
+
+    input_ids = np.zeros((len(ids), max_len), dtype='int64')
+    attention_mask = np.zeros((len(ids), max_len), dtype='int64')
+    for i, x in enumerate(ids):
+      input_ids[i, :len(x)] = x
+      attention_mask[i, :len(x)] = 1
 
-    out_str = span
+    return input_ids, attention_mask, lengths
+
+
+def generate_texts(
+        tokenizer, ailia_model, spans, outputlength, onnx_runtime=False,
+        top_k=0, top_p=1.0, temperature=1.0, seed=None):
+    """
+    Generate the continuation of each prompt in spans in one batch.
+    """
+    rng = np.random.RandomState(seed)
+
+    def select(logits):
+      return select_tokens(
+        logits, outputlength, top_k=top_k, top_p=top_p,
+        temperature=temperature, rng=rng)
+
+    tokens = generate_tokens(
+      tokenizer, ailia_model, spans, outputlength, select, onnx_runtime)
+
+    out_strs = []
+    for span, row in zip(spans, tokens):
+      out_str = span
+      for token in row:
+        out_str += token.replace('Ġ',' ')
+      out_strs.append(out_str)
+
+    return out_strs
+
+
+def generate_tokens(tokenizer, ailia_model, spans, outputlength, select, onnx_runtime=False):
+    # prompts are right padded, so that the positions of each row start at 0
+    input_ids, attention_mask, lengths = encode_prompts(tokenizer, spans)
+
+    B = len(spans)
+    total = input_ids.shape[1] + outputlength
+    buf_ids = np.zeros((B, total), dtype='int64')
+    buf_mask = np.zeros((B, total), dtype='int64')
+    buf_ids[:, :input_ids.shape[1]] = input_ids
+    buf_mask[:, :input_ids.shape[1]] = attention_mask
+
+    tokens = [[] for _ in range(B)]
+    finished = np.zeros(B, dtype=bool)
+    rows = np.arange(B)
     for i in range(outputlength):
-      K=outputlength
-      predictions = np.argpartition(-onnx_result[0][0, -1], K)[:K]
-      index = predictions[0]
-      token = tokenizer.convert_ids_to_tokens([index])[0]
-      out_str += token.replace('Ġ',' ')
-      trim = 0
-      input = np.append(model_input['input_ids'][:,trim:], index)
-      model_input['input_ids'] = np.expand_dims(input, 0)
-      attention_mask = np.append(model_input['attention_mask'][:,trim:], 1)
-      model_input['attention_mask'] = np.expand_dims(attention_mask, 0)
-      if onnx_runtime:
-        onnx_result = ailia_model.run(None,model_input)
-      else:
-        onnx_result = ailia_model.run(model_input)
-
-      if token == "<unk>":
+      # the model has no key/value cache, so the whole prefix is run again
+      cur = int(np.max(lengths))
+      model_input = {
+        'input_ids': buf_ids[:, :cur],
+        'attention_mask': buf_mask[:, :cur],
+      }
+      onnx_result = run_model(ailia_model, model_input, onnx_runtime)
+
+      index = select(onnx_result[0][rows, lengths - 1])
+      for b in np.where(~finished)[0]:
+        token = tokenizer.convert_ids_to_tokens([int(index[b])])[0]
+        tokens[b].append(token)
+        if token == "<unk>":
+          finished[b] = True
+      if np.all(finished):
         break
 
-    return out_str
\ No newline at end of file
+      active = rows[~finished]
+      buf_ids[active, lengths[active]] = index[active]
+      buf_mask[active, lengths[active]] = 1
+      lengths[active] += 1
+
+    return tokens
+
+
+def generate_text(tokenizer, ailia_model, span, outputlength, onnx_runtime=False, **kwargs):
+    return generate_texts(
+      tokenizer, ailia_model, [span], outputlength, onnx_runtime, **kwargs)[0]
@@ -34,8 +34,29 @@ class Embedder:
         self.embed_fns = embed_fns
         self.out_dim = out_dim
 
+        # tables used by embed, computed once instead of per call
+        self.freq_bands = freq_bands.reshape(1, -1, 1)
+        self.periodic_fns = self.kwargs['periodic_fns']
+        self.include_input = self.kwargs['include_input']
+
     def embed(self, inputs):
-        return np.concatenate([fn(inputs) for fn in self.embed_fns], -1)
+        # [x, p0(f0 x), p1(f0 x), p0(f1 x), ...] written into one buffer,
+        # same layout as concatenating embed_fns
+        inputs = np.asarray(inputs, dtype=np.float32)
+        n, d = inputs.shape[0], inputs.shape[-1]
+        out = np.empty((n, self.out_dim), dtype=np.float32)
+
+        start = 0
+        if self.include_input:
+            out[:, :d] = inputs
+            start = d
+
+        xf = inputs[:, None, :] * self.freq_bands  # [N, N_freqs, d]
+        view = out[:, start:].reshape(n, -1, len(self.periodic_fns), d)
+        for k, p_fn in enumerate(self.periodic_fns):
+            p_fn(xf, out=view[:, :, k, :])
+
+        return out
 
 
 def get_embedder(multires, i=0):
@@ -56,12 +77,24 @@ def get_embedder(multires, i=0):
     return embed, embedder_obj.out_dim
 
 # Ray helpers
+_camera_dirs = {}
+
+
+def get_camera_dirs(H, W, focal):
+    """Pixel directions in camera space, cached for each resolution."""
+    key = (H, W, focal)
+    if key not in _camera_dirs:
+        i, j = np.meshgrid(np.arange(W, dtype=np.float32),
+                           np.arange(H, dtype=np.float32), indexing='xy')
+        _camera_dirs[key] = np.stack(
+            [(i-W*.5)/focal, -(j-H*.5)/focal, -np.ones_like(i)], -1)
+    return _camera_dirs[key]
+
+
 def get_rays_np(H, W, focal, c2w):
     """Get ray origins, directions from a pinhole camera."""
-    i, j = np.meshgrid(np.arange(W, dtype=np.float32),
-                       np.arange(H, dtype=np.float32), indexing='xy')
-    dirs = np.stack([(i-W*.5)/focal, -(j-H*.5)/focal, -np.ones_like(i)], -1)
-    rays_d = np.sum(dirs[..., np.newaxis, :] * c2w[:3, :3], -1)
+    dirs = get_camera_dirs(H, W, focal)
+    rays_d = dirs @ c2w[:3, :3].T
     rays_o = np.broadcast_to(c2w[:3, -1], np.shape(rays_d))
     return rays_o, rays_d
 
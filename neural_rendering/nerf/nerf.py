@@ -1,4 +1,7 @@
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import imageio
 import cv2
@@ -44,8 +47,10 @@ parser = get_base_parser(
 )
 
 # ailia options
-parser.add_argument('-a', '--angle', default=0, type=int, help='Rendering angle (0 - 120)')
+parser.add_argument('-a', '--angle', default=0, type=int, help='Rendering angle (0 - 120), -1 renders all angles')
 parser.add_argument('--onnx', action='store_true', help='execute onnxruntime version.')
+parser.add_argument('--processes', default=0, type=int,
+                    help='number of processes rendering different angles in parallel (0: disabled)')
 
 # angle options
 parser.add_argument("--datadir", type=str,
@@ -106,7 +111,7 @@ args = update_parser(parser)
 # ======================
 # Main functions
 # ======================
-def main():
+def create_render_kwargs():
     # net initialize
     if args.onnx:
         import onnxruntime
@@ -114,12 +119,6 @@ def main():
     else:
         net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
 
-    # load angles
-    render_poses = load_llff_data(args.datadir, args.factor,
-                                    recenter=True, bd_factor=.75,
-                                    spherify=args.spherify,
-                                    image_shape=(H, W, C))
-
     # create nerf instance
     render_kwargs = utils_nerf.create_nerf(args, net)
     bds_dict = {
@@ -131,26 +130,75 @@ def main():
     render_kwargs_fast = {k : render_kwargs[k] for k in render_kwargs}
     render_kwargs_fast['N_importance'] = 0
 
+    return render_kwargs_fast
+
+
+def render_angle(c2w, render_kwargs):
+    down = args.render_factor
+    test = utils_nerf.render(int(H) // down, int(W) // down, focal / down, c2w=c2w[:3, :4], **render_kwargs)
+    frame = (255 * np.clip(test[0], 0, 1)).astype(np.uint8)
+    return frame
+
+
+# each process of the pool creates its own net
+_worker_render_kwargs = None
+
+
+def init_worker():
+    global _worker_render_kwargs
+    _worker_render_kwargs = create_render_kwargs()
+
+
+def render_angle_worker(c2w):
+    return render_angle(c2w, _worker_render_kwargs)
+
+
+def save_frame(frame, savepath):
+    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+    logger.info(f'saved at : {savepath}')
+    cv2.imwrite(savepath, frame)
+
+
+def main():
+    # load angles
+    render_poses = load_llff_data(args.datadir, args.factor,
+                                    recenter=True, bd_factor=.75,
+                                    spherify=args.spherify,
+                                    image_shape=(H, W, C))
+
     down = args.render_factor
 
     # display rendering information
     logger.info("Rendering angles "+str(len(render_poses)))
     logger.info("Rendering resolution "+str(int(W) // down)+"x"+str(int(H) // down))
 
+    if args.angle < 0:
+        angles = list(range(len(render_poses)))
+    else:
+        angles = [args.angle]
+
     # rendering
-    frames = []
-    for i, c2w in enumerate(render_poses):
-        if i!=args.angle:
-            continue
-
-        logger.info("Rendering angle "+str(i))
-        test = utils_nerf.render(int(H) // down, int(W) // down, focal / down, c2w=c2w[:3, :4], **render_kwargs_fast)
-        frame = (255 * np.clip(test[0], 0, 1)).astype(np.uint8)
-        frames.append(frame)
-
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        logger.info(f'saved at : {args.savepath}')
-        cv2.imwrite(args.savepath,frame)
+    if args.processes > 0 and len(angles) > 1:
+        logger.info("Rendering angles with %d processes" % args.processes)
+        with ProcessPoolExecutor(args.processes, initializer=init_worker) as pool:
+            frames = list(pool.map(
+                render_angle_worker, [render_poses[i] for i in angles]))
+    else:
+        render_kwargs_fast = create_render_kwargs()
+        frames = []
+        for i in angles:
+            logger.info("Rendering angle "+str(i))
+            frames.append(render_angle(render_poses[i], render_kwargs_fast))
+
+    if len(angles) == 1:
+        save_frame(frames[0], args.savepath)
+    else:
+        root, ext = os.path.splitext(args.savepath)
+        for i, frame in zip(angles, frames):
+            save_frame(frame, '%s_%03d%s' % (root, i, ext))
+        savepath = root + '.gif'
+        imageio.mimwrite(savepath, frames)
+        logger.info(f'saved at : {savepath}')
 
     # finish
     logger.info('Script finished successfully.')
@@ -6,12 +6,22 @@ def batchify(fn, chunk):
     if chunk is None:
         return fn
 
+    if "onnxruntime" in str(type(fn)):
+        def run(x): return fn.run(None, {"input_1": x})[0]
+    else:
+        def run(x): return fn.run(x)[0]
+
     def ret(inputs):
-        inputs = np.array(inputs, dtype=np.float32)
-        if "onnxruntime" in str(type(fn)):
-            return np.concatenate([fn.run(None,{"input_1":np.array(inputs[i:i+chunk])})[0] for i in range(0, inputs.shape[0], chunk)], 0)
-        else:
-            return np.concatenate([fn.run(np.array(inputs[i:i+chunk]))[0] for i in range(0, inputs.shape[0], chunk)], 0)
+        inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+        n = inputs.shape[0]
+        out = None
+        for i in range(0, n, chunk):
+            y = run(inputs[i:i+chunk])
+            if out is None:
+                # output buffer is allocated once from the first chunk
+                out = np.empty((n,) + y.shape[1:], dtype=y.dtype)
+            out[i:i+y.shape[0]] = y
+        return out
     return ret
 
 
@@ -22,10 +32,16 @@ def run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024*64):
 
     embedded = embed_fn(inputs_flat)
     if viewdirs is not None:
-        input_dirs = np.broadcast_to(viewdirs[:, None], inputs.shape)
-        input_dirs_flat = np.reshape(input_dirs, [-1, input_dirs.shape[-1]])
-        embedded_dirs = embeddirs_fn(input_dirs_flat)
-        embedded = np.concatenate([embedded, embedded_dirs], -1)
+        # all samples of a ray share the view direction, so it is encoded
+        # once per ray and broadcast to the samples
+        embedded_dirs = embeddirs_fn(viewdirs)
+        n_rays, n_samples = inputs.shape[:2]
+        dim = embedded.shape[-1]
+        buf = np.empty(
+            (n_rays, n_samples, dim + embedded_dirs.shape[-1]), dtype=np.float32)
+        buf[..., :dim] = embedded.reshape(n_rays, n_samples, dim)
+        buf[..., dim:] = embedded_dirs[:, None]
+        embedded = buf.reshape(n_rays * n_samples, -1)
 
     outputs_flat = batchify(fn, netchunk)(embedded)
     outputs = np.reshape(outputs_flat, list(
@@ -73,7 +89,7 @@ def render_rays(ray_batch,
         # regularize network during training (prevents floater artifacts).
         noise = 0.
         if raw_noise_std > 0.:
-            noise = np.random.normal(raw[..., 3].shape) * raw_noise_std
+            noise = np.random.normal(size=raw[..., 3].shape) * raw_noise_std
 
         # Predict density of each sample along each ray. Higher values imply
         # higher likelihood of being absorbed at this point.
@@ -83,23 +99,10 @@ def render_rays(ray_batch,
         # used to express the idea of the ray not having reflected up to this
         # sample yet.
         # [N_rays, N_samples]
-
-        def cumprod(array):
-            out_list = []
-            for i in range(array.shape[0]):
-                if i == 0:
-                    out = 1
-                else:
-                    out = 1
-                    for s in array[:i]:
-                        out *= s
-                out_list.append(out)
-            return out_list
-
-        cum = np.cumprod(1. - alpha + 1e-10, axis=-1)
-        cum[:, 1:] = cum[:, :-1]
-        cum[:, 0] = 1
-        weights = alpha * cum
+        trans = np.empty_like(alpha)
+        trans[:, 0] = 1
+        np.cumprod(1. - alpha[:, :-1] + 1e-10, axis=-1, out=trans[:, 1:])
+        weights = alpha * trans
 
 
         # Computed weighted color of each sample along each ray.
@@ -155,7 +158,7 @@ def render_rays(ray_batch,
         upper = np.concatenate([mids, z_vals[..., -1:]], -1)
         lower = np.concatenate([z_vals[..., :1], mids], -1)
         # stratified samples in those intervals
-        t_rand = np.random.uniform(z_vals.shape)
+        t_rand = np.random.uniform(size=z_vals.shape)
         z_vals = lower + (upper - lower) * t_rand
 
     # Points in space to evaluate model at.
@@ -176,15 +179,16 @@ def render_rays(ray_batch,
 
 def batchify_rays(rays_flat, chunk=1024*32, **kwargs):
     """Render rays in smaller minibatches to avoid OOM."""
+    n = rays_flat.shape[0]
     all_ret = {}
-    for i in range(0, rays_flat.shape[0], chunk):
+    for i in range(0, n, chunk):
         ret = render_rays(rays_flat[i:i+chunk], **kwargs)
         for k in ret:
             if k not in all_ret:
-                all_ret[k] = []
-            all_ret[k].append(ret[k])
+                # output buffers are allocated once from the first chunk
+                all_ret[k] = np.empty((n,) + ret[k].shape[1:], dtype=ret[k].dtype)
+            all_ret[k][i:i+ret[k].shape[0]] = ret[k]
 
-    all_ret = {k: np.concatenate(all_ret[k], 0) for k in all_ret}
     return all_ret
 
 
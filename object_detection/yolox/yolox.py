@@ -180,18 +180,13 @@ def recognize_from_video(detector):
         writer = None
 
     if args.write_prediction:
-        frame_count = 0
         frame_digit = int(math.log10(capture.get(cv2.CAP_PROP_FRAME_COUNT)) + 1)
         video_name = os.path.splitext(os.path.basename(args.video))[0]
 
-    frame_shown = False
-    while (True):
-        ret, frame = capture.read()
-        if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
-            break
-        if frame_shown and cv2.getWindowProperty('frame', cv2.WND_PROP_VISIBLE) == 0:
-            break
+    frame_count = 0
 
+    def process_frame(frame):
+        nonlocal frame_count
         raw_img = frame
         if args.detector:
             detector.compute(raw_img, args.threshold, args.iou)
@@ -204,12 +199,6 @@ def recognize_from_video(detector):
             detect_object = predictions_to_object(predictions, raw_img, ratio, args.iou, args.threshold)
             detect_object = reverse_letterbox(detect_object, raw_img, (raw_img.shape[0], raw_img.shape[1]))
             res_img = plot_results(detect_object, raw_img, COCO_CATEGORY)
-        cv2.imshow('frame', res_img)
-        frame_shown = True
-
-        # save results
-        if writer is not None:
-            writer.write(res_img)
 
         # write prediction
         if args.write_prediction:
@@ -218,6 +207,13 @@ def recognize_from_video(detector):
             write_predictions(pred_file, detect_object, frame, COCO_CATEGORY)
             frame_count += 1
 
+        return res_img
+
+    # decode, inference and encode run in a pipeline
+    # (the latest frames are processed in webcam mode)
+    policy = 'drop_oldest' if args.video.isdigit() else 'block'
+    webcamera_utils.run_video_pipeline(capture, process_frame, writer, policy=policy)
+
     capture.release()
     cv2.destroyAllWindows()
     if writer is not None:
@@ -1,16 +1,21 @@
+import os
+import sys
+
 import numpy as np
 
-from .kalman_filter import KalmanFilter
-from .basetrack import BaseTrack, TrackState
-from . import matching
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../../util'))
+from kalman_utils import KalmanTrackStore, KalmanStateMixin  # noqa: E402
+from .kalman_filter import KalmanFilter  # noqa: E402
+from .basetrack import BaseTrack, TrackState  # noqa: E402
+from . import matching  # noqa: E402
 
 
-class STrack(BaseTrack):
+class STrack(BaseTrack, KalmanStateMixin):
     shared_kalman = KalmanFilter()
 
     def __init__(self, tlwh, score):
         # wait activate
-        self._tlwh = np.asarray(tlwh, dtype=np.float)
+        self._tlwh = np.asarray(tlwh, dtype=np.float64)
         self.kalman_filter = None
         self.mean, self.covariance = None, None
         self.is_activated = False
@@ -27,6 +32,15 @@ class STrack(BaseTrack):
     @staticmethod
     def multi_predict(stracks):
         if len(stracks) > 0:
+            store = stracks[0].store
+            if store is not None and all(st.store is store for st in stracks):
+                # predict all the states in place in the track store
+                slots = np.array([st.slot for st in stracks])
+                not_tracked = np.array([st.state != TrackState.Tracked for st in stracks])
+                store.mean[slots[not_tracked], 7] = 0
+                store.predict(slots)
+                return
+
             multi_mean = np.asarray([st.mean.copy() for st in stracks])
             multi_covariance = np.asarray([st.covariance for st in stracks])
             for i, st in enumerate(stracks):
@@ -37,6 +51,15 @@ class STrack(BaseTrack):
                 stracks[i].mean = mean
                 stracks[i].covariance = cov
 
+    @staticmethod
+    def multi_update(stracks, new_tracks):
+        """Kalman update of the tracks attached to a store with the matched detections"""
+        if len(stracks) > 0:
+            store = stracks[0].store
+            store.update(
+                [st.slot for st in stracks],
+                [STrack.tlwh_to_xyah(t.tlwh) for t in new_tracks])
+
     def activate(self, kalman_filter, frame_id):
         """Start a new tracklet"""
         self.kalman_filter = kalman_filter
@@ -51,10 +74,11 @@ class STrack(BaseTrack):
         self.frame_id = frame_id
         self.start_frame = frame_id
 
-    def re_activate(self, new_track, frame_id, new_id=False):
-        self.mean, self.covariance = self.kalman_filter.update(
-            self.mean, self.covariance, self.tlwh_to_xyah(new_track.tlwh)
-        )
+    def re_activate(self, new_track, frame_id, new_id=False, filtered=False):
+        if not filtered:
+            self.mean, self.covariance = self.kalman_filter.update(
+                self.mean, self.covariance, self.tlwh_to_xyah(new_track.tlwh)
+            )
         self.tracklet_len = 0
         self.state = TrackState.Tracked
         self.is_activated = True
@@ -63,20 +87,21 @@ class STrack(BaseTrack):
             self.track_id = self.next_id()
         self.score = new_track.score
 
-    def update(self, new_track, frame_id):
+    def update(self, new_track, frame_id, filtered=False):
         """
         Update a matched track
         :type new_track: STrack
         :type frame_id: int
-        :type update_feature: bool
+        :type filtered: bool, the state has already been updated by multi_update
         :return:
         """
         self.frame_id = frame_id
         self.tracklet_len += 1
 
-        new_tlwh = new_track.tlwh
-        self.mean, self.covariance = self.kalman_filter.update(
-            self.mean, self.covariance, self.tlwh_to_xyah(new_tlwh))
+        if not filtered:
+            new_tlwh = new_track.tlwh
+            self.mean, self.covariance = self.kalman_filter.update(
+                self.mean, self.covariance, self.tlwh_to_xyah(new_tlwh))
         self.state = TrackState.Tracked
         self.is_activated = True
 
@@ -149,6 +174,7 @@ class BYTETracker(object):
         self.max_time_lost = self.buffer_size
         self.mot20 = mot20
         self.kalman_filter = KalmanFilter()
+        self.store = KalmanTrackStore()
 
     def update(self, output_results):
         self.frame_id += 1
@@ -201,14 +227,17 @@ class BYTETracker(object):
 
         matches, u_track, u_detection = matching.linear_assignment(dists, thresh=self.match_thresh)
 
+        STrack.multi_update(
+            [strack_pool[itracked] for itracked, _ in matches],
+            [detections[idet] for _, idet in matches])
         for itracked, idet in matches:
             track = strack_pool[itracked]
             det = detections[idet]
             if track.state == TrackState.Tracked:
-                track.update(detections[idet], self.frame_id)
+                track.update(detections[idet], self.frame_id, filtered=True)
                 activated_starcks.append(track)
             else:
-                track.re_activate(det, self.frame_id, new_id=False)
+                track.re_activate(det, self.frame_id, new_id=False, filtered=True)
                 refind_stracks.append(track)
 
         ''' Step 3: Second association, with low score detection boxes'''
@@ -222,14 +251,17 @@ class BYTETracker(object):
         r_tracked_stracks = [strack_pool[i] for i in u_track if strack_pool[i].state == TrackState.Tracked]
         dists = matching.iou_distance(r_tracked_stracks, detections_second)
         matches, u_track, u_detection_second = matching.linear_assignment(dists, thresh=0.5)
+        STrack.multi_update(
+            [r_tracked_stracks[itracked] for itracked, _ in matches],
+            [detections_second[idet] for _, idet in matches])
         for itracked, idet in matches:
             track = r_tracked_stracks[itracked]
             det = detections_second[idet]
             if track.state == TrackState.Tracked:
-                track.update(det, self.frame_id)
+                track.update(det, self.frame_id, filtered=True)
                 activated_starcks.append(track)
             else:
-                track.re_activate(det, self.frame_id, new_id=False)
+                track.re_activate(det, self.frame_id, new_id=False, filtered=True)
                 refind_stracks.append(track)
 
         for it in u_track:
@@ -246,8 +278,11 @@ class BYTETracker(object):
 
         matches, u_unconfirmed, u_detection = matching.linear_assignment(dists, thresh=0.7)
 
+        STrack.multi_update(
+            [unconfirmed[itracked] for itracked, _ in matches],
+            [detections[idet] for _, idet in matches])
         for itracked, idet in matches:
-            unconfirmed[itracked].update(detections[idet], self.frame_id)
+            unconfirmed[itracked].update(detections[idet], self.frame_id, filtered=True)
             activated_starcks.append(unconfirmed[itracked])
         for it in u_unconfirmed:
             track = unconfirmed[it]
@@ -260,6 +295,7 @@ class BYTETracker(object):
             if track.score < self.det_thresh:
                 continue
             track.activate(self.kalman_filter, self.frame_id)
+            track.attach(self.store)
             activated_starcks.append(track)
         """ Step 5: Update state"""
         for track in self.lost_stracks:
@@ -277,6 +313,8 @@ class BYTETracker(object):
         self.lost_stracks = sub_stracks(self.lost_stracks, self.removed_stracks)
         self.removed_stracks.extend(removed_stracks)
         self.tracked_stracks, self.lost_stracks = remove_duplicate_stracks(self.tracked_stracks, self.lost_stracks)
+        # free the store slots of the tracks no longer followed
+        self.store.retain(self.tracked_stracks + self.lost_stracks)
 
         # get scores of lost tracks
         output_stracks = [track for track in self.tracked_stracks if track.is_activated]
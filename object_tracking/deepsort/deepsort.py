@@ -5,12 +5,12 @@ import numpy as np
 import cv2
 
 import ailia
-from sort.tracker import Tracker
-from sort.nn_matching import NearestNeighborDistanceMetric
-from deepsort_utils import *
 
 # import original modules
 sys.path.append('../../util')
+from sort.tracker import Tracker  # noqa: E402
+from sort.nn_matching import NearestNeighborDistanceMetric  # noqa: E402
+from deepsort_utils import *  # noqa: E402
 from utils import get_base_parser, update_parser  # noqa: E402
 from image_utils import normalize_image  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
@@ -73,6 +73,10 @@ parser.add_argument(
     help=('If this option is specified, the model is set to determine '
           'if the person in two images is the same person or not.')
 )
+parser.add_argument(
+    '--stage_time', action='store_true',
+    help='report the processing time of each stage (detector, extractor, tracker).'
+)
 args = update_parser(parser)
 
 
@@ -106,7 +110,10 @@ def recognize_from_video():
 
     # net initialize
     detector = init_detector(args.env_id)
-    extractor = ailia.Net(EX_MODEL_PATH, EX_WEIGHT_PATH, env_id=args.env_id)
+    extractor = BatchExtractor(
+        lambda: ailia.Net(EX_MODEL_PATH, EX_WEIGHT_PATH, env_id=args.env_id)
+    )
+    timer = StageTimer(('detector', 'extractor', 'tracker'))
 
     # tracker class instance
     metric = NearestNeighborDistanceMetric(
@@ -141,6 +148,8 @@ def recognize_from_video():
         if frame_shown and cv2.getWindowProperty('frame', cv2.WND_PROP_VISIBLE) == 0:
             break
 
+        timer.start()
+
         # In order to use ailia.Detector, the input should have 4 channels.
         input_img = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
         h, w = frame.shape[0], frame.shape[1]
@@ -148,6 +157,7 @@ def recognize_from_video():
         # do detection
         detector.compute(input_img, THRESHOLD, IOU)
         bbox_xywh, cls_conf, cls_ids = get_detector_result(detector, h, w)
+        timer.stop('detector')
 
         # select person class
         mask = cls_ids == 0
@@ -172,14 +182,11 @@ def recognize_from_video():
                 for img in img_crops
             ], axis=0).transpose(0, 3, 1, 2)
 
-            # TODO better to pass a batch at once
-            # features = extractor.predict(img_batch)
-            features = []
-            for img in img_batch:
-                features.append(extractor.predict(img[np.newaxis, :, :, :])[0])
-            features = np.array(features)
+            # all the crops of the frame are passed at once
+            features = extractor.predict(img_batch)
         else:
             features = np.array([])
+        timer.stop('extractor')
 
         bbox_tlwh = xywh_to_tlwh(bbox_xywh)
         detections = [
@@ -197,6 +204,10 @@ def recognize_from_video():
         # update tracker
         tracker.predict()
         tracker.update(detections)
+        timer.stop('tracker')
+        timer.next_frame()
+        if args.stage_time:
+            logger.info(f'\tframe {idx_frame} ({len(img_crops)} persons): {timer.frame_report()}')
 
         # update bbox identities
         outputs = []
@@ -206,7 +217,7 @@ def recognize_from_video():
             box = track.to_tlwh()
             x1, y1, x2, y2 = tlwh_to_xyxy(box, h, w)
             track_id = track.track_id
-            outputs.append(np.array([x1, y1, x2, y2, track_id], dtype=np.int))
+            outputs.append(np.array([x1, y1, x2, y2, track_id], dtype=np.int64))
         if len(outputs) > 0:
             outputs = np.stack(outputs, axis=0)
 
@@ -238,6 +249,9 @@ def recognize_from_video():
     if writer is not None:
         writer.release()
 
+    if args.stage_time:
+        logger.info(f'average time per frame: {timer.summary_report()}')
+
     logger.info(f'Save results to {args.savepath}')
     logger.info('Script finished successfully.')
 
@@ -1,3 +1,5 @@
+import time
+
 import cv2
 import numpy as np
 from PIL import Image
@@ -28,7 +30,7 @@ class Detection(object):
     """
 
     def __init__(self, tlwh, confidence, feature):
-        self.tlwh = np.asarray(tlwh, dtype=np.float)
+        self.tlwh = np.asarray(tlwh, dtype=np.float64)
         self.confidence = float(confidence)
         self.feature = np.asarray(feature, dtype=np.float32)
 
@@ -166,7 +168,7 @@ def non_max_suppression(boxes, max_bbox_overlap, scores=None):
     if len(boxes) == 0:
         return []
 
-    boxes = boxes.astype(np.float)
+    boxes = boxes.astype(np.float64)
     pick = []
 
     x1 = boxes[:, 0]
@@ -271,3 +273,82 @@ def write_results(filename, results, data_type):
 
 def cosin_metric(x1, x2):
     return np.dot(x1, x2) / (np.linalg.norm(x1) * np.linalg.norm(x2))
+
+
+class BatchExtractor(object):
+    """
+    Feature extractor which runs all the crops of a frame at once.
+
+    The batch is padded up to one of the fixed bucket sizes and each bucket
+    has its own network instance, so that the network is not reshaped when
+    the number of detected persons changes between frames.
+    Batches larger than the largest bucket are split into several calls.
+    """
+
+    def __init__(self, create_net, buckets=(1, 2, 4, 8, 16, 32)):
+        self.create_net = create_net
+        self.buckets = sorted(buckets)
+        self.nets = {}
+
+    def get_net(self, bucket, input_shape):
+        net = self.nets.get(bucket)
+        if net is None:
+            net = self.create_net()
+            net.set_input_shape((bucket,) + tuple(input_shape[1:]))
+            self.nets[bucket] = net
+        return net
+
+    def predict(self, img_batch):
+        n = img_batch.shape[0]
+        max_bucket = self.buckets[-1]
+
+        features = []
+        for i in range(0, n, max_bucket):
+            chunk = img_batch[i:i + max_bucket]
+            count = chunk.shape[0]
+            bucket = next(b for b in self.buckets if b >= count)
+            if bucket != count:
+                pad = np.zeros(
+                    (bucket - count,) + chunk.shape[1:],
+                    dtype=chunk.dtype)
+                chunk = np.concatenate([chunk, pad], axis=0)
+            net = self.get_net(bucket, chunk.shape)
+            output = net.predict(chunk)
+            features.append(output[:count])
+
+        return np.concatenate(features, axis=0)
+
+
+class StageTimer(object):
+    """
+    Accumulate the processing time of each stage and report it.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.total = {k: 0.0 for k in stages}
+        self.last = {k: 0.0 for k in stages}
+        self.count = 0
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    def stop(self, stage):
+        end = time.perf_counter()
+        t = (end - self.start_time) * 1000
+        self.last[stage] = t
+        self.total[stage] += t
+        self.start_time = end
+
+    def next_frame(self):
+        self.count += 1
+
+    def frame_report(self):
+        return ', '.join(
+            '%s %.1f ms' % (k, self.last[k]) for k in self.stages)
+
+    def summary_report(self):
+        n = max(self.count, 1)
+        return ', '.join(
+            '%s %.1f ms' % (k, self.total[k] / n) for k in self.stages)
@@ -1,7 +1,13 @@
+import os
+import sys
+
 import numpy as np
 # from sklearn.utils.linear_assignment_ import linear_assignment
 from scipy.optimize import linear_sum_assignment as linear_assignment
-from . import kalman_filter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../../util'))
+from kalman_utils import KalmanTrackStore  # noqa: E402
+from . import kalman_filter  # noqa: E402
 
 
 INFTY_COST = 1e+5
@@ -149,7 +155,10 @@ def gate_cost_matrix(
 
     Parameters
     ----------
-    kf : The Kalman filter.
+    kf : kalman_utils.KalmanTrackStore | kalman_filter.KalmanFilter
+        The store holding the state distributions of `tracks`, which gates
+        all tracks at once. With a Kalman filter, the tracks are gated one
+        by one from their `mean` and `covariance`.
     cost_matrix : ndarray
         The NxM dimensional cost matrix, where N is the number of track indices
         and M is the number of detection indices, such that entry (i, j) is the
@@ -182,9 +191,16 @@ def gate_cost_matrix(
     gating_threshold = kalman_filter.chi2inv95[gating_dim]
     measurements = np.asarray(
         [detections[i].to_xyah() for i in detection_indices])
-    for row, track_idx in enumerate(track_indices):
-        track = tracks[track_idx]
-        gating_distance = kf.gating_distance(
-            track.mean, track.covariance, measurements, only_position)
-        cost_matrix[row, gating_distance > gating_threshold] = gated_cost
+    if len(track_indices) == 0 or len(detection_indices) == 0:
+        return cost_matrix
+    if not isinstance(kf, KalmanTrackStore):
+        for row, track_idx in enumerate(track_indices):
+            track = tracks[track_idx]
+            gating_distance = kf.gating_distance(
+                track.mean, track.covariance, measurements, only_position)
+            cost_matrix[row, gating_distance > gating_threshold] = gated_cost
+        return cost_matrix
+    gating_distance = kf.gating_distance(
+        [tracks[i].slot for i in track_indices], measurements, only_position)
+    cost_matrix[gating_distance > gating_threshold] = gated_cost
     return cost_matrix
@@ -1,3 +1,10 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../../util'))
+from kalman_utils import KalmanStateMixin  # noqa: E402
+
+
 class TrackState:
     """
     Enumeration type for the single target track state. Newly created tracks are
@@ -13,7 +20,7 @@ class TrackState:
     Deleted = 3
 
 
-class Track:
+class Track(KalmanStateMixin):
     """
     A single target track with state space `(x, y, a, h)` and associated
     velocities, where `(x, y)` is the center of the bounding box, `a` is the
@@ -44,6 +51,10 @@ class Track:
         Mean vector of the initial state distribution.
     covariance : ndarray
         Covariance matrix of the initial state distribution.
+    store : Optional[kalman_utils.KalmanTrackStore]
+        The store holding `mean` and `covariance` once attached, None before.
+    slot : Optional[int]
+        Index of the track state in `store`.
     track_id : int
         A unique track identifier.
     hits : int
@@ -117,6 +128,12 @@ class Track:
 
         """
         self.mean, self.covariance = kf.predict(self.mean, self.covariance)
+        self.mark_predicted()
+
+    def mark_predicted(self):
+        """Advance the age counters by one time step. The state distribution
+        has been propagated by `predict` or in batch by the track store.
+        """
         self.age += 1
         self.time_since_update += 1
 
@@ -126,14 +143,16 @@ class Track:
 
         Parameters
         ----------
-        kf : kalman_filter.KalmanFilter
-            The Kalman filter.
+        kf : Optional[kalman_filter.KalmanFilter]
+            The Kalman filter. None if the state distribution has already been
+            updated in batch by the track store.
         detection : Detection
             The associated detection.
 
         """
-        self.mean, self.covariance = kf.update(
-            self.mean, self.covariance, detection.to_xyah())
+        if kf is not None:
+            self.mean, self.covariance = kf.update(
+                self.mean, self.covariance, detection.to_xyah())
         self.features.append(detection.feature)
 
         self.hits += 1
@@ -1,8 +1,14 @@
+import os
+import sys
+
 import numpy as np
-from . import kalman_filter
-from . import linear_assignment
-from . import iou_matching
-from .track import Track
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../../util'))
+from kalman_utils import KalmanTrackStore  # noqa: E402
+from . import kalman_filter  # noqa: E402
+from . import linear_assignment  # noqa: E402
+from . import iou_matching  # noqa: E402
+from .track import Track  # noqa: E402
 
 
 class Tracker:
@@ -30,6 +36,9 @@ class Tracker:
         Number of frames that a track remains in initialization phase.
     kf : kalman_filter.KalmanFilter
         A Kalman filter to filter target trajectories in image space.
+    store : kalman_utils.KalmanTrackStore
+        The state distributions of all the tracks in contiguous arrays, so that
+        predict, update and gating run in batch.
     tracks : List[Track]
         The list of active tracks at the current time step.
 
@@ -42,6 +51,7 @@ class Tracker:
         self.n_init = n_init
 
         self.kf = kalman_filter.KalmanFilter()
+        self.store = KalmanTrackStore()
         self.tracks = []
         self._next_id = 1
 
@@ -50,8 +60,9 @@ class Tracker:
 
         This function should be called once every time step, before `update`.
         """
+        self.store.predict([t.slot for t in self.tracks])
         for track in self.tracks:
-            track.predict(self.kf)
+            track.mark_predicted()
 
     def update(self, detections):
         """Perform measurement update and track management.
@@ -67,14 +78,18 @@ class Tracker:
             self._match(detections)
 
         # Update track set.
+        self.store.update(
+            [self.tracks[track_idx].slot for track_idx, _ in matches],
+            [detections[detection_idx].to_xyah()
+             for _, detection_idx in matches])
         for track_idx, detection_idx in matches:
-            self.tracks[track_idx].update(
-                self.kf, detections[detection_idx])
+            self.tracks[track_idx].update(None, detections[detection_idx])
         for track_idx in unmatched_tracks:
             self.tracks[track_idx].mark_missed()
         for detection_idx in unmatched_detections:
             self._initiate_track(detections[detection_idx])
         self.tracks = [t for t in self.tracks if not t.is_deleted()]
+        self.store.retain(self.tracks)
 
         # Update distance metric.
         active_targets = [t.track_id for t in self.tracks if t.is_confirmed()]
@@ -95,7 +110,7 @@ class Tracker:
             targets = np.array([tracks[i].track_id for i in track_indices])
             cost_matrix = self.metric.distance(features, targets)
             cost_matrix = linear_assignment.gate_cost_matrix(
-                self.kf, cost_matrix, tracks, dets, track_indices,
+                self.store, cost_matrix, tracks, dets, track_indices,
                 detection_indices)
 
             return cost_matrix
@@ -130,7 +145,9 @@ class Tracker:
 
     def _initiate_track(self, detection):
         mean, covariance = self.kf.initiate(detection.to_xyah())
-        self.tracks.append(Track(
+        track = Track(
             mean, covariance, self._next_id, self.n_init, self.max_age,
-            detection.feature))
+            detection.feature)
+        track.attach(self.store)
+        self.tracks.append(track)
         self._next_id += 1
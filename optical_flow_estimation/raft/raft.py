@@ -12,6 +12,7 @@ import ailia
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
+from functional import grid_sample  # noqa: E402
 import webcamera_utils  # noqa: E402
 
 # logger
@@ -68,6 +69,17 @@ parser.add_argument(
          'If the iterations is small, speed will increase.' + 
          'default value: {\'things\': 12, \'small\': 5}'
 )
+parser.add_argument(
+    '--warm_start', action='store_true',
+    help='Video mode only. Initialize the flow of each frame pair with ' +
+         'the flow estimated for the previous pair.'
+)
+parser.add_argument(
+    '--tolerance', type=float, default=0,
+    help='Stop the refinement iterations when the mean update of the ' +
+         'flow (in 1/8 resolution pixels) falls under this value. ' +
+         '(0: always run all the iterations)'
+)
 args = update_parser(parser)
 
 
@@ -86,9 +98,6 @@ WEIGHT_PATH_UB = 'raft-' + args.model + '_update_block.onnx'
 MODEL_PATH_UB = 'raft-' + args.model + '_update_block.onnx.prototxt'
 REMOTE_PATH_UB = 'https://storage.googleapis.com/ailia-models/raft/'
 
-if (args.iterations > 0):
-    ITERS = args.iterations
-
 if (args.model == 'things'):
     ITERS = 12
     HDIM = 128
@@ -98,6 +107,9 @@ else:
     HDIM = 96
     CORR_RADIUS = 3
 
+if (args.iterations > 0):
+    ITERS = args.iterations
+
 
 # ======================
 # Sub functions
@@ -134,6 +146,12 @@ class CorrBlock:
         self.radius = radius
         self.corr_pyramid = []
 
+        r = radius
+        dx = np.linspace(-r, r, 2*r+1, dtype=np.float32)
+        dy = np.linspace(-r, r, 2*r+1, dtype=np.float32)
+        delta = np.stack(np.meshgrid(dx, dy)[::-1], axis=-1)
+        self.delta = delta.reshape(1, 2*r+1, 2*r+1, 2)
+
         # all pairs correlation
         corr = CorrBlock.corr(fmap1, fmap2)
 
@@ -151,20 +169,15 @@ class CorrBlock:
             self.corr_pyramid.append(corr)
 
     def __call__(self, coords):
-        r = self.radius
-        coords = coords.transpose(0, 2, 3, 1)
+        coords = coords.transpose(0, 2, 3, 1).astype(np.float32)
         batch, h1, w1, _ = coords.shape
 
         out_pyramid = []
         for i in range(self.num_levels):
             corr = self.corr_pyramid[i]
-            dx = np.linspace(-r, r, 2*r+1)
-            dy = np.linspace(-r, r, 2*r+1)
-            delta = np.stack(np.meshgrid(dx, dy)[::-1], axis=-1)
 
             centroid_lvl = coords.reshape(batch*h1*w1, 1, 1, 2) / 2**i
-            delta_lvl = delta.reshape(1, 2*r+1, 2*r+1, 2)
-            coords_lvl = centroid_lvl + delta_lvl
+            coords_lvl = centroid_lvl + self.delta
 
             corr = bilinear_sampler(corr, coords_lvl)
             corr = corr.reshape(batch, h1, w1, -1)
@@ -193,7 +206,7 @@ def bilinear_sampler(img, coords, mode='bilinear', mask=False):
     ygrid = 2*ygrid/(H-1) - 1
 
     grid = np.concatenate([xgrid, ygrid], axis=-1)
-    img = grid_sample(img, grid, align_corners=True)
+    img = grid_sample(img, grid, padding_mode='border', align_corners=True)
 
     if mask:
         mask = (xgrid > -1) & (ygrid > -1) & (xgrid < 1) & (ygrid < 1)
@@ -202,108 +215,6 @@ def bilinear_sampler(img, coords, mode='bilinear', mask=False):
     return img
 
 
-def grid_sampler_unnormalize(coord, side, align_corners):
-    if align_corners:
-        return ((coord + 1) / 2) * (side - 1)
-    else:
-        return ((coord + 1) * side - 1) / 2
-
-
-def grid_sampler_compute_source_index(coord, size, align_corners):
-    coord = grid_sampler_unnormalize(coord, size, align_corners)
-    return coord
-
-
-def safe_get_border(image, n, c, x, y, H, W):
-    x = np.clip(x, 0, (W - 1))
-    y = np.clip(y, 0, (H - 1))
-    value = image[n, c, y, x]
-    return value
-
-
-def safe_get_zero(image, n, c, x, y, H, W):
-    x = x + 1
-    y = y + 1
-    x = np.clip(x, 0, (W + 1))
-    y = np.clip(y, 0, (H + 1))
-    value = np.pad(image, ((0, 0), (0, 0), (1, 1), (1, 1)))
-    value = value[n, c, y, x]
-    return value
-
-
-def safe_get(image, n, c, x, y, H, W, padding_mode='zeros'):
-    if padding_mode == 'border':
-        return safe_get_border(image, n, c, x, y, H, W)
-    else:
-        return safe_get_zero(image, n, c, x, y, H, W)
-
-
-# Originally default value of padding_mode is 'zeros', but change to 'border' for speeding up.
-def grid_sample(image, grid, padding_mode='border', align_corners=False):
-    '''
-         input shape = [N, C, H, W]
-         grid_shape  = [N, H, W, 2]
-
-         output shape = [N, C, H, W]
-    '''
-    # print(image.shape)
-    N, C, H, W = image.shape
-    grid_H = grid.shape[1]
-    grid_W = grid.shape[2]
-
-    output_tensor = np.zeros([N, C, grid_H, grid_W], 
-                             dtype=type(image.reshape(-1)[0]))
-
-    # get corresponding grid x and y
-    y = grid[:, :, :, 1]
-    x = grid[:, :, :, 0]
-
-    y = y[:, np.newaxis, :, :]
-    x = x[:, np.newaxis, :, :]
-    y = y.repeat(C, axis=1)
-    x = x.repeat(C, axis=1)
-
-    c = np.zeros_like(y) + np.arange(C)[np.newaxis, :, np.newaxis, np.newaxis]
-    n = np.zeros_like(y) + np.arange(N)[:, np.newaxis, np.newaxis, np.newaxis]
-    c = c.astype(np.int)
-    n = n.astype(np.int)
-
-    # Unnormalize with align_corners condition
-    ix = grid_sampler_compute_source_index(x, W, align_corners)
-    iy = grid_sampler_compute_source_index(y, H, align_corners)
-
-    x0 = np.floor(ix)
-    x1 = x0 + 1
-
-    y0 = np.floor(iy)
-    y1 = y0 + 1
-
-    # Get W matrix before I matrix, as I matrix requires Channel information
-    wa = (x1 - ix) * (y1 - iy)
-    wb = (x1 - ix) * (iy - y0)
-    wc = (ix - x0) * (y1 - iy)
-    wd = (ix - x0) * (iy - y0)
-
-    # Get values of the image by provided x0,y0,x1,y1 by channel
-
-    # image, n, c, x, y, H, W
-    x0 = x0.astype(np.int)
-    y0 = y0.astype(np.int)
-    x1 = x1.astype(np.int)
-    y1 = y1.astype(np.int)
-    Ia = safe_get(image, n, c, x0, y0, H, W, padding_mode)
-    Ib = safe_get(image, n, c, x0, y1, H, W, padding_mode)
-    Ic = safe_get(image, n, c, x1, y0, H, W, padding_mode)
-    Id = safe_get(image, n, c, x1, y1, H, W, padding_mode)
-    out_ch_val = (
-            (Ia * wa) + (Ib * wb) + \
-            (Ic * wc) + (Id * wd))
-
-    output_tensor[:, :, :, :] = out_ch_val
-
-    return output_tensor
-
-
 def initialize_flow(img):
     """ Flow is represented as difference between two coordinate grids flow = coords1 - coords0"""
     N, C, H, W = img.shape
@@ -557,15 +468,110 @@ def flow_to_image(flow_uv, clip_flow=None, convert_to_bgr=False):
     return flow_uv_to_colors(u, v, convert_to_bgr)
 
 
-# ======================
-# Main functions
-# ======================
-def recognize_from_image():
+class RaftStream:
+    """
+    Estimate the optical flow between consecutive frames.
+
+    The fnet features of each frame are computed once and kept for the
+    next pair, the context features are computed once per pair instead of
+    every iteration, and the flow can be warm-started from the previous pair.
+    """
+    def __init__(self, fnet, cnet, update_block,
+                 iters=ITERS, warm_start=False, tolerance=0):
+        self.fnet = fnet
+        self.cnet = cnet
+        self.update_block = update_block
+        self.iters = iters
+        self.warm_start = warm_start
+        self.tolerance = tolerance
+        self.reset()
+
+    def reset(self):
+        self.image = None
+        self.fmap = None
+        self.flow = None
+        self.last_iters = 0
+
+    def push(self, image):
+        """
+        Add the next (padded and normalized) frame.
+
+        Returns the upsampled flow from the previous frame to this frame,
+        or None for the first frame.
+        """
+        fmap = self.fnet.run(image)[0]
+        image1, fmap1 = self.image, self.fmap
+        self.image, self.fmap = image, fmap
+        if image1 is None:
+            return None
+
+        flow_up, self.flow = self.estimate(image1, fmap1, fmap,
+                                           self.flow if self.warm_start else None)
+        return flow_up
+
+    def estimate(self, image1, fmap1, fmap2, flow_init=None):
+        # calculate correlation of pixel of feature map
+        corr_fn = CorrBlock(fmap1, fmap2, radius=CORR_RADIUS)
+
+        # calculate context
+        cmap = self.cnet.run(image1)[0]
+        net = cmap[:, :HDIM]
+        inp = cmap[:, HDIM:]
+        net = np.tanh(net)
+        inp = np.clip(inp, 0, None)
+
+        # initialize coordinates
+        coords0, coords1 = initialize_flow(image1)
+        if flow_init is not None:
+            coords1 = coords1 + flow_init
+
+        # predict optical flow
+        for itr in range(self.iters):
+            corr = corr_fn(coords1)  # index correlation volume
+
+            flow = coords1 - coords0
+            net, up_mask, delta_flow = self.update_block.run(
+                [net, inp, corr, flow])
+
+            # F(t+1) = F(t) + \Delta(t)
+            coords1 = coords1 + delta_flow
+
+            if self.tolerance > 0 and \
+                    np.mean(np.linalg.norm(delta_flow, axis=1)) < self.tolerance:
+                break
+        self.last_iters = itr + 1
+
+        # upsample prediction
+        flow = coords1 - coords0
+        if (args.model == 'small'):
+            flow_up = upflow8(flow)
+        else:
+            flow_up = upsample_flow(flow, up_mask)
+
+        return flow_up, flow
+
+
+def create_stream():
     # net initialize
     fnet = ailia.Net(MODEL_PATH_FNET, WEIGHT_PATH_FNET, env_id=0)
     cnet = ailia.Net(MODEL_PATH_CNET, WEIGHT_PATH_CNET, env_id=0)
     update_block = ailia.Net(MODEL_PATH_UB, WEIGHT_PATH_UB, env_id=0)
 
+    return RaftStream(
+        fnet, cnet, update_block,
+        warm_start=args.warm_start, tolerance=args.tolerance)
+
+
+def normalize(image):
+    return 2 * (image / 255.0) - 1.0
+
+
+# ======================
+# Main functions
+# ======================
+def recognize_from_image():
+    stream = create_stream()
+
     # set filename of images
     imfile1 = args.inputs[0]
     imfile2 = args.inputs[1]
@@ -581,73 +587,24 @@ def recognize_from_image():
     padder = InputPadder(image1.shape)
     image1, image2 = padder.pad(image1, image2)
     # normalize
-    image1 = 2 * (image1 / 255.0) - 1.0
-    image2 = 2 * (image2 / 255.0) - 1.0
+    image1 = normalize(image1)
+    image2 = normalize(image2)
 
-    # calculate feature map
-    logger.info('Start calculating feature map...')
-    if args.benchmark:
-        logger.info('BENCHMARK mode')
-        for i in range(args.benchmark_count):
-            start = int(round(time.time() * 1000))
-            fmap = fnet.run(np.concatenate([image1, image2], axis=0))
-            end = int(round(time.time() * 1000))
-            logger.info(f'\tailia processing time {end - start} ms')
-    else:
-        fmap = fnet.run(np.concatenate([image1, image2], axis=0))
-    fmap1 = fmap[0][[0]]
-    fmap2 = fmap[0][[1]]
-    # calculate correlation of pixel of feature map
-    corr_fn = CorrBlock(fmap1, fmap2, radius=CORR_RADIUS)
-
-    # calculate context
-    logger.info('Start calculating context...')
+    # predict optical flow
+    logger.info('Start predicting optical flow...')
     if args.benchmark:
         logger.info('BENCHMARK mode')
         for i in range(args.benchmark_count):
             start = int(round(time.time() * 1000))
-            cmap = cnet.run(image1)[0]
+            stream.reset()
+            stream.push(image1)
+            flow_up = stream.push(image2)
             end = int(round(time.time() * 1000))
             logger.info(f'\tailia processing time {end - start} ms')
     else:
-        cmap = cnet.run(image1)[0]
-    net = cmap[:, :HDIM]
-    inp = cmap[:, HDIM:]
-    net = np.tanh(net)
-    inp = np.clip(inp, 0, None)
-
-    # initialize coordinates
-    coords0, coords1 = initialize_flow(image1)
-
-    # predict optical flow
-    flow_predictions = []
-    for itr in range(ITERS):
-
-        corr = corr_fn(coords1)  # index correlation volume
-
-        flow = coords1 - coords0
-        logger.info('[iter:%d] Start predicting optical flow...' % (itr+1))
-        if args.benchmark:
-            logger.info('BENCHMARK mode')
-            for i in range(args.benchmark_count):
-                start = int(round(time.time() * 1000))
-                cmap = cnet.run(image1)[0]
-                end = int(round(time.time() * 1000))
-                logger.info(f'\tailia processing time {end - start} ms')
-        else:
-            cmap = cnet.run(image1)[0]
-        net, up_mask, delta_flow = update_block.run([net, inp, corr, flow])
-
-        # F(t+1) = F(t) + \Delta(t)
-        coords1 = coords1 + delta_flow
-
-        # upsample predictions
-        if (args.model == 'small'):
-            flow_up = upflow8(coords1 - coords0)
-        else:
-            flow_up = upsample_flow(coords1 - coords0, up_mask)
-
-        flow_predictions.append(flow_up)
+        stream.push(image1)
+        flow_up = stream.push(image2)
+    logger.info('iterations : %d' % stream.last_iters)
 
     # visualize
     img_BGR = viz(image1_org, image2_org, flow_up)
@@ -659,10 +616,7 @@ def recognize_from_image():
 
 
 def recognize_from_video():
-    # net initialize
-    fnet = ailia.Net(MODEL_PATH_FNET, WEIGHT_PATH_FNET, env_id=0)
-    cnet = ailia.Net(MODEL_PATH_CNET, WEIGHT_PATH_CNET, env_id=0)
-    update_block = ailia.Net(MODEL_PATH_UB, WEIGHT_PATH_UB, env_id=0)
+    stream = create_stream()
 
     # capture video
     capture = webcamera_utils.get_capture(args.video)
@@ -683,103 +637,39 @@ def recognize_from_video():
     else:
         writer = None
 
+    padder = InputPadder((H, W))
+
     # read frame
     ret, frame_before = capture.read()
     if RESIZE_ENABLE:
         frame_before = cv2.resize(frame_before, (W,H))
     frame_before = frame_before[..., ::-1]  # BGR2RGB
+    image1_org = prep_input(frame_before)
+    stream.push(normalize(padder.pad(image1_org)[0]))
     
     frame_shown = False
     while(True):
         # read frame
         ret, frame_after = capture.read()
-        if RESIZE_ENABLE:
-            frame_after = cv2.resize(frame_after, (W,H))
         if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
             break
         if frame_shown and cv2.getWindowProperty('frame', cv2.WND_PROP_VISIBLE) == 0:
             break
+        if RESIZE_ENABLE:
+            frame_after = cv2.resize(frame_after, (W,H))
 
         # preprocessing
         frame_after = frame_after[..., ::-1]  # BGR2RGB
-        image1 = frame_before.copy()
-        image2 = frame_after.copy()
-        image1 = prep_input(image1)
-        image2 = prep_input(image2)
-        image1_org = image1.copy()
-        image2_org = image2.copy()
-
-        # padding for adjust
-        padder = InputPadder(image1.shape)
-        image1, image2 = padder.pad(image1, image2)
-        # normalize
-        image1 = 2 * (image1 / 255.0) - 1.0
-        image2 = 2 * (image2 / 255.0) - 1.0
-
-        # calculate feature map
-        logger.info('Start calculating feature map...')
-        if args.benchmark:
-            logger.info('BENCHMARK mode')
-            for i in range(args.benchmark_count):
-                start = int(round(time.time() * 1000))
-                fmap = fnet.run(np.concatenate([image1, image2], axis=0))
-                end = int(round(time.time() * 1000))
-                logger.info(f'\tailia processing time {end - start} ms')
-        else:
-            fmap = fnet.run(np.concatenate([image1, image2], axis=0))
-        fmap1 = fmap[0][[0]]
-        fmap2 = fmap[0][[1]]
-        # calculate correlation of pixel of feature map
-        corr_fn = CorrBlock(fmap1, fmap2, radius=CORR_RADIUS)
-
-        # calculate context
-        logger.info('Start calculating context...')
-        if args.benchmark:
-            logger.info('BENCHMARK mode')
-            for i in range(args.benchmark_count):
-                start = int(round(time.time() * 1000))
-                cmap = cnet.run(image1)[0]
-                end = int(round(time.time() * 1000))
-                logger.info(f'\tailia processing time {end - start} ms')
-        else:
-            cmap = cnet.run(image1)[0]
-        net = cmap[:, :HDIM]
-        inp = cmap[:, HDIM:]
-        net = np.tanh(net)
-        inp = np.clip(inp, 0, None)
-
-        # initialize coordinates
-        coords0, coords1 = initialize_flow(image1)
-
-        # predict optical flow
-        flow_predictions = []
-        for itr in range(ITERS):
-
-            corr = corr_fn(coords1)  # index correlation volume
-
-            flow = coords1 - coords0
-            logger.info('[iter:%d] Start predicting optical flow...' % (itr+1))
-            if args.benchmark:
-                logger.info('BENCHMARK mode')
-                for i in range(args.benchmark_count):
-                    start = int(round(time.time() * 1000))
-                    cmap = cnet.run(image1)[0]
-                    end = int(round(time.time() * 1000))
-                    logger.info(f'\tailia processing time {end - start} ms')
-            else:
-                cmap = cnet.run(image1)[0]
-            net, up_mask, delta_flow = update_block.run([net, inp, corr, flow])
-
-            # F(t+1) = F(t) + \Delta(t)
-            coords1 = coords1 + delta_flow
-
-            # upsample predictions
-            if (args.model == 'small'):
-                flow_up = upflow8(coords1 - coords0)
-            else:
-                flow_up = upsample_flow(coords1 - coords0, up_mask)
+        image2_org = prep_input(frame_after)
+        image2 = normalize(padder.pad(image2_org)[0])
 
-            flow_predictions.append(flow_up)
+        # predict optical flow, the features of the previous frame are reused
+        start = int(round(time.time() * 1000))
+        flow_up = stream.push(image2)
+        end = int(round(time.time() * 1000))
+        logger.info(
+            f'ailia processing time {end - start} ms'
+            f' ({stream.last_iters} iterations)')
 
         # visualize
         img_BGR = viz(image1_org, image2_org, flow_up)
@@ -793,7 +683,7 @@ def recognize_from_video():
             writer.write(img_BGR)
 
         # slide frame
-        frame_before = frame_after
+        image1_org = image2_org
 
     capture.release()
     cv2.destroyAllWindows()
@@ -2,10 +2,13 @@ import os
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "True"
 import copy
+import itertools
 import math
 import sys
 import time
 import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import ailia
 import cv2
@@ -102,6 +105,16 @@ parser.add_argument(
           'Please set a positive integer.'
           'Generally set to a multiple of 32, such as 960.')
 )
+parser.add_argument(
+    '-p', '--pipeline', action='store_true',
+    help=('Process the input images with a pipeline, which overlaps '
+          'the text detection of the next pages with the text recognition, '
+          'and recognizes the text crops of several pages together.')
+)
+parser.add_argument(
+    '--rec_pages', type=int, default=4,
+    help='The number of pages whose text crops are recognized together in pipeline mode.'
+)
 args = update_parser(parser)
 
 
@@ -143,6 +156,7 @@ def get_default_config():
     dc['rec_bbox_padding'] = 0.1
     dc['limited_max_width'] = 1280
     dc['limited_min_width'] = 16
+    dc['rec_width_bucket'] = 160  # input width is rounded up to a multiple of this
 
     # params for text classifier
     dc['use_angle_cls'] = True
@@ -697,6 +711,51 @@ class ClsPostProcess(object):
         return decode_out, label
 
 
+def batch_bucket(n, max_n):
+    """
+    Round the batch size up to a power of 2 (capped by max_n).
+    """
+    bucket = 1
+    while bucket < n:
+        bucket *= 2
+    return min(bucket, max_n)
+
+
+def pad_batch(batch, bucket):
+    if batch.shape[0] == bucket:
+        return batch
+    pad = np.zeros((bucket - batch.shape[0],) + batch.shape[1:], dtype=batch.dtype)
+    return np.concatenate([batch, pad], axis=0)
+
+
+class NetPool(object):
+    """
+    Pool of network instances keyed by the input shape.
+
+    Inputs are padded to a small set of shape buckets, and each bucket keeps
+    its own instance, so that the model is not loaded again when the batch
+    size or the width changes.
+    """
+
+    def __init__(self, model_path, env_id):
+        self.model_path = model_path
+        self.env_id = env_id
+        self.nets = {}
+
+    def get(self, shape):
+        shape = tuple(shape)
+        net = self.nets.get(shape)
+        if net is None:
+            net = ailia.Net(self.model_path + '.prototxt',
+                            self.model_path, env_id=self.env_id)
+            net.set_input_shape(shape)
+            self.nets[shape] = net
+        return net
+
+    def predict(self, batch):
+        return self.get(batch.shape).predict(batch)
+
+
 class TextDetector():
     def __init__(self, config, env_id):
         OCR_CFG = config
@@ -829,7 +888,7 @@ class TextClassifier():
             "label_list": OCR_CFG['label_list'],
         }
         self.postprocess_op = build_post_process(postprocess_params)
-        self.net = None
+        self.net_pool = NetPool(self.cfg['cls_model_path'], env_id)
 
     def resize_norm_img(self, img):
         imgC, imgH, imgW = self.cls_image_shape
@@ -882,13 +941,12 @@ class TextClassifier():
             norm_img_batch = norm_img_batch.copy()
             starttime = time.time()
 
-
-            # net initialize, Detection Boxes Rectify
-            if self.net==None or self.net.get_input_shape()!=norm_img_batch.shape:
-                self.net = ailia.Net(self.cfg['cls_model_path']+'.prototxt',
-                                     self.cfg['cls_model_path'], env_id=self.env_id)
-            self.net.set_input_shape(norm_img_batch.shape)
-            prob_out = self.net.predict(norm_img_batch)
+            # Detection Boxes Rectify
+            # (the batch is padded to the bucket size of the network pool)
+            n = norm_img_batch.shape[0]
+            norm_img_batch = pad_batch(
+                norm_img_batch, batch_bucket(n, batch_num))
+            prob_out = self.net_pool.predict(norm_img_batch)[:n]
 
             cls_result = self.postprocess_op(prob_out)
             elapse += time.time() - starttime
@@ -920,14 +978,17 @@ class TextRecognizer():
             "character_dict_path": OCR_CFG['rec_char_dict_path'],
             "use_space_char": OCR_CFG['use_space_char']
         }
+        self.rec_width_bucket = OCR_CFG['rec_width_bucket']
         self.postprocess_op = build_post_process(postprocess_params)
-        self.net = None
+        self.net_pool = NetPool(self.config['rec_model_path'], env_id)
 
     def resize_norm_img(self, img, max_wh_ratio):
         imgC, imgH, imgW = self.rec_image_shape
         assert imgC == img.shape[2]
         if self.character_type == "ch":
             imgW = int((32 * max_wh_ratio))
+            # round up to the width bucket of the network pool
+            imgW = int(math.ceil(imgW / self.rec_width_bucket)) * self.rec_width_bucket
         imgW = max(min(imgW, self.limited_max_width), self.limited_min_width)
         h, w = img.shape[:2]
         ratio = w / float(h)
@@ -978,11 +1039,12 @@ class TextRecognizer():
             norm_img_batch = norm_img_batch.copy()
             starttime = time.time()
 
-            # net initialize, Text Recognition
-            if self.net==None or self.net.get_input_shape()!=norm_img_batch.shape:
-                self.net = ailia.Net(self.config['rec_model_path']+'.prototxt',
-                                     self.config['rec_model_path'], env_id=self.env_id)
-            preds = self.net.predict(norm_img_batch)
+            # Text Recognition
+            # (the batch is padded to the bucket size of the network pool)
+            n = norm_img_batch.shape[0]
+            norm_img_batch = pad_batch(
+                norm_img_batch, batch_bucket(n, batch_num))
+            preds = self.net_pool.predict(norm_img_batch)[:n]
 
             rec_result = self.postprocess_op(preds)
             for rno in range(len(rec_result)):
@@ -1036,7 +1098,10 @@ class TextSystem(object):
             dst_img = np.rot90(dst_img)
         return dst_img
 
-    def __call__(self, img):
+    def detect(self, img):
+        """
+        Text detection and crop rectification of one image.
+        """
         ori_im = img.copy()
         dt_boxes, elapse = self.text_detector(img)
         logger.info("dt_boxes num : {}, elapse : {}".format(
@@ -1069,6 +1134,12 @@ class TextSystem(object):
             tmp_box = copy.deepcopy(dt_boxes[bno])
             img_crop = self.get_rotate_crop_image(ori_im, tmp_box)
             img_crop_list.append(img_crop)
+        return dt_boxes, img_crop_list
+
+    def recognize(self, img_crop_list):
+        """
+        Angle classification and text recognition of the text crops.
+        """
         if self.use_angle_cls:
             img_crop_list, angle_list, elapse = self.text_classifier(
                 img_crop_list)
@@ -1078,6 +1149,9 @@ class TextSystem(object):
         rec_res, elapse = self.text_recognizer(img_crop_list)
         logger.info("rec_res num  : {}, elapse : {}".format(
             len(rec_res), elapse))
+        return rec_res
+
+    def filter_results(self, dt_boxes, rec_res):
         filter_boxes, filter_rec_res = [], []
         for box, rec_reuslt in zip(dt_boxes, rec_res):
             text, score = rec_reuslt
@@ -1086,6 +1160,61 @@ class TextSystem(object):
                 filter_rec_res.append(rec_reuslt)
         return filter_boxes, filter_rec_res
 
+    def __call__(self, img):
+        dt_boxes, img_crop_list = self.detect(img)
+        if dt_boxes is None:
+            return None, None
+
+        rec_res = self.recognize(img_crop_list)
+        return self.filter_results(dt_boxes, rec_res)
+
+    def pipeline(self, pages, rec_pages=4, prefetch=2):
+        """
+        OCR a sequence of pages (image paths or images) with a pipeline.
+
+        Reading and detection of the following pages run in a worker thread
+        while the main thread runs classification and recognition, and the
+        text crops of up to rec_pages pages are recognized together to
+        make fuller batches.
+        Yields (page, image, dt_boxes, rec_res) in the order of pages.
+        """
+        def load_and_detect(page):
+            img = imread(page) if isinstance(page, str) else page
+            dt_boxes, img_crop_list = self.detect(img)
+            return page, img, dt_boxes, img_crop_list
+
+        pages = iter(pages)
+        futures = deque()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            def submit(n):
+                for page in itertools.islice(pages, n):
+                    futures.append(executor.submit(load_and_detect, page))
+
+            submit(rec_pages + prefetch)
+            while futures:
+                # pool the crops of the pages already detected
+                detected = []
+                while futures and len(detected) < rec_pages:
+                    detected.append(futures.popleft().result())
+                    submit(1)
+
+                img_crop_list = []
+                for _, _, dt_boxes, crops in detected:
+                    if dt_boxes is not None:
+                        img_crop_list.extend(crops)
+                rec_res = self.recognize(img_crop_list) if img_crop_list else []
+
+                # split the results by page
+                i = 0
+                for page, img, dt_boxes, crops in detected:
+                    if dt_boxes is None:
+                        yield page, img, None, None
+                        continue
+                    page_res = rec_res[i:i + len(crops)]
+                    i += len(crops)
+                    filter_boxes, filter_rec_res = self.filter_results(dt_boxes, page_res)
+                    yield page, img, filter_boxes, filter_rec_res
+
 
 def sorted_boxes(dt_boxes):
     """
@@ -1177,6 +1306,42 @@ def adjust_half_and_full(txts):
     return txts
 
 
+def save_result(config, img_path, img, dt_boxes, rec_res):
+    image = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    boxes = dt_boxes
+    txts = [rec_res[i][0] for i in range(len(rec_res))]
+    scores = [rec_res[i][1] for i in range(len(rec_res))]
+
+    # adjust halfwidth and fullwidth forms
+    txts = adjust_half_and_full(txts)
+
+    draw_img = draw_ocr_box_txt(image, boxes, txts, scores,
+                                drop_score=config['drop_score'],
+                                font_path=config['vis_font_path'],
+                                bbox_padding=config['rec_bbox_padding'])
+    savepath = get_savepath(args.savepath, img_path)
+    cv2.imwrite(savepath, draw_img[:, :, ::-1])
+
+
+def recognize_from_image_pipeline(config, text_sys):
+    start = time.time()
+    n_pages = 0
+    for img_path, img, dt_boxes, rec_res in text_sys.pipeline(
+            args.input, rec_pages=args.rec_pages):
+        if dt_boxes is None:
+            logger.error('failed to process %s' % img_path)
+            continue
+        if not args.benchmark:
+            save_result(config, img_path, img, dt_boxes, rec_res)
+        n_pages += 1
+    elapse = time.time() - start
+
+    logger.info('%d pages, %.2f sec, %.2f pages/sec' %
+                (n_pages, elapse, n_pages / max(elapse, 1e-6)))
+    if not args.benchmark:
+        logger.info('finished process and write result to %s!' % args.savepath)
+
+
 def recognize_from_image(config, text_sys):
 
     for img_path in args.input:
@@ -1186,20 +1351,7 @@ def recognize_from_image(config, text_sys):
         # exec ocr
         dt_boxes, rec_res = text_sys(img)
 
-        image = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-        boxes = dt_boxes
-        txts = [rec_res[i][0] for i in range(len(rec_res))]
-        scores = [rec_res[i][1] for i in range(len(rec_res))]
-
-        # adjust halfwidth and fullwidth forms
-        txts = adjust_half_and_full(txts)
-
-        draw_img = draw_ocr_box_txt(image, boxes, txts, scores,
-                                    drop_score=config['drop_score'],
-                                    font_path=config['vis_font_path'],
-                                    bbox_padding=config['rec_bbox_padding'])
-        savepath = get_savepath(args.savepath, img_path)
-        cv2.imwrite(savepath, draw_img[:, :, ::-1])
+        save_result(config, img_path, img, dt_boxes, rec_res)
 
     logger.info('finished process and write result to %s!' % args.savepath)
 
@@ -1311,6 +1463,13 @@ def main():
 
     if args.video is not None:
         recognize_from_video(config, text_sys)
+    elif args.pipeline:
+        if args.benchmark:
+            logger.info('BENCHMARK mode (throughput)')
+            for i in range(args.benchmark_count):
+                recognize_from_image_pipeline(config, text_sys)
+        else:
+            recognize_from_image_pipeline(config, text_sys)
     else:
         if args.benchmark:
             logger.info('BENCHMARK mode')
@@ -0,0 +1,173 @@
+import numpy as np
+
+# Post-processing shared by the MediaPipe Blaze* detectors
+# (BlazeFace, BlazePalm, BlazePose and the face detectors of facemesh, iris, ...)
+#
+# This is based on the source code from:
+# mediapipe/calculators/tflite/tflite_tensors_to_detections_calculator.cc
+# mediapipe/calculators/util/non_max_suppression_calculator.cc
+
+SCORE_CLIPPING_THRESH = 100.0
+
+_anchors_cache = {}
+
+
+def load_anchors(anchor_path):
+    """
+    Load the anchors (num_anchors, 4) as float32.
+    The file is read only once for each path.
+    """
+    anchors = _anchors_cache.get(anchor_path)
+    if anchors is None:
+        anchors = np.load(anchor_path).astype(np.float32)
+        _anchors_cache[anchor_path] = anchors
+    return anchors
+
+
+def decode_boxes(raw_boxes, anchors, scale):
+    """
+    Converts the predictions into actual coordinates using the anchor boxes.
+
+    raw_boxes: (b, num_anchors, 4 + 2 * num_keypoints)
+    returns: same shape, boxes as (ymin, xmin, ymax, xmax) followed by the
+        keypoints as (x, y)
+    """
+    raw_boxes = np.asarray(raw_boxes, dtype=np.float32)
+    shape = raw_boxes.shape
+    anchor_xy = anchors[:, 0:2]
+    anchor_wh = anchors[:, 2:4] / scale
+
+    boxes = np.empty(shape, dtype=np.float32)
+
+    center = raw_boxes[..., 0:2] * anchor_wh + anchor_xy  # (x, y)
+    half = raw_boxes[..., 2:4] * anchor_wh / 2.  # (w, h) / 2
+    boxes[..., 0:2] = (center - half)[..., ::-1]  # ymin, xmin
+    boxes[..., 2:4] = (center + half)[..., ::-1]  # ymax, xmax
+
+    num_keypoints = (shape[-1] - 4) // 2
+    keypoints = raw_boxes[..., 4:4 + num_keypoints * 2].reshape(
+        shape[:-1] + (num_keypoints, 2))
+    keypoints = keypoints * anchor_wh[:, np.newaxis] + anchor_xy[:, np.newaxis]
+    boxes[..., 4:4 + num_keypoints * 2] = keypoints.reshape(
+        shape[:-1] + (num_keypoints * 2,))
+
+    return boxes
+
+
+def raw_output_to_detections(raw_box, raw_score, anchors, scale, min_score_thresh=0.75):
+    """
+    Converts the raw outputs (b, num_anchors, num_coords) and
+    (b, num_anchors, 1) into detections.
+
+    Returns a list of (num_detections, num_coords + 1) arrays, one for each
+    image in the batch, the last column is the score.
+    """
+    detection_boxes = decode_boxes(raw_box, anchors, scale)
+
+    raw_score = np.clip(raw_score[..., 0], -SCORE_CLIPPING_THRESH, SCORE_CLIPPING_THRESH)
+    detection_scores = 1.0 / (1.0 + np.exp(-raw_score))
+
+    mask = detection_scores >= min_score_thresh
+
+    output_detections = []
+    for i in range(detection_boxes.shape[0]):
+        detections = np.concatenate(
+            (detection_boxes[i, mask[i]], detection_scores[i, mask[i], np.newaxis]),
+            axis=-1)
+        output_detections.append(detections)
+
+    return output_detections
+
+
+def weighted_non_max_suppression(detections, min_suppression_threshold=0.3):
+    """
+    The alternative NMS method as mentioned in the BlazeFace paper:
+
+    "We replace the suppression algorithm with a blending strategy that
+    estimates the regression parameters of a bounding box as a weighted
+    mean between the overlapping predictions."
+
+    The original MediaPipe code assigns the score of the most confident
+    detection to the weighted detection, but we take the average score
+    of the overlapping detections.
+
+    detections: (count, num_coords + 1), the last column is the score.
+    returns: (num_detections, num_coords + 1)
+    """
+    n, d = detections.shape
+    if n == 0:
+        return np.zeros((0, d), dtype=detections.dtype)
+
+    # Sort the detections from highest to lowest score.
+    order = np.argsort(-detections[:, -1], kind='stable')
+    detections = detections[order]
+    boxes = detections[:, :4]
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    # Assign each detection to the cluster of the first remaining detection
+    # that overlaps with it. Only the assignment is sequential, the
+    # weighted means of all the clusters are computed at once.
+    cluster = np.empty(n, dtype=np.int64)
+    remaining = np.arange(n)
+    k = 0
+    while len(remaining) > 0:
+        first = remaining[0]
+        others = boxes[remaining]
+        lt = np.maximum(boxes[first, :2], others[:, :2])
+        rb = np.minimum(boxes[first, 2:4], others[:, 2:4])
+        wh = np.clip(rb - lt, 0, None)
+        inter = wh[:, 0] * wh[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ious = inter / (area[first] + area[remaining] - inter)
+
+        mask = ious > min_suppression_threshold
+        mask[0] = True
+        cluster[remaining[mask]] = k
+        remaining = remaining[~mask]
+        k += 1
+
+    scores = detections[:, -1]
+    total_score = np.bincount(cluster, weights=scores, minlength=k)
+    counts = np.bincount(cluster, minlength=k)
+
+    weighted = np.zeros((k, d - 1), dtype=np.float64)
+    np.add.at(weighted, cluster, detections[:, :-1] * scores[:, np.newaxis])
+
+    output = np.empty((k, d), dtype=detections.dtype)
+    output[:, :-1] = weighted / total_score[:, np.newaxis]
+    output[:, -1] = total_score / counts
+
+    # a detection overlapping with no other one is kept as is
+    first = np.unique(cluster, return_index=True)[1]
+    single = counts == 1
+    output[single] = detections[first[single]]
+
+    return output
+
+
+def postprocess(
+        preds, anchors, scale,
+        min_score_thresh=0.75, min_suppression_threshold=0.3):
+    """
+    Decode the outputs (raw_box, raw_score) of a Blaze* detector and apply
+    the weighted NMS.
+
+    anchors: array, or path of the anchors file
+    scale: input resolution the boxes are regressed against
+    returns: list of (num_detections, num_coords + 1) arrays, one for each
+        image in the batch
+    """
+    raw_box = preds[0]  # (b, num_anchors, num_coords)
+    raw_score = preds[1]  # (b, num_anchors, 1)
+
+    if isinstance(anchors, str):
+        anchors = load_anchors(anchors)
+
+    detections = raw_output_to_detections(
+        raw_box, raw_score, anchors, scale, min_score_thresh)
+
+    # Non-maximum suppression to remove overlapping detections:
+    return [
+        weighted_non_max_suppression(x, min_suppression_threshold)
+        for x in detections
+    ]
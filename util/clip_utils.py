@@ -0,0 +1,117 @@
+import numpy as np
+
+# Temporal clip assembly for the clip-based action recognizers
+# (MARS, ST-GCN, ax action recognition, ...)
+
+
+class ClipBuffer:
+    """
+    Ring buffer of the latest `length` frames.
+
+    A new frame is written in place of the oldest one, so that pushing a
+    frame costs one frame copy whatever the clip length. The frames are
+    put back in temporal order only when the clip is gathered for
+    inference.
+
+    frame_shape: shape of one frame
+    time_axis: position of the time axis in the gathered clip, e.g. 1 for
+        (C, T, H, W) clips of (C, H, W) frames
+    """
+
+    def __init__(self, length, frame_shape, dtype=np.float32, time_axis=0):
+        self.length = length
+        self.time_axis = time_axis
+        self._data = np.zeros((length,) + tuple(frame_shape), dtype=dtype)
+        self._head = 0  # index of the oldest frame
+        self.count = 0  # number of frames pushed
+
+    def __len__(self):
+        return min(self.count, self.length)
+
+    @property
+    def full(self):
+        return self.count >= self.length
+
+    @property
+    def last(self):
+        """The latest frame (a view)"""
+        return self._data[self._head - 1]
+
+    @property
+    def shape(self):
+        shape = list(self._data.shape[1:])
+        shape.insert(self.time_axis, self.length)
+        return tuple(shape)
+
+    def push(self, frame):
+        self._data[self._head] = frame
+        self._head = (self._head + 1) % self.length
+        self.count += 1
+
+    def extend(self, frames):
+        frames = frames[-self.length:]
+        for frame in frames:
+            self.push(frame)
+
+    def clear(self):
+        self._data[...] = 0
+        self._head = 0
+        self.count = 0
+
+    def clip(self, out=None):
+        """
+        The clip in temporal order, oldest frame first. The frames not
+        pushed yet are zeros at the beginning of the clip.
+
+        out: optional array of shape self.shape to write the clip to
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self._data.dtype)
+        view = np.moveaxis(out, self.time_axis, 0)
+        n = self.length - self._head
+        view[:n] = self._data[self._head:]
+        view[n:] = self._data[:self._head]
+        return out
+
+
+class ScoreSmoother:
+    """
+    Run the recognizer every `stride` frames, and smooth the scores of
+    successive inferences by exponential moving average:
+
+        scores = smoothing * scores + (1 - smoothing) * new_scores
+
+    With stride=1 and smoothing=0, every frame is inferred and the scores
+    are kept as is.
+    """
+
+    def __init__(self, stride=1, smoothing=0.0):
+        if not 0 <= smoothing < 1:
+            raise ValueError('smoothing must be in [0, 1).')
+        self.stride = max(1, int(stride))
+        self.smoothing = smoothing
+        self.scores = None
+        self._frame = 0
+
+    def due(self):
+        """Called once by frame, returns True if the frame is to be inferred"""
+        due = self.scores is None or self._frame >= self.stride
+        if due:
+            self._frame = 0
+        self._frame += 1
+        return due
+
+    def update(self, scores):
+        scores = np.asarray(scores)
+        if self.scores is None or self.smoothing == 0 \
+                or self.scores.shape != scores.shape:
+            self.scores = scores.copy()
+        else:
+            self.scores = self.smoothing * self.scores \
+                + (1 - self.smoothing) * scores
+        return self.scores
+
+    def reset(self):
+        self.scores = None
+        self._frame = 0
+
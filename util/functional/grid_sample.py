@@ -34,6 +34,68 @@ def _grid_sample(
          input shape = [N, C, H, W]
          grid_shape  = [N, H, W, 2]
 
+         output shape = [N, C, H, W]
+
+    The corner indices are computed once for all the channels and the
+    values are gathered with flat take, out of range corners of the zeros
+    padding get a zero weight instead of padding the image.
+    '''
+    N, C, H, W = image.shape
+    grid_H = grid.shape[1]
+    grid_W = grid.shape[2]
+    P = grid_H * grid_W
+
+    dtype = image.dtype if image.dtype.kind == 'f' else np.float32
+    grid = grid.reshape(N, P, 2).astype(dtype, copy=False)
+
+    # Unnormalize with align_corners condition
+    ix = grid_sampler_compute_source_index(grid[:, :, 0], W, align_corners)
+    iy = grid_sampler_compute_source_index(grid[:, :, 1], H, align_corners)
+    if padding_mode == 'border':
+        ix = np.clip(ix, 0, W - 1)
+        iy = np.clip(iy, 0, H - 1)
+
+    x0 = np.floor(ix)
+    y0 = np.floor(iy)
+    fx = ix - x0
+    fy = iy - y0
+    x0 = x0.astype(np.int64)
+    y0 = y0.astype(np.int64)
+
+    # pixels are gathered as rows of [N * H * W, C]
+    if C == 1:
+        rows = image.reshape(N * H * W, 1)
+    else:
+        rows = image.transpose(0, 2, 3, 1).reshape(N * H * W, C)
+    base = (np.arange(N) * (H * W))[:, np.newaxis]
+
+    output = np.zeros((N, P, C), dtype=dtype)
+    for dx, dy in ((0, 0), (0, 1), (1, 0), (1, 1)):
+        x = x0 + dx
+        y = y0 + dy
+        wx = fx if dx else 1 - fx
+        wy = fy if dy else 1 - fy
+        weight = wx * wy
+        if padding_mode != 'border':
+            valid = (x >= 0) & (x < W) & (y >= 0) & (y < H)
+            weight = weight * valid
+        x = np.clip(x, 0, W - 1)
+        y = np.clip(y, 0, H - 1)
+        value = np.take(rows, base + y * W + x, axis=0)
+        output += value * weight[:, :, np.newaxis]
+
+    output = output.transpose(0, 2, 1).reshape(N, C, grid_H, grid_W)
+    return output
+
+
+def _grid_sample_reference(
+        image, grid,
+        padding_mode='zeros',
+        align_corners=False):
+    '''
+         input shape = [N, C, H, W]
+         grid_shape  = [N, H, W, 2]
+
          output shape = [N, C, H, W]
     '''
     N, C, H, W = image.shape
@@ -55,8 +117,8 @@ def _grid_sample(
 
     c = np.zeros_like(y) + np.arange(C)[np.newaxis, :, np.newaxis, np.newaxis]
     n = np.zeros_like(y) + np.arange(N)[:, np.newaxis, np.newaxis, np.newaxis]
-    c = c.astype(np.int)
-    n = n.astype(np.int)
+    c = c.astype(int)
+    n = n.astype(int)
 
     # Unnormalize with align_corners condition
     ix = grid_sampler_compute_source_index(x, W, align_corners)
@@ -77,10 +139,10 @@ def _grid_sample(
     # Get values of the image by provided x0,y0,x1,y1 by channel
 
     # image, n, c, x, y, H, W
-    x0 = x0.astype(np.int)
-    y0 = y0.astype(np.int)
-    x1 = x1.astype(np.int)
-    y1 = y1.astype(np.int)
+    x0 = x0.astype(int)
+    y0 = y0.astype(int)
+    x1 = x1.astype(int)
+    y1 = y1.astype(int)
     Ia = safe_get(image, n, c, x0, y0, H, W, padding_mode)
     Ib = safe_get(image, n, c, x0, y1, H, W, padding_mode)
     Ic = safe_get(image, n, c, x1, y0, H, W, padding_mode)
@@ -139,3 +201,55 @@ def safe_get(
         return safe_get_border(image, n, c, x, y, H, W)
     else:
         return safe_get_zero(image, n, c, x, y, H, W)
+
+
+if __name__ == '__main__':
+    # Micro-benchmark of the NumPy kernel against the reference implementation
+    # and torch.nn.functional.grid_sample (if torch is installed)
+    #   $ python3 grid_sample.py
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='grid_sample micro-benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    try:
+        import torch
+        from torch.nn import functional as F
+    except ModuleNotFoundError:
+        torch = None
+
+    def measure(fn):
+        fn()
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            result = fn()
+        return result, (time.perf_counter() - start) * 1000 / args.repeat
+
+    rng = np.random.RandomState(0)
+    cases = [
+        # RAFT CorrBlock lookup: (h*w) x 1 x H x W, 9x9 window
+        ('raft corr', (64 * 128, 1, 64, 128), (64 * 128, 9, 9)),
+        # feature map warp
+        ('warp', (1, 64, 256, 256), (1, 256, 256)),
+        # descriptor sampling
+        ('points', (1, 256, 60, 80), (1, 1, 1000)),
+    ]
+    for name, image_shape, grid_shape in cases:
+        image = rng.uniform(-1, 1, image_shape).astype(np.float32)
+        grid = rng.uniform(-1.2, 1.2, grid_shape + (2,)).astype(np.float32)
+        print('%s: image %s, grid %s' % (name, image_shape, grid_shape))
+        for padding_mode in ('zeros', 'border'):
+            for align_corners in (False, True):
+                kwargs = dict(padding_mode=padding_mode, align_corners=align_corners)
+                result, t = measure(lambda: _grid_sample(image, grid, **kwargs))
+                expected, t_ref = measure(lambda: _grid_sample_reference(image, grid, **kwargs))
+                line = '\t%-6s align_corners=%-5s numpy %9.2f ms, reference %9.2f ms (max diff %.1e)' % (
+                    padding_mode, align_corners, t, t_ref, np.max(np.abs(result - expected)))
+                if torch is not None:
+                    expected, t_torch = measure(lambda: F.grid_sample(
+                        torch.from_numpy(image), torch.from_numpy(grid), **kwargs).numpy())
+                    line += ', torch %9.2f ms (max diff %.1e)' % (
+                        t_torch, np.max(np.abs(result - expected)))
+                print(line)
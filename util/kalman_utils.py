@@ -0,0 +1,224 @@
+import numpy as np
+
+# Constant velocity Kalman filter of deep_sort / ByteTrack for all the tracks
+# at once. The state space is (x, y, a, h, vx, vy, va, vh), with the bounding
+# box center position (x, y), aspect ratio a, height h and their velocities.
+
+
+class BatchKalmanFilter:
+    """
+    Same model as deep_sort's KalmanFilter, with each step applied to N
+    tracks in single NumPy calls.
+
+    mean : (N, 8), covariance : (N, 8, 8), measurements : (N, 4) or (M, 4)
+    """
+
+    def __init__(self):
+        ndim, dt = 4, 1.
+
+        self.ndim = ndim
+        self._motion_mat = np.eye(2 * ndim, 2 * ndim)
+        for i in range(ndim):
+            self._motion_mat[i, ndim + i] = dt
+
+        self._std_weight_position = 1. / 20
+        self._std_weight_velocity = 1. / 160
+
+    def _std(self, h, position, velocity, aspect):
+        # (N, 4) standard deviations of (x, y, a, h) scaled by the height
+        std = np.empty((len(h), 4))
+        std[:, 0] = std[:, 1] = std[:, 3] = position * h
+        std[:, 2] = aspect
+        if velocity is not None:
+            std_vel = np.empty((len(h), 4))
+            std_vel[:, 0] = std_vel[:, 1] = std_vel[:, 3] = velocity * h
+            std_vel[:, 2] = 1e-5
+            std = np.concatenate([std, std_vel], axis=1)
+        return std
+
+    def initiate(self, measurements):
+        measurements = np.asarray(measurements, dtype=np.float64).reshape(-1, 4)
+        n = len(measurements)
+        mean = np.zeros((n, 8))
+        mean[:, :4] = measurements
+
+        std = self._std(
+            measurements[:, 3], 2 * self._std_weight_position,
+            10 * self._std_weight_velocity, 1e-2)
+        covariance = np.zeros((n, 8, 8))
+        idx = np.arange(8)
+        covariance[:, idx, idx] = np.square(std)
+        return mean, covariance
+
+    def predict(self, mean, covariance):
+        std = self._std(
+            mean[:, 3], self._std_weight_position,
+            self._std_weight_velocity, 1e-2)
+
+        mean = mean @ self._motion_mat.T
+        covariance = self._motion_mat @ covariance @ self._motion_mat.T
+        idx = np.arange(8)
+        covariance[:, idx, idx] += np.square(std)
+        return mean, covariance
+
+    def project(self, mean, covariance):
+        std = self._std(mean[:, 3], self._std_weight_position, None, 1e-1)
+
+        projected_mean = mean[:, :4]
+        projected_cov = covariance[:, :4, :4].copy()
+        idx = np.arange(4)
+        projected_cov[:, idx, idx] += np.square(std)
+        return projected_mean, projected_cov
+
+    def update(self, mean, covariance, measurements):
+        projected_mean, projected_cov = self.project(mean, covariance)
+
+        # K = P H^T S^-1, with S symmetric: K^T = S^-1 (H P)
+        kalman_gain = np.linalg.solve(
+            projected_cov, covariance[:, :4, :]).transpose(0, 2, 1)
+        innovation = measurements - projected_mean
+
+        new_mean = mean + np.einsum('nij,nj->ni', kalman_gain, innovation)
+        new_covariance = covariance - \
+            kalman_gain @ projected_cov @ kalman_gain.transpose(0, 2, 1)
+        return new_mean, new_covariance
+
+    def gating_distance(self, mean, covariance, measurements, only_position=False):
+        """
+        Returns (N, M) squared Mahalanobis distances between the N state
+        distributions and the M measurements.
+        """
+        mean, covariance = self.project(mean, covariance)
+        measurements = np.asarray(measurements).reshape(-1, 4)
+        if only_position:
+            mean, covariance = mean[:, :2], covariance[:, :2, :2]
+            measurements = measurements[:, :2]
+
+        cholesky_factor = np.linalg.cholesky(covariance)
+        d = measurements[np.newaxis, :, :] - mean[:, np.newaxis, :]  # (N, M, k)
+        z = np.linalg.solve(cholesky_factor, d.transpose(0, 2, 1))
+        return np.sum(z * z, axis=1)
+
+
+class KalmanTrackStore:
+    """
+    Structure of arrays holding the Kalman states of all the tracks.
+
+    The means and covariances are kept in contiguous (capacity, 8) and
+    (capacity, 8, 8) arrays, each track owns a slot, and predict / update /
+    gating_distance process a list of slots at once.
+    """
+
+    def __init__(self, kf=None, capacity=64):
+        self.kf = kf if kf is not None else BatchKalmanFilter()
+        self.mean = np.zeros((capacity, 8))
+        self.covariance = np.zeros((capacity, 8, 8))
+        self._free = list(range(capacity - 1, -1, -1))
+        self._owners = {}
+
+    def _grow(self):
+        capacity = len(self.mean)
+        self.mean = np.concatenate([self.mean, np.zeros_like(self.mean)])
+        self.covariance = np.concatenate(
+            [self.covariance, np.zeros_like(self.covariance)])
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, mean, covariance, owner=None):
+        if not self._free:
+            self._grow()
+        slot = self._free.pop()
+        self.mean[slot] = mean
+        self.covariance[slot] = covariance
+        self._owners[slot] = owner
+        return slot
+
+    def release(self, slot):
+        del self._owners[slot]
+        self._free.append(slot)
+
+    def retain(self, tracks):
+        """Detach the tracks of the store not in tracks"""
+        keep = set(id(t) for t in tracks)
+        for slot, owner in list(self._owners.items()):
+            if owner is not None and id(owner) not in keep:
+                owner.detach()
+
+    def predict(self, slots):
+        slots = np.asarray(slots, dtype=np.int64)
+        if len(slots) == 0:
+            return
+        self.mean[slots], self.covariance[slots] = self.kf.predict(
+            self.mean[slots], self.covariance[slots])
+
+    def update(self, slots, measurements):
+        slots = np.asarray(slots, dtype=np.int64)
+        if len(slots) == 0:
+            return
+        self.mean[slots], self.covariance[slots] = self.kf.update(
+            self.mean[slots], self.covariance[slots],
+            np.asarray(measurements).reshape(-1, 4))
+
+    def gating_distance(self, slots, measurements, only_position=False):
+        slots = np.asarray(slots, dtype=np.int64)
+        return self.kf.gating_distance(
+            self.mean[slots], self.covariance[slots], measurements, only_position)
+
+
+class KalmanStateMixin:
+    """
+    Track attributes mean and covariance, backed by a KalmanTrackStore
+    slot once attached.
+
+    The getters read the row of the slot at each access and return a copy,
+    so that a value held by the caller is not invalidated when the store
+    grows, nor changed by the later batched updates (as with the per-track
+    filter, which assigns new arrays).
+    """
+    store = None
+    slot = None
+    _mean = None
+    _covariance = None
+
+    @property
+    def mean(self):
+        if self.store is None:
+            return self._mean
+        return self.store.mean[self.slot].copy()
+
+    @mean.setter
+    def mean(self, value):
+        if self.store is None:
+            self._mean = value
+        else:
+            self.store.mean[self.slot] = value
+
+    @property
+    def covariance(self):
+        if self.store is None:
+            return self._covariance
+        return self.store.covariance[self.slot].copy()
+
+    @covariance.setter
+    def covariance(self, value):
+        if self.store is None:
+            self._covariance = value
+        else:
+            self.store.covariance[self.slot] = value
+
+    def attach(self, store):
+        """Move the state into the store"""
+        if self.store is not None:
+            return
+        self.slot = store.add(self._mean, self._covariance, self)
+        self.store = store
+        self._mean = self._covariance = None
+
+    def detach(self):
+        """Move the state out of the store and free the slot"""
+        if self.store is None:
+            return
+        self._mean = self.store.mean[self.slot].copy()
+        self._covariance = self.store.covariance[self.slot].copy()
+        self.store.release(self.slot)
+        self.store = None
+        self.slot = None
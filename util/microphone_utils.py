@@ -11,7 +11,7 @@ logger = getLogger(__name__)
 M1_SAMPLE_RATE = 48000
 
 
-def capture_microphone(que, ready, pause, fin, sample_rate, sc=False, speaker=False):
+def capture_microphone(que, ready, pause, fin, sample_rate, sc=False, speaker=False, stream=False):
     if sc:
         import soundcard as sc
     else:
@@ -22,7 +22,8 @@ def capture_microphone(que, ready, pause, fin, sample_rate, sc=False, speaker=Fa
     SAMPLE_RATE = M1_SAMPLE_RATE if sc is False else sample_rate
     THRES_SPEECH_POW = 0.001
     THRES_SILENCE_POW = 0.0001
-    INTERVAL = SAMPLE_RATE * 3
+    # stream: send chunks of 0.1 s as they are recorded, without silence detection
+    INTERVAL = SAMPLE_RATE // 10 if stream else SAMPLE_RATE * 3
     INTERVAL_MIN = SAMPLE_RATE * 1.5
     BUFFER_MAX = SAMPLE_RATE * 10
 
@@ -49,6 +50,12 @@ def capture_microphone(que, ready, pause, fin, sample_rate, sc=False, speaker=Fa
                 audio = np.frombuffer(src.read(INTERVAL, exception_on_overflow=False), dtype=np.int16) / 32768.0
 
             audio = audio.reshape(-1)
+            if stream:
+                if sc is False and SAMPLE_RATE != sample_rate:
+                    audio = librosa.resample(audio, orig_sr=SAMPLE_RATE, target_sr=sample_rate)
+                que.put(audio.astype(np.float32))
+                continue
+
             square = audio ** 2
             if np.max(square) >= THRES_SPEECH_POW:
                 sys.stdout.write(".")
@@ -99,18 +106,18 @@ def capture_microphone(que, ready, pause, fin, sample_rate, sc=False, speaker=Fa
                 read(mic)
         else:
             p = pyaudio.PyAudio()
-            stream = p.open(
+            audio_stream = p.open(
                 format=pyaudio.paInt16,
                 channels=1,
                 rate=SAMPLE_RATE,
                 input=True,
                 frames_per_buffer=1024,
             )
-            stream.start_stream()
-            read(stream)
+            audio_stream.start_stream()
+            read(audio_stream)
 
-            stream.stop_stream()
-            stream.close()
+            audio_stream.stop_stream()
+            audio_stream.close()
             p.terminate()
         pass
     except KeyboardInterrupt:
@@ -119,7 +126,7 @@ def capture_microphone(que, ready, pause, fin, sample_rate, sc=False, speaker=Fa
         logger.exception(e)
 
 
-def start_microphone_input(sample_rate, sc=False, speaker=False, thread=False, queue_size=2):
+def start_microphone_input(sample_rate, sc=False, speaker=False, thread=False, queue_size=2, stream=False):
     que = mp.Queue(maxsize=queue_size)
     ready = mp.Event()
     pause = mp.Event()
@@ -128,12 +135,12 @@ def start_microphone_input(sample_rate, sc=False, speaker=False, thread=False, q
     if thread:
         p = threading.Thread(
             target=capture_microphone,
-            args=(que, ready, pause, fin, sample_rate, sc, speaker),
+            args=(que, ready, pause, fin, sample_rate, sc, speaker, stream),
             daemon=True)
     else:
         p = mp.Process(
             target=capture_microphone,
-            args=(que, ready, pause, fin, sample_rate, sc, speaker),
+            args=(que, ready, pause, fin, sample_rate, sc, speaker, stream),
             daemon=True)
     p.start()
 
@@ -153,3 +160,72 @@ def start_microphone_input(sample_rate, sc=False, speaker=False, thread=False, q
     )
 
     return params
+
+
+if __name__ == '__main__':
+    # Check of the capture with a recorded signal in place of the microphone
+    #   $ python3 microphone_utils.py
+    import queue
+    import types
+
+    def fake_pyaudio(signal, fin):
+        # pyaudio stand-in reading the int16 samples of signal, then
+        # finishing the capture
+        class Stream:
+            pos = 0
+
+            def read(self, n, exception_on_overflow=True):
+                chunk = signal[self.pos:self.pos + n]
+                self.pos += n
+                if len(signal) <= self.pos:
+                    fin.set()
+                chunk = np.pad(chunk, (0, n - len(chunk)))
+                return (chunk * 32767).astype(np.int16).tobytes()
+
+            def start_stream(self):
+                pass
+
+            def stop_stream(self):
+                pass
+
+            def close(self):
+                pass
+
+        class PyAudio:
+            def open(self, **kwargs):
+                return Stream()
+
+            def terminate(self):
+                pass
+
+        return types.SimpleNamespace(PyAudio=PyAudio, paInt16=8)
+
+    def capture(signal, stream):
+        que = queue.Queue()
+        ready, pause, fin = threading.Event(), threading.Event(), threading.Event()
+        sys.modules['pyaudio'] = fake_pyaudio(signal, fin)
+        capture_microphone(que, ready, pause, fin, M1_SAMPLE_RATE, stream=stream)
+        chunks = []
+        while not que.empty():
+            chunks.append(que.get())
+        return chunks
+
+    # 1 s of silence, a 2 s utterance and 3 s of silence
+    sr = M1_SAMPLE_RATE
+    t = np.arange(2 * sr) / sr
+    signal = np.concatenate([
+        np.zeros(sr), 0.5 * np.sin(2 * np.pi * 440 * t), np.zeros(3 * sr)])
+
+    # the utterance is detected and sent alone
+    chunks = capture(signal, stream=False)
+    print()
+    assert len(chunks) == 1, [len(x) for x in chunks]
+    assert 2 * sr <= len(chunks[0]) < 3 * sr, len(chunks[0])
+    print('utterance: %.2f s' % (len(chunks[0]) / sr))
+
+    # stream: all the samples are sent by chunks of 0.1 s
+    chunks = capture(signal, stream=True)
+    assert all(len(x) == sr // 10 for x in chunks)
+    assert len(chunks) == len(signal) // (sr // 10)
+    print('stream: %d chunks' % len(chunks))
+    print('ok')
@@ -2,8 +2,12 @@ import os
 import sys
 import argparse
 import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging import DEBUG
 
+import numpy as np
+
 from params import MODALITIES, EXTENSIONS
 import log_init
 
@@ -111,6 +115,16 @@ def get_base_parser(
         default=5, type=int,
         help='set iteration count of benchmark'
     )
+    parser.add_argument(
+        '--batch_size', metavar='BATCH_SIZE', default=1, type=int,
+        help=('Number of images inferred at once when a directory is given '
+              'as input. (Only for the models supporting batch inference)')
+    )
+    parser.add_argument(
+        '--workers', metavar='WORKERS', default=0, type=int,
+        help=('Number of threads decoding and preprocessing the upcoming '
+              'images while the current batch is inferred. (0: disabled)')
+    )
     return parser
 
 
@@ -216,6 +230,76 @@ def update_parser(parser, check_input_type=True, large_model=False):
     return args
 
 
+def prefetch_batches(inputs, load_fn, batch_size=1, workers=0):
+    """Load inputs in batches, preparing the upcoming batches in background
+
+    load_fn (e.g. decode and preprocess with image_utils.imread/load_image)
+    is run by a pool of worker threads ahead of the consumer, so that the
+    loading overlaps with the inference of the current batch.
+    Loaded data of the same shape are stacked along a new first axis; a
+    change of shape ends the batch early.
+
+    Parameters
+    ----------
+    inputs : list
+        input paths (e.g. args.input)
+    load_fn : function
+        function returning the preprocessed data (numpy array) of an input,
+        or a tuple (data, extra) to keep other results of the loading (e.g.
+        the decoded image), which are yielded with the input
+    batch_size : int
+    workers : int
+        number of worker threads, 0 loads the data in the calling thread
+
+    Yields
+    ------
+    batch_inputs : list
+        the inputs, or the (input, extra) pairs when load_fn returns a tuple
+    batch_data : numpy array
+        array of shape (len(batch_inputs), ...)
+    """
+    batch_size = max(batch_size, 1)
+
+    def flush(batch_inputs, batch_data):
+        return batch_inputs, np.stack(batch_data)
+
+    def loaded():
+        if workers <= 0:
+            for x in inputs:
+                yield x, load_fn(x)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            it = iter(inputs)
+            # keep the next 2 batches in flight
+            for x in it:
+                pending.append((x, executor.submit(load_fn, x)))
+                if len(pending) >= batch_size * 2 + workers:
+                    break
+            while pending:
+                x, future = pending.popleft()
+                for nx in it:
+                    pending.append((nx, executor.submit(load_fn, nx)))
+                    break
+                yield x, future.result()
+
+    batch_inputs, batch_data = [], []
+    for x, data in loaded():
+        if isinstance(data, tuple):
+            data, extra = data
+            x = (x, extra)
+        if batch_data and data.shape != batch_data[0].shape:
+            yield flush(batch_inputs, batch_data)
+            batch_inputs, batch_data = [], []
+        batch_inputs.append(x)
+        batch_data.append(data)
+        if len(batch_data) == batch_size:
+            yield flush(batch_inputs, batch_data)
+            batch_inputs, batch_data = [], []
+    if batch_data:
+        yield flush(batch_inputs, batch_data)
+
+
 def get_savepath(arg_path, src_path, prefix='', post_fix='_res', ext=None):
     """Get savepath
     NOTE: we may have better option...
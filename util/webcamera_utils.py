@@ -1,5 +1,7 @@
 import os
+import queue
 import sys
+import threading
 
 import numpy as np
 import cv2
@@ -185,3 +187,125 @@ def get_capture(video):
             capture = cv2.VideoCapture(video)
 
     return capture
+
+
+def _put_frame(q, item, policy, stop_event):
+    if policy == 'drop_oldest':
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+    else:
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+def run_video_pipeline(
+        capture, process_frame, writer=None, window_name='frame',
+        queue_size=4, policy='block', show=True):
+    """
+    Run process_frame on every frame of the capture with a pipeline.
+
+    Frames are decoded by a reader thread and encoded by a writer thread,
+    each connected to the inference stage (the calling thread) with a
+    bounded queue, so that the decode and encode time is hidden behind the
+    inference time. The display (cv2.imshow) is done in the calling thread.
+
+    Parameters
+    ----------
+    capture : cv2.VideoCapture
+    process_frame : callable
+        Function called with the frame (BGR) and returning the image to
+        display and write, or None to skip the frame.
+    writer : cv2.VideoWriter or None
+    window_name : str
+    queue_size : int
+        Size of the reader and writer queues.
+    policy : str
+        Back-pressure policy of the reader queue when the inference is
+        slower than the decoding.
+        - 'block': the reader waits, every frame is processed (video file)
+        - 'drop_oldest': the oldest waiting frame is discarded (webcam)
+    show : bool
+        Display the results with cv2.imshow.
+
+    Returns
+    -------
+    frame_count : int
+        Number of the processed frames.
+    """
+    if policy not in ('block', 'drop_oldest'):
+        raise ValueError(f"Unknown policy: {policy}")
+
+    stop_event = threading.Event()
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+
+    def read_loop():
+        while not stop_event.is_set():
+            ret, frame = capture.read()
+            if not ret:
+                break
+            _put_frame(read_queue, frame, policy, stop_event)
+        _put_frame(read_queue, None, 'block', stop_event)
+
+    def write_loop():
+        while True:
+            img = write_queue.get()
+            if img is None:
+                break
+            writer.write(img)
+
+    reader = threading.Thread(target=read_loop, daemon=True)
+    reader.start()
+    if writer is not None:
+        write_thread = threading.Thread(target=write_loop, daemon=True)
+        write_thread.start()
+
+    frame_count = 0
+    frame_shown = False
+    try:
+        while True:
+            frame = read_queue.get()
+            if frame is None:
+                break
+            if show:
+                if (cv2.waitKey(1) & 0xFF == ord('q')):
+                    break
+                if frame_shown and cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE) == 0:
+                    break
+
+            res_img = process_frame(frame)
+            frame_count += 1
+            if res_img is None:
+                continue
+
+            if show:
+                cv2.imshow(window_name, res_img)
+                frame_shown = True
+
+            if writer is not None:
+                write_queue.put(res_img)
+    finally:
+        stop_event.set()
+        # unblock the reader waiting on the full queue
+        try:
+            while True:
+                read_queue.get_nowait()
+        except queue.Empty:
+            pass
+        reader.join()
+        if writer is not None:
+            write_queue.put(None)
+            write_thread.join()
+
+    return frame_count